@@ -9,9 +9,47 @@ class AffinityMap(Chunk):
     def __init__(self, array, global_offset=None):
         super().__init__(array, global_offset=global_offset)
 
+    @classmethod
+    def from_chunk(cls, chunk):
+        assert isinstance(chunk, Chunk)
+        return cls(chunk.array, global_offset=chunk.global_offset)
+
     def quantize(self):
         # only use the last channel, it is the Z affinity
         # if this is affinitymap
         image = self[-1, :, :, :]
         image = (image * 255).astype(np.uint8)
         return image
+
+    def evaluate(self, reference, threshold: float = 0.5):
+        """compare with a reference affinity map.
+
+        This is used to check the accuracy of an approximated inference, 
+        such as int8 quantization, against the float32 inference.
+
+        Parameters
+        ------------
+        reference: the reference affinity map with the same shape.
+        threshold: the affinity threshold to binarize the maps. 
+            The voxels with different binary affinity could change 
+            the agglomeration.
+
+        Returns
+        ---------
+            a dict of the absolute error and the ratio of flipped voxels.
+        """
+        if isinstance(reference, Chunk):
+            reference = reference.array
+        assert self.shape == reference.shape
+
+        this = np.asarray(self.array, dtype=np.float32)
+        reference = np.asarray(reference, dtype=np.float32)
+        error = np.abs(this - reference)
+        flipped = np.count_nonzero((this > threshold) != (reference > threshold))
+        return {
+            'max_abs_error': float(error.max()),
+            'mean_abs_error': float(error.mean(dtype=np.float64)),
+            'root_mean_square_error': float(np.sqrt(np.mean(
+                np.square(error, dtype=np.float64)))),
+            'flipped_ratio': flipped / error.size
+        }
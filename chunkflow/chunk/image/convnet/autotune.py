@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+__doc__ = """
+Select the batch size and patch geometry of ConvNet inference by measured throughput.
+
+The candidate configurations are benchmarked with a synthetic chunk in
+the current computer, and the configuration with the most output voxels
+per second is selected. The model loading and the first chunk, which
+could include compilation and calibration, are not counted.
+"""
+import time
+import tracemalloc
+from itertools import product
+
+import numpy as np
+
+from chunkflow.chunk import Chunk
+from .inferencer import Inferencer
+
+
+def is_compatible(output_patch_size: tuple, output_patch_overlap: tuple,
+                  output_crop_margin: tuple):
+    """the patch overlap and crop margin should work with the output patch size."""
+    return all(0 <= o < s for o, s in zip(output_patch_overlap, output_patch_size)) \
+        and all(o <= m for o, m in zip(output_patch_overlap, output_crop_margin))
+
+
+def benchmark(patch_num: tuple, repeats: int = 2, **kwargs):
+    """measure the inference throughput of a configuration.
+
+    Parameters
+    ------------
+    patch_num:
+        the number of patches in z,y,x of the synthetic chunk.
+    repeats:
+        the number of chunks to measure after a warm up chunk.
+    kwargs:
+        the parameters of Inferencer.
+
+    Returns
+    ---------
+        a dict of the output voxels per second and the peak memory in bytes.
+        The peak memory only includes the allocation traced by Python,
+        such as the numpy buffers, but not the memory of ConvNet framework.
+    """
+    # the buffers allocated in the first chunk are reused in the following
+    # chunks, so the memory is traced from the beginning
+    tracemalloc.start()
+    try:
+        with Inferencer(patch_num=patch_num, skip_zero_patches=False,
+                        verbose=0, **kwargs) as inferencer:
+            input_chunk = Chunk.create(size=inferencer.input_size, dtype='uint8')
+            # the first chunk warms up the model
+            inferencer(input_chunk)
+
+            start = time.time()
+            for _ in range(repeats):
+                output_chunk = inferencer(input_chunk)
+                del output_chunk
+            elapsed = time.time() - start
+            _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'input_size': tuple(int(s) for s in inferencer.input_size),
+        'output_size': tuple(int(s) for s in inferencer.output_size),
+        'compute_device': inferencer.compute_device,
+        'voxels_per_second': float(
+            np.prod(inferencer.output_size) * repeats / elapsed),
+        'peak_memory': int(peak_memory)
+    }
+
+
+def autotune(batch_sizes: list, output_patch_overlaps: list,
+             output_crop_margins: list, patch_num: tuple = (2, 2, 2),
+             repeats: int = 2, max_memory: int = None, verbose: bool = True,
+             **kwargs):
+    """benchmark the candidate configurations and select the fastest one.
+
+    Parameters
+    ------------
+    batch_sizes:
+        the candidate batch sizes.
+    output_patch_overlaps:
+        the candidate output patch overlaps.
+    output_crop_margins:
+        the candidate output crop margins. None means the same with
+        the patch overlap.
+    patch_num:
+        the number of patches in z,y,x of the synthetic chunk.
+    repeats:
+        the number of chunks to measure for each configuration.
+    max_memory:
+        the configurations using more memory in bytes are not selected.
+    verbose:
+        print the result of each configuration or not.
+    kwargs:
+        the other parameters of Inferencer, such as the framework.
+
+    Returns
+    ---------
+        the best configuration and the results of all the configurations.
+    """
+    output_patch_size = kwargs.get('output_patch_size')
+    if output_patch_size is None:
+        output_patch_size = kwargs['input_patch_size']
+
+    results = []
+    for batch_size, output_patch_overlap, output_crop_margin in product(
+            batch_sizes, output_patch_overlaps, output_crop_margins):
+        if output_crop_margin is None:
+            output_crop_margin = output_patch_overlap
+        if not is_compatible(output_patch_size, output_patch_overlap,
+                             output_crop_margin):
+            continue
+
+        config = {
+            'batch_size': batch_size,
+            'output_patch_overlap': tuple(output_patch_overlap),
+            'output_crop_margin': tuple(output_crop_margin),
+        }
+        result = benchmark(patch_num, repeats=repeats, **config, **kwargs)
+        result.update(config)
+        result['patch_num'] = tuple(patch_num)
+        results.append(result)
+        if verbose:
+            print(f'batch size: {batch_size}, ' +
+                  f'patch overlap: {output_patch_overlap}, ' +
+                  f'crop margin: {output_crop_margin}, ' +
+                  f'voxels per second: {result["voxels_per_second"]:.0f}, ' +
+                  f'peak memory: {result["peak_memory"]/1e6:.1f} MB')
+
+    candidates = [r for r in results
+                  if max_memory is None or r['peak_memory'] <= max_memory]
+    if not candidates:
+        raise ValueError('no configuration is compatible with the patch size ' +
+                         'and the memory limit.')
+    best = max(candidates, key=lambda r: r['voxels_per_second'])
+    return best, results
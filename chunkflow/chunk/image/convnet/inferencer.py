@@ -4,15 +4,73 @@ ConvNet Inference of an image chunk
 """
 import os
 import time
+from threading import Lock, Thread
+from collections import OrderedDict
+from concurrent.futures import Future
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 from tqdm import tqdm
 from warnings import warn
 from typing import Union
-from tempfile import mktemp
+from tempfile import NamedTemporaryFile, TemporaryFile
+
+from gevent.monkey import get_original
 
 from chunkflow.chunk import Chunk
+from chunkflow.lib.tracer import tracer
 # from chunkflow.chunk.affinity_map import AffinityMap
 
+# the queue module was monkey patched by gevent in chunkflow/__init__.py,
+# and the patched queue do not work across real threads.
+Queue = get_original('queue', 'Queue')
+
+# the output chunk masks are shared by all the inferencers in a process.
+# the key is the input size and patch geometry, and the value is a 
+# readonly array of normalization weights. A mask is as large as the 
+# output chunk, so only the recently used ones are kept.
+_output_chunk_masks = OrderedDict()
+_output_chunk_masks_lock = Lock()
+_OUTPUT_CHUNK_MASK_CACHE_SIZE = 2
+
+# the attributes of an inferencer depending on the chunk in inference.
+# they are restored before resuming the inference of a streaming chunk.
+_CHUNK_STATE = ('input_size', 'output_size', 'output_patch_stride', 
+                'input_patch_offsets', 'output_patch_regions', 'patch_groups', 
+                'patch_grid_size', 'output_chunk_mask', 'input_patch_buffer', 
+                'input_patch_buffers', 'forward_times')
+
+
+def create_patch_inferencer(framework: str, convnet_model: str, 
+                            convnet_weight_path: str, **kwargs):
+    """create the patch inference backend.
+
+    The other parameters, such as the patch size, are passed to the backend.
+    """
+    if framework == 'pznet':
+        from .patch.pznet import PZNet as PatchInferencer
+    elif framework == 'pytorch':
+        from .patch.pytorch import PyTorch as PatchInferencer
+        # currently, we do not support pytorch backend with different
+        # input and output patch size and overlap.
+    elif framework == 'pytorch-quantized':
+        from .patch.pytorch_quantized import PyTorchQuantized as PatchInferencer
+    elif framework == 'pytorch-multitask':
+        # currently only this type of task support mask in device
+        from .patch.pytorch_multitask import PyTorchMultitask as PatchInferencer
+    elif framework == 'onnx':
+        from .patch.onnx_runtime import ONNXRuntime as PatchInferencer
+    elif framework == 'identity':
+        from .patch.identity import Identity as PatchInferencer
+    elif framework == 'general':
+        from .patch.general import General as PatchInferencer
+    elif framework == 'remote':
+        # the convnet model is the socket path of inference server
+        from .patch.remote import Remote as PatchInferencer
+    else:
+        raise Exception(f'invalid inference backend: {framework}')
+    
+    return PatchInferencer(convnet_model, convnet_weight_path, **kwargs)
+
 
 class Inferencer(object):
     """
@@ -28,6 +86,42 @@ class Inferencer(object):
     what's more, the output buffer is formated as memory map and was mapped 
     to disk. This is particularly useful for multiple channel output with 
     large chunk size.
+
+    The inferencer could be shared by multiple workers in different threads.
+    The chunk inference is serialized, so only one chunk is using the 
+    ConvNet model at a time.
+
+    The output chunk mask only depends on the input size and patch geometry,
+    so it is computed once and reused across tasks. If the mask_cache_dir 
+    is set, the mask is saved as a numpy file and memory mapped, so all the
+    worker processes in a node could share it.
+
+    In the double buffer mode, a background thread gathers the next batch 
+    of input patches and blends the outputs of previous batch while the 
+    current batch is in the ConvNet forward pass. The patch inference 
+    backend should return a new output array in each call.
+
+    The patches with all zero input, or fully masked out by a mask in lower
+    resolution, are not sent to the ConvNet model. Their output contribution
+    is zero, the same as an all zero input chunk.
+
+    In the out-of-core mode, the output buffer and output chunk mask are
+    memory mapped to scratch files, so the chunk could be larger than RAM. 
+    The scratch files are removed automatically after the arrays are deleted. 
+    The patches are blended in z, y, x order, so the blending streams 
+    through the files in z slabs.
+
+    The backend specific options, such as the number of threads of pytorch,
+    are passed to the patch inference backend with framework_options. The
+    number of batches and the time of forward passes are recorded in the 
+    task log, so the throughput of different compute devices could be compared.
+
+    In the overlap-add mode, the output is the weighted sum of patches 
+    without normalization, and the accumulated patch weight is appended as 
+    the last channel. The output covers all the patches without cropping,
+    so the outputs of neighboring chunks could be added together and 
+    normalized by the weight later. As a result, the patches in the 
+    overlapping margin of chunks only need to be computed once.
     """
     def __init__(self,
                  convnet_model: str,
@@ -40,15 +134,26 @@ class Inferencer(object):
                  output_crop_margin: Union[tuple, list] = None,
                  dtype = 'float32',
                  framework: str = 'identity',
+                 framework_options: dict = None,
                  batch_size: int = 1,
+                 double_buffer: bool = False,
                  bump: str = 'wu',
                  input_size: tuple = None,
                  mask_output_chunk: bool = False,
+                 overlap_add: bool = False,
+                 mask_cache_dir: str = None,
+                 skip_zero_patches: bool = True,
+                 scratch_dir: str = None,
                  mask_myelin_threshold = None,
                  dry_run: bool = False,
                  verbose: int = 1):
         
         assert input_size is None or patch_num is None 
+        if overlap_add:
+            # the weight of every voxel is needed and nothing is cropped
+            mask_output_chunk = True
+            # the myelin should be masked after normalization
+            assert mask_myelin_threshold is None
         
         if output_patch_size is None:
             output_patch_size = input_patch_size 
@@ -114,22 +219,44 @@ class Inferencer(object):
         self.num_output_channels = num_output_channels
         self.verbose = verbose
         self.mask_output_chunk = mask_output_chunk
+        self.overlap_add = overlap_add
         self.output_chunk_mask = None
+        if mask_cache_dir:
+            mask_cache_dir = os.path.expanduser(mask_cache_dir)
+            os.makedirs(mask_cache_dir, exist_ok=True)
+        self.mask_cache_dir = mask_cache_dir
+        # the patch mask, hence the output chunk mask, depends on the bump
+        self.bump = bump
+        self.skip_zero_patches = skip_zero_patches
+        if scratch_dir:
+            scratch_dir = os.path.expanduser(scratch_dir)
+            os.makedirs(scratch_dir, exist_ok=True)
+        self.scratch_dir = scratch_dir
         self.dtype = dtype        
         self.mask_myelin_threshold = mask_myelin_threshold
         self.dry_run = dry_run
+        # the model, patch list and buffers are reused across chunks 
+        self.lock = Lock()
         
         # allocate a buffer to avoid redundant memory allocation
-        self.input_patch_buffer = np.zeros((batch_size, 1, *input_patch_size),
-                                           dtype=dtype)
-
-        self.patch_slices_list = []
+        self.double_buffer = double_buffer
+        self.input_patch_buffer = None
+        self._prepare_input_patch_buffers(np.dtype(dtype))
+
+        # the patch grid is stored as integer offset arrays inside the chunk 
+        self.input_patch_offsets = None
+        self.output_patch_regions = None
+        self.patch_groups = None
+        self.patch_grid_size = None
         
         if isinstance(convnet_model, str):
             convnet_model = os.path.expanduser(convnet_model)
         if isinstance(convnet_weight_path, str):
             convnet_weight_path = os.path.expanduser(convnet_weight_path)
-        self._prepare_patch_inferencer(framework, convnet_model, convnet_weight_path, bump)
+        self._prepare_patch_inferencer(framework, convnet_model, convnet_weight_path, 
+                                       bump, framework_options)
+        # the time of forward passes in a chunk
+        self.forward_times = []
    
     @property
     def compute_device(self):
@@ -147,8 +274,8 @@ class Inferencer(object):
         patch offset list and output chunk mask. Otherwise, recompute them.
         """
         if np.array_equal(self.input_size, input_chunk.shape):
-            print('reusing output chunk mask.')
-            assert self.patch_slices_list is not None
+            if self.verbose:
+                print('reusing output chunk mask.')
         else:
             if self.input_size is not None:
                 warn('the input size has changed, using new intput size.')
@@ -164,31 +291,24 @@ class Inferencer(object):
         self.output_patch_stride = tuple(s-o for s, o in zip(
             self.output_patch_size, self.output_patch_overlap))
 
-        self._construct_patch_slices_list(input_chunk.global_offset)
+        if not np.array_equal(self.patch_grid_size, self.input_size):
+            # the patch offsets are relative to the chunk, 
+            # so they only depend on the chunk size
+            self._construct_patch_offsets()
         self._construct_output_chunk_mask(input_chunk)
 
-    def _prepare_patch_inferencer(self, framework, convnet_model, convnet_weight_path, bump):
-        # prepare for inference
-        if framework == 'pznet':
-            from .patch.pznet import PZNet as PatchInferencer
-        elif framework == 'pytorch':
-            # pytorch will not output consistent result if we use batch size > 1
+    def _prepare_patch_inferencer(self, framework, convnet_model, convnet_weight_path, 
+                                  bump, framework_options=None):
+        # the backend specific options, such as the number of threads
+        framework_options = dict(framework_options or {})
+        if framework in ('pytorch', 'pytorch-quantized'):
+            # pytorch used to output inconsistent result with batch size > 1
             # https://discuss.pytorch.org/t/solved-inconsistent-results-during-test-using-different-batch-size/2265 
-            assert self.batch_size == 1
-            from .patch.pytorch import PyTorch as PatchInferencer
-            # currently, we do not support pytorch backend with different
-            # input and output patch size and overlap.
-        elif framework == 'pytorch-multitask':
-            # currently only this type of task support mask in device
-            from .patch.pytorch_multitask import PyTorchMultitask as PatchInferencer
-        elif framework == 'identity':
-            from .patch.identity import Identity as PatchInferencer
-        elif framework == 'general':
-            from .patch.general import General as PatchInferencer
-        else:
-            raise Exception(f'invalid inference backend: {self.framework}')
+            # the backend checks it with the batch size while loading the model.
+            framework_options['batch_size'] = self.batch_size
         
-        self.patch_inferencer = PatchInferencer(
+        self.patch_inferencer = create_patch_inferencer(
+            framework,
             convnet_model,
             convnet_weight_path,
             input_patch_size=self.input_patch_size,
@@ -196,7 +316,8 @@ class Inferencer(object):
             output_patch_overlap=self.output_patch_overlap,
             num_output_channels=self.num_output_channels,
             dtype=self.dtype,
-            bump=bump)
+            bump=bump,
+            **framework_options)
 
     def _check_alignment(self):
         is_align = tuple((i - o) % s == 0 for i, s, o in zip(
@@ -211,215 +332,630 @@ class Inferencer(object):
         if self.verbose:
             print('great! patches aligns in chunk.')
 
-    def _construct_patch_slices_list(self, input_chunk_offset):
+    def _construct_patch_offsets(self):
         """
-        create the normalization mask and patch bounding box list
+        create the patch offset arrays inside the input chunk and output buffer
         """
-        self.patch_slices_list = []
         # the step is the stride, so the end of aligned patch is
         # input_size - patch_overlap
+        if self.verbose:
+            print('Construct patch offsets...')
+        starts = []
+        for isz, ps, po, pst in zip(self.input_size, self.input_patch_size,
+                                    self.input_patch_overlap, self.input_patch_stride):
+            axis_starts = np.arange(0, isz - po, pst)
+            # the last patch is shifted back to align with the chunk end
+            axis_starts = np.minimum(axis_starts, isz - ps)
+            assert np.all(axis_starts >= 0)
+            starts.append(axis_starts)
+
+        grid_shape = tuple(len(axis_starts) for axis_starts in starts)
+        # the patches are ordered as z, y, x
+        grid_index = np.stack(np.unravel_index(
+            np.arange(np.prod(grid_shape)), grid_shape), axis=1)
+        self.input_patch_offsets = np.stack([axis_starts[index] for axis_starts, index 
+            in zip(starts, grid_index.T)], axis=1)
         
-        input_patch_size = self.input_patch_size
-        output_patch_size = self.output_patch_size
-        input_patch_overlap = self.input_patch_overlap 
-        input_patch_stride = self.input_patch_stride 
-
-        print('Construct patch slices list...')
-        for iz in range(0, self.input_size[0] - input_patch_overlap[0], input_patch_stride[0]):
-            if iz + input_patch_size[0] > self.input_size[0]:
-                iz = self.input_size[0] - input_patch_size[0]
-                assert iz >= 0
-            iz += input_chunk_offset[-3]
-            oz = iz + self.output_patch_crop_margin[0]
-            for iy in range(0, self.input_size[1] - input_patch_overlap[1], input_patch_stride[1]):
-                if iy + input_patch_size[1] > self.input_size[1]:
-                    iy = self.input_size[1] - input_patch_size[1]
-                    assert iy >= 0
-                iy += input_chunk_offset[-2]
-                oy = iy + self.output_patch_crop_margin[1]
-                for ix in range(0, self.input_size[2] - input_patch_overlap[2], input_patch_stride[2]):
-                    if ix + input_patch_size[2] > self.input_size[2]:
-                        ix = self.input_size[2] - input_patch_size[2]
-                        assert ix >= 0
-                    ix += input_chunk_offset[-1]
-                    ox = ix + self.output_patch_crop_margin[2]
-                    input_patch_slice =  (slice(iz, iz + input_patch_size[0]),
-                                          slice(iy, iy + input_patch_size[1]),
-                                          slice(ix, ix + input_patch_size[2]))
-                    output_patch_slice = (slice(oz, oz + output_patch_size[0]),
-                                          slice(oy, oy + output_patch_size[1]),
-                                          slice(ox, ox + output_patch_size[2]))
-                    self.patch_slices_list.append((input_patch_slice, output_patch_slice))
+        # the output patch could start from the outside of output buffer 
+        # since the margin of output buffer was cropped.
+        offsets = self.input_patch_offsets + np.asarray(
+            self.output_patch_crop_margin) - np.asarray(self.output_offset)
+        patch_size = np.asarray(self.output_patch_size)
+        patch_starts = np.maximum(offsets, 0)
+        patch_stops = np.minimum(offsets + patch_size, np.asarray(self.output_size))
+        # the start in output buffer, the start inside the patch, 
+        # and the size of the region inside output buffer
+        self.output_patch_regions = np.concatenate((
+            patch_starts, patch_starts - offsets, patch_stops - patch_starts), axis=1)
+
+        # the patches with the same remainder of the grid index do not overlap,
+        # even if the last patch was shifted back to align with the chunk end.
+        # the patches in a group also have the same region size.
+        period = np.ceil(patch_size / np.asarray(self.output_patch_stride)).astype(int) + 1
+        group_keys = np.concatenate((grid_index % period, 
+                                     self.output_patch_regions[:, 3:]), axis=1)
+        _, self.patch_groups = np.unique(group_keys, axis=0, return_inverse=True)
+        self.patch_groups = self.patch_groups.reshape(-1)
+        self.patch_grid_size = self.input_size
+
+    def _prepare_input_patch_buffers(self, dtype: np.dtype):
+        """allocate the input patch buffers if the data type changed."""
+        if self.input_patch_buffer is not None and \
+                self.input_patch_buffer.dtype == dtype:
+            return
+        self.input_patch_buffer = np.zeros(
+            (self.batch_size, 1, *self.input_patch_size), dtype=dtype)
+        if self.double_buffer:
+            # one buffer is in the forward pass while the other one is filling
+            self.input_patch_buffers = (self.input_patch_buffer, 
+                                        np.zeros_like(self.input_patch_buffer))
+
+    def _gather_input_patches(self, input_array: np.ndarray, 
+                              patch_range: Union[slice, np.ndarray],
+                              input_patch_buffer: np.ndarray):
+        """copy a batch of input patches to the input patch buffer.
+
+        The integer input is normalized to 0-1 value range in the buffer,
+        so only the patches are converted to float rather than the chunk.
+        """
+        offsets = self.input_patch_offsets[patch_range]
+        if len(offsets) == 1:
+            z, y, x = offsets[0].tolist()
+            pz, py, px = self.input_patch_size
+            input_patch_buffer[0, 0, ...] = input_array[z:z+pz, y:y+py, x:x+px]
+        else:
+            # the window view do not copy the data
+            windows = sliding_window_view(input_array, self.input_patch_size)
+            input_patch_buffer[:len(offsets), 0, ...] = windows[
+                offsets[:, 0], offsets[:, 1], offsets[:, 2]]
+        
+        if np.issubdtype(input_array.dtype, np.integer) and \
+                np.issubdtype(input_patch_buffer.dtype, np.floating):
+            patches = input_patch_buffer[:len(offsets)]
+            np.divide(patches, np.iinfo(input_array.dtype).max, out=patches)
+
+    def _scatter_output_patches(self, output_array: np.ndarray, 
+                                output_patches: np.ndarray, 
+                                patch_range: Union[slice, np.ndarray],
+                                z_offset: int = 0):
+        """accumulate a batch of output patches to the output buffer.
+
+        The patches are partitioned to groups without any overlap, 
+        so each group is accumulated by one vectorized operation.
+
+        Parameters
+        ------------
+        output_array:
+            4D array of the output buffer with channel dimension.
+        output_patches:
+            5D array of output patches, and the first dimension is batch.
+        patch_range:
+            the range or index array of patches.
+        z_offset:
+            the z start of output array in the output buffer. It is used to 
+            blend the patches to a slab of the output buffer.
+        """
+        regions = self.output_patch_regions[patch_range]
+        # only use the required number of channels
+        # the remaining channels are dropped
+        output_patches = output_patches[:len(regions), :output_array.shape[0], ...]
+        
+        groups = self.patch_groups[patch_range]
+        for group in np.unique(groups):
+            members = np.nonzero(groups == group)[0]
+            z, y, x, pz, py, px, sz, sy, sx = regions[members[0]].tolist()
+            z -= z_offset
+            if min(sz, sy, sx) <= 0:
+                # the patches are all in the cropped margin
+                continue
+            patches = output_patches[members, :, pz:pz+sz, py:py+sy, px:px+sx]
+            if len(members) == 1:
+                output_array[:, z:z+sz, y:y+sy, x:x+sx] += patches[0]
+            else:
+                starts = regions[members, :3] - (z_offset, 0, 0)
+                windows = sliding_window_view(output_array, (sz, sy, sx), 
+                                              axis=(-3, -2, -1), writeable=True)
+                # the windows do not overlap, so the accumulation is correct
+                windows[:, starts[:, 0], starts[:, 1], starts[:, 2]] += \
+                    np.moveaxis(patches, 0, 1)
 
     def _construct_output_chunk_mask(self, input_chunk):
         if not self.mask_output_chunk:
             return
 
-        if self.verbose:
-            print('creating output chunk mask...')
+        # the output chunk weight is saved instead of the mask in overlap-add mode
+        kind = 'weight' if self.overlap_add else 'mask'
+        key = (kind, self.bump, tuple(self.input_size), tuple(self.input_patch_size),
+               tuple(self.output_patch_size), tuple(self.output_patch_overlap),
+               tuple(self.output_crop_margin), np.dtype(self.dtype).name)
+        with _output_chunk_masks_lock:
+            output_mask_array = _output_chunk_masks.get(key)
+            if output_mask_array is not None:
+                _output_chunk_masks.move_to_end(key)
         
-        if self.output_chunk_mask is None or not np.array_equal(
-                input_chunk.shape, self.output_chunk_mask.shape):
-            # To-Do: clean up extra temporal files if we created 
-            # multiple mmap files
-            #output_mask_mmap_file = mktemp(suffix='.dat')
-            ## the memory map is initialized with 0 in default
-            #output_mask_array = np.memmap(output_mask_mmap_file, 
-            #                                   dtype=self.dtype, mode='w+', 
-            #                                   shape=self.output_size)
-            output_mask_array = np.zeros(self.output_size, self.dtype)
-        else:
-            output_chunk_mask_array = self.output_chunk_mask.array
-            output_chunk_mask_array.fill(0)
+        if output_mask_array is None:
+            output_mask_array = self._load_output_chunk_mask(key)
+        
+        if output_mask_array is None:
+            if self.verbose:
+                print('creating output chunk mask...')
+            output_mask_array = self._compute_output_chunk_mask()
+            if self.mask_cache_dir:
+                self._dump_output_chunk_mask(key, output_mask_array)
+                # use the memory map to share the pages with other processes
+                output_mask_array = self._load_output_chunk_mask(key)
+            # the mask is shared, it should never be modified
+            output_mask_array.flags.writeable = False
+
+        with _output_chunk_masks_lock:
+            output_mask_array = _output_chunk_masks.setdefault(key, output_mask_array)
+            _output_chunk_masks.move_to_end(key)
+            while len(_output_chunk_masks) > _OUTPUT_CHUNK_MASK_CACHE_SIZE:
+                # the evicted mask is released after the inferencers using 
+                # it move to another chunk size
+                _output_chunk_masks.popitem(last=False)
 
         output_global_offset = tuple(io + ocso for io, ocso in zip(
             input_chunk.global_offset, self.output_offset))
- 
-        self.output_chunk_mask = Chunk(output_mask_array, global_offset=output_global_offset)
+        self.output_chunk_mask = Chunk(output_mask_array, 
+                                       global_offset=output_global_offset)
+
+    def _compute_output_chunk_mask(self):
+        output_mask_array = self._create_array(self.output_size, self.dtype)
         
-        assert len(self.patch_slices_list) > 0
-        for _, output_patch_slice in self.patch_slices_list:
-            # accumulate weights using the patch mask in RAM
-            patch_global_offset = tuple(s.start for s in output_patch_slice)
-            patch_mask = Chunk(self.patch_inferencer.output_patch_mask_numpy,
-                               global_offset=patch_global_offset)
-            self.output_chunk_mask.blend(patch_mask)
+        assert len(self.output_patch_regions) > 0
+        # accumulate weights using the patch mask in RAM
+        patch_mask = self.patch_inferencer.output_patch_mask_numpy
+        patch_masks = np.broadcast_to(patch_mask, (self.batch_size, 1, *patch_mask.shape))
+        for i in range(0, len(self.output_patch_regions), self.batch_size):
+            self._scatter_output_patches(
+                output_mask_array[np.newaxis, ...], patch_masks, 
+                slice(i, i + self.batch_size))
         
-        # normalize weight, so accumulated inference result multiplies
-        # this mask will result in 1
-        self.output_chunk_mask.array = 1.0 / self.output_chunk_mask.array
+        if not self.overlap_add:
+            # normalize weight, so accumulated inference result multiplies
+            # this mask will result in 1
+            np.reciprocal(output_mask_array, out=output_mask_array)
+        return output_mask_array
+
+    def _output_chunk_mask_file(self, key: tuple):
+        # the file name is readable, such as
+        # output_chunk_mask_wu_20x256x256_..._float32.npy
+        name = '_'.join('x'.join(str(v) for v in k) for k in key[2:-1])
+        return os.path.join(self.mask_cache_dir, 
+                            f'output_chunk_{key[0]}_{key[1]}_{name}_{key[-1]}.npy')
+
+    def _load_output_chunk_mask(self, key: tuple):
+        if not self.mask_cache_dir:
+            return None
+        file_name = self._output_chunk_mask_file(key)
+        try:
+            output_mask_array = np.load(file_name, mmap_mode='r')
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        if self.verbose:
+            print('loaded output chunk mask: ', file_name)
+        return output_mask_array
     
+    def _dump_output_chunk_mask(self, key: tuple, output_mask_array: np.ndarray):
+        # write to a temporal file first, so other processes never read
+        # a partially written mask
+        with NamedTemporaryFile(dir=self.mask_cache_dir, suffix='.tmp', 
+                                delete=False) as f:
+            np.save(f, output_mask_array)
+        os.replace(f.name, self._output_chunk_mask_file(key))
+    
+    def _create_array(self, shape: tuple, dtype):
+        """create a zero array in RAM, or in a scratch file in out-of-core mode."""
+        if self.scratch_dir is None:
+            return np.zeros(shape, dtype=dtype)
+        
+        # the scratch file is removed while closing it, and the disk space 
+        # is released after the memory map is deleted.
+        with TemporaryFile(dir=self.scratch_dir, suffix='.dat') as f:
+            # the memory map is initialized with 0
+            return np.memmap(f, dtype=dtype, mode='w+', shape=shape)
+
+    def _z_slabs(self, size_z: int):
+        """the z slices to traverse the output buffer slab by slab."""
+        step = self.output_patch_size[0]
+        for z in range(0, size_z, step):
+            yield slice(z, min(z + step, size_z))
+
+    @property
+    def num_buffer_channels(self):
+        # the last channel is the weight in overlap-add mode
+        return self.patch_inferencer.num_output_channels + int(self.overlap_add)
+
     def _get_output_buffer(self, input_chunk):
-        output_buffer_size = (self.patch_inferencer.num_output_channels, ) + self.output_size
-        #if self.mask_myelin_threshold is None:
-        # a random temporal file. will be removed later.
-        #output_buffer_mmap_file = mktemp(suffix='.dat')
-        ## the memory map is initialized with 0 in default
-        #output_buffer_array = np.memmap(output_buffer_mmap_file, 
-        #                               dtype=self.dtype, mode='w+', 
-        #                               shape=output_buffer_size)
-        ##else:
-        #    # when we use myelin mask, the masking computation will create a full array in RAM!
-        #    # and it will duplicate the array! thus, we should use normal array in this case.
-        output_buffer_array = np.zeros(output_buffer_size, dtype=self.dtype)
+        output_buffer_size = (self.num_buffer_channels, ) + self.output_size
+        # when we use myelin mask, the masking computation will create a full array in RAM!
+        output_buffer_array = self._create_array(output_buffer_size, self.dtype)
         
         output_global_offset = tuple(io + ocso for io, ocso in zip(
             input_chunk.global_offset, self.output_offset))
         
         output_buffer = Chunk(output_buffer_array,
                                    global_offset=(0,) + output_global_offset)
-        assert output_buffer == 0
         return output_buffer
 
-    def __call__(self, input_chunk: np.ndarray):
+    def _forward(self, input_patches: np.ndarray):
+        start = time.time()
+        with tracer.span('forward', category='inference'):
+            output_patches = self.patch_inferencer(input_patches)
+        self.forward_times.append(time.time() - start)
+        return output_patches
+
+    def _infer_patches(self, input_array: np.ndarray, output_array: np.ndarray,
+                       patch_index: np.ndarray, z_offset: int = 0):
+        """run the gathering, forward pass and blending of batches in sequence."""
+        # iterate the selected patches
+        for i in tqdm(range(0, len(patch_index), self.batch_size),
+                      disable=not self.verbose,
+                      desc='ConvNet inference for patches: '):
+            if self.verbose:
+                start = time.time()
+
+            patch_range = patch_index[i:i + self.batch_size]
+            with tracer.span('gather', category='inference'):
+                self._gather_input_patches(input_array, patch_range,
+                                           self.input_patch_buffer)
+
+            if self.verbose > 1:
+                end = time.time()
+                print('prepare %d input patches takes %3f sec' %
+                      (self.batch_size, end - start))
+                start = end
+
+            # the input and output patch is a 5d numpy array with
+            # datatype of float32, the dimensions are batch/channel/z/y/x.
+            # the input image should be normalized to [0,1]
+            output_patch = self._forward(self.input_patch_buffer)
+
+            if self.verbose > 1:
+                assert output_patch.ndim == 5
+                end = time.time()
+                print('run inference for %d patch takes %3f sec' %
+                      (self.batch_size, end - start))
+                start = end
+
+            with tracer.span('blend', category='inference'):
+                self._scatter_output_patches(output_array, output_patch,
+                                             patch_range, z_offset)
+
+            if self.verbose > 1:
+                end = time.time()
+                print('blend patch takes %3f sec' % (end - start))
+
+    def _infer_patches_double_buffered(self, input_array: np.ndarray, 
+                                       output_array: np.ndarray,
+                                       patch_index: np.ndarray,
+                                       z_offset: int = 0):
+        """overlap the gathering and blending with the forward pass.
+
+        A background thread runs the gathering and blending jobs in order, 
+        so the blending of a batch is always finished before the 
+        gathering of two batches later, and the outputs waiting for 
+        blending will not accumulate.
+        """
+        jobs = Queue()
+
+        def work():
+            while True:
+                job = jobs.get()
+                if job is None:
+                    return
+                future, func, args = job
+                try:
+                    future.set_result(func(*args))
+                except BaseException as exception:
+                    future.set_exception(exception)
+        
+        def submit(func, *args):
+            future = Future()
+            jobs.put((future, func, args))
+            return future
+
+        def gather(patch_range, input_patch_buffer):
+            with tracer.span('gather', category='inference'):
+                self._gather_input_patches(input_array, patch_range, 
+                                           input_patch_buffer)
+        
+        def blend(output_patch, patch_range):
+            with tracer.span('blend', category='inference'):
+                self._scatter_output_patches(output_array, output_patch, 
+                                             patch_range, z_offset)
+
+        patch_ranges = [patch_index[i:i + self.batch_size] for i in range(
+            0, len(patch_index), self.batch_size)]
+
+        thread = Thread(target=work, name='patch-worker', daemon=True)
+        thread.start()
+        try:
+            gathered = submit(gather, patch_ranges[0], self.input_patch_buffers[0])
+            blended = []
+            for idx, patch_range in enumerate(tqdm(patch_ranges,
+                    disable=not self.verbose,
+                    desc='ConvNet inference for patches: ')):
+                if self.verbose > 1:
+                    start = time.time()
+
+                with tracer.span('wait', category='inference'):
+                    gathered.result()
+                if idx + 1 < len(patch_ranges):
+                    # fill the other buffer in background
+                    gathered = submit(gather, patch_ranges[idx + 1], 
+                                      self.input_patch_buffers[(idx + 1) % 2])
+                
+                output_patch = self._forward(self.input_patch_buffers[idx % 2])
+                
+                blended.append(submit(blend, output_patch, patch_range))
+
+                if self.verbose > 1:
+                    print('wait and run inference for %d patch takes %3f sec' %
+                          (self.batch_size, time.time() - start))
+            
+            for future in blended:
+                # raise the exception in blending
+                future.result()
+        finally:
+            jobs.put(None)
+            thread.join()
+
+    def _select_patches(self, input_chunk: Chunk, mask: Chunk, mask_factor: tuple):
+        """find the patches that need the forward pass.
+
+        args:
+            input_chunk (Chunk): input chunk with global offset
+            mask (Chunk): mask in lower resolution with global offset. 
+            mask_factor (tuple): downsampling factor of mask in z,y,x.
+        return:
+            the index array of selected patches.
+        """
+        selected = np.ones(len(self.input_patch_offsets), dtype=bool)
+        
+        if self.skip_zero_patches:
+            selected &= _any_nonzero(
+                input_chunk.array, self.input_patch_offsets, 
+                self.input_patch_offsets + np.asarray(self.input_patch_size))
+
+        if mask is not None:
+            # the patch is skipped if the output region is fully masked out
+            mask_factor = np.asarray(mask_factor)
+            starts = self.input_patch_offsets + np.asarray(
+                input_chunk.global_offset[-3:]) + np.asarray(
+                    self.output_patch_crop_margin)
+            stops = starts + np.asarray(self.output_patch_size)
+            mask_starts = np.maximum(starts // mask_factor - np.asarray(
+                mask.global_offset[-3:]), 0)
+            mask_stops = np.maximum(-(-stops // mask_factor) - np.asarray(
+                mask.global_offset[-3:]), 0)
+            selected &= _any_nonzero(mask.array, mask_starts, mask_stops)
+        
+        return np.flatnonzero(selected)
+
+    def __call__(self, input_chunk: Chunk, mask: Chunk = None,
+                 mask_factor: tuple = (1, 1, 1), log: dict = None):
         """
         args:
             input_chunk (Chunk): input chunk with global offset
+            mask (Chunk): mask with global offset in lower resolution. 
+                The patches fully masked out are skipped.
+            mask_factor (tuple): downsampling factor of mask in z,y,x.
+            log (dict): the task log to record the number of skipped patches.
         """
         assert isinstance(input_chunk, Chunk)
+        with self.lock:
+            output_chunk, = self._infer(input_chunk, mask, mask_factor, log)
+        return output_chunk
+
+    def infer_slabs(self, input_chunk: Chunk, slab_size: int, mask: Chunk = None,
+                    mask_factor: tuple = (1, 1, 1), log: dict = None):
+        """streaming inference that yields the finished output in z slabs.
+
+        The patches are processed row by row in z. A slab is finalized and 
+        yielded as soon as all the patches overlapping with it were blended,
+        so the downstream could save it while the following slabs are 
+        still in inference. Only a few slabs are kept in memory. 
+
+        args:
+            input_chunk (Chunk): input chunk with global offset
+            slab_size (int): the slab boundaries are aligned with multiples 
+                of slab size in global z coordinate, such as the block size 
+                of output volume, so the slabs could be saved independently.
+            mask (Chunk): mask with global offset in lower resolution. 
+            mask_factor (tuple): downsampling factor of mask in z,y,x.
+            log (dict): the task log to record the number of skipped patches.
+        """
+        assert isinstance(input_chunk, Chunk)
+        assert slab_size > 0
+        slabs = self._infer(input_chunk, mask, mask_factor, log, 
+                            slab_size=slab_size)
+        chunk_state = None
+        while True:
+            # the lock is released while the consumer handles a slab, 
+            # so the other workers could infer their chunks meanwhile
+            with self.lock:
+                if chunk_state is not None:
+                    self.__dict__.update(chunk_state)
+                slab = next(slabs, None)
+                chunk_state = {name: getattr(self, name) 
+                               for name in _CHUNK_STATE if hasattr(self, name)}
+            if slab is None:
+                return
+            yield slab
+
+    def _infer(self, input_chunk: Chunk, mask: Chunk = None, 
+               mask_factor: tuple = (1, 1, 1), log: dict = None,
+               slab_size: int = None):
+        """generate the output chunks. 
         
-        self._update_parameters_for_input_chunk(input_chunk)
-        output_buffer = self._get_output_buffer(input_chunk)
+        The whole output is a single chunk if the slab size is None.
+        """
+        with tracer.span('prepare', category='inference'):
+            self._update_parameters_for_input_chunk(input_chunk)
 
         if not self.mask_output_chunk:
             self._check_alignment()
          
+        output_global_offset = (0,) + tuple(io + ocso for io, ocso in zip(
+            input_chunk.global_offset, self.output_offset))
+
         if self.dry_run:
             print('dry run, return a special artifical chunk.')
-            size=output_buffer.shape
+            size = (self.num_buffer_channels, *self.output_size)
             
             if self.mask_myelin_threshold:
                 # eleminate the myelin channel
                 size = (size[0]-1, *size[1:])
 
-            return Chunk.create(
+            yield Chunk.create(
                 size=size,
-                dtype = output_buffer.dtype,
-                voxel_offset=output_buffer.global_offset
+                dtype = self.dtype,
+                voxel_offset=output_global_offset
             )
+            return
        
         if input_chunk == 0:
             print('input is all zero, return zero buffer directly')
+            patch_index = np.zeros(0, dtype=int)
+        else:
+            with tracer.span('select', category='inference'):
+                patch_index = self._select_patches(input_chunk, mask, mask_factor)
+        
+        if log is not None:
+            log['inference'] = {
+                'executed_patches': len(patch_index),
+                'skipped_patches': len(self.input_patch_offsets) - len(patch_index)}
+
+        if len(patch_index) == 0:
+            output_buffer = self._get_output_buffer(input_chunk)
             if self.mask_myelin_threshold:
                 assert output_buffer.shape[0] == 4
-                return output_buffer[:-1, ...]
+                yield output_buffer[:-1, ...]
+            elif self.overlap_add:
+                # the weight is still needed to normalize the neighboring chunks
+                yield self._finalize_output(output_buffer)
             else:
-                return output_buffer
+                yield output_buffer
+            return
         
-        if np.issubdtype(input_chunk.dtype, np.integer):
-            # normalize to 0-1 value range
-            dtype_max = np.iinfo(input_chunk.dtype).max
-            input_chunk = input_chunk.astype(self.dtype) / dtype_max
+        if self.patch_inferencer.accepts_raw_input and \
+                np.issubdtype(input_chunk.dtype, np.integer):
+            # the backend normalizes the input patches by itself
+            self._prepare_input_patch_buffers(input_chunk.dtype)
+        else:
+            # the input patches are normalized while gathering
+            self._prepare_input_patch_buffers(np.dtype(self.dtype))
 
         if self.verbose:
             chunk_time_start = time.time()
 
-        # iterate the offset list
-        for i in tqdm(range(0, len(self.patch_slices_list), self.batch_size),
-                      disable=not self.verbose,
-                      desc='ConvNet inference for patches: '):
-            if self.verbose:
-                start = time.time()
-
-            batch_slices = self.patch_slices_list[i:i + self.batch_size]
-            for batch_idx, slices in enumerate(batch_slices):
-                self.input_patch_buffer[
-                    batch_idx, 0, :, :, :] = input_chunk.cutout(slices[0]).array
+        self.forward_times = []
+        if slab_size is None:
+            output_buffer = self._get_output_buffer(input_chunk)
+            self._run_patches(input_chunk.array, output_buffer.array, patch_index)
+            yield self._finalize_output(output_buffer)
+        else:
+            yield from self._stream_slabs(input_chunk.array, patch_index, 
+                                          output_global_offset, slab_size)
 
-            if self.verbose > 1:
-                end = time.time()
-                print('prepare %d input patches takes %3f sec' %
-                      (self.batch_size, end - start))
-                start = end
+        if log is not None:
+            # compare the throughput of different compute devices
+            log['inference'].update({
+                'batch_size': self.batch_size,
+                'batches': len(self.forward_times),
+                'forward_time': sum(self.forward_times),
+                'max_forward_time': max(self.forward_times)})
 
-            # the input and output patch is a 5d numpy array with
-            # datatype of float32, the dimensions are batch/channel/z/y/x.
-            # the input image should be normalized to [0,1]
-            output_patch = self.patch_inferencer(self.input_patch_buffer)
+        if self.verbose:
+            print("Inference of whole chunk takes %3f sec" %
+                  (time.time() - chunk_time_start))
 
-            if self.verbose > 1:
-                assert output_patch.ndim == 5
-                end = time.time()
-                print('run inference for %d patch takes %3f sec' %
-                      (self.batch_size, end - start))
-                start = end
+    def _run_patches(self, input_array: np.ndarray, output_array: np.ndarray,
+                     patch_index: np.ndarray, z_offset: int = 0):
+        if self.overlap_add:
+            # the weight channel is filled while finalizing
+            output_array = output_array[:-1]
 
-            for batch_idx, slices in enumerate(batch_slices):
-                # only use the required number of channels
-                # the remaining channels are dropped
-                # the slices[0] is for input patch slice
-                # the slices[1] is for output patch slice
-                offset = (0,) + tuple(s.start for s in slices[1])
-                output_chunk = Chunk(output_patch[batch_idx, :, :, :, :],
-                                     global_offset=offset)
-
-                ## save some patch for debug
-                #bbox = output_chunk.bbox
-                #if bbox.minpt[-1] < 94066 and bbox.maxpt[-1] > 94066 and \
-                #        bbox.minpt[-2]<81545 and bbox.maxpt[-2]>81545 and \
-                #        bbox.minpt[-3]<17298 and bbox.maxpt[-3]>17298:
-                #    print('save patch: ', output_chunk.bbox)
-                #    breakpoint()
-                #    output_chunk.to_tif()
-                #    #input_chunk.cutout(slices[0]).to_tif()
-
-                output_buffer.blend(output_chunk)
+        if self.double_buffer:
+            self._infer_patches_double_buffered(input_array, output_array, 
+                                                patch_index, z_offset)
+        else:
+            self._infer_patches(input_array, output_array, patch_index, z_offset)
 
-            if self.verbose > 1:
-                end = time.time()
-                print('blend patch takes %3f sec' % (end - start))
+    def _stream_slabs(self, input_array: np.ndarray, patch_index: np.ndarray,
+                      output_global_offset: tuple, slab_size: int):
+        """blend the patches row by row to a sliding window of output buffer.
 
-        if self.verbose:
-            print("Inference of whole chunk takes %3f sec" %
-                  (time.time() - chunk_time_start))
+        The window starts from the first unfinished voxel in z. The patches 
+        in a row start from the same z, so the output before a row is 
+        finished after blending the previous rows.
+        """
+        output_z = output_global_offset[1]
+        output_size_z = self.output_size[0]
+        # the window covers the unfinished part before a row and the row
+        depth = min(self.output_patch_size[0] + slab_size, output_size_z)
+        window = self._create_array((self.num_buffer_channels, 
+                                     depth, *self.output_size[1:]), self.dtype)
+        # the z start of window in output buffer
+        base = 0
+
+        def aligned(z):
+            """the last slab boundary not after z."""
+            return max((output_z + z) // slab_size * slab_size - output_z, 0)
+
+        def emit(stop):
+            nonlocal base
+            size = stop - base
+            slab = Chunk(np.array(window[:, :size, ...]), global_offset=(
+                0, output_z + base, *output_global_offset[2:]))
+            # slide the window
+            window[:, :depth-size, ...] = window[:, size:, ...]
+            window[:, depth-size:, ...] = 0
+            z_start = base
+            base = stop
+            return self._finalize_output(slab, z_start)
         
-        if self.mask_output_chunk:
-            output_buffer *= self.output_chunk_mask
+        row_starts = self.output_patch_regions[:, 0]
+        selected_row_starts = row_starts[patch_index]
+        for row_start in np.unique(row_starts).tolist():
+            stop = aligned(row_start)
+            if stop > base:
+                yield emit(stop)
+            
+            row_index = patch_index[selected_row_starts == row_start]
+            if len(row_index) > 0:
+                self._run_patches(input_array, window, row_index, z_offset=base)
+        
+        while base < output_size_z:
+            yield emit(min(aligned(base) + slab_size, output_size_z))
+
+    def _finalize_output(self, output_buffer: Chunk, z_start: int = 0):
+        """normalize and mask the output buffer.
+
+        args:
+            output_buffer (Chunk): the whole output buffer or a slab of it.
+            z_start (int): the z start of the slab in output buffer.
+        """
+        # traverse the output buffer in z slabs, so the temporal arrays 
+        # are small and the memory mapped files are read sequentially.
+        for slab in self._z_slabs(output_buffer.shape[1]):
+            if self.overlap_add:
+                output_buffer.array[-1, slab, ...] = self.output_chunk_mask.array[
+                    z_start + slab.start : z_start + slab.stop, ...]
+                # the output is not normalized
+                continue
+
+            if self.mask_output_chunk:
+                with tracer.span('normalize', category='inference'):
+                    output_buffer.array[:, slab, ...] *= self.output_chunk_mask.array[
+                        z_start + slab.start : z_start + slab.stop, ...]
         
-        # theoretically, all the value of output_buffer should not be greater than 1
-        # we use a slightly higher value here to accomondate numerical precision issue
-        np.testing.assert_array_less(output_buffer, 1.0001,
-            err_msg='output buffer should not be greater than 1')
+            # theoretically, all the value of output_buffer should not be greater than 1
+            # we use a slightly higher value here to accomondate numerical precision issue
+            np.testing.assert_array_less(output_buffer.array[:, slab, ...], 1.0001,
+                err_msg='output buffer should not be greater than 1')
 
         if self.mask_myelin_threshold:
             # currently only for masking out affinity map 
@@ -434,3 +970,41 @@ class Inferencer(object):
             return output_chunk
         else:
             return output_buffer
+
+
+def _any_nonzero(array: np.ndarray, starts: np.ndarray, stops: np.ndarray):
+    """whether there is any nonzero voxel in each box of a 3D array.
+
+    The array is reduced axis by axis over the unique ranges of the boxes 
+    in that axis, so the loops run over a few ranges instead of the boxes.
+
+    Parameters
+    ------------
+    array:
+        the 3D array.
+    starts:
+        the start of boxes with shape of (N, 3).
+    stops:
+        the stop of boxes with shape of (N, 3).
+
+    Returns
+    ---------
+        the boolean array with shape of (N, ).
+    """
+    reduced = np.asarray(array)
+    box_index = [None] * 3
+    for axis in (0, 1, 2):
+        # encode the ranges as integers, it is much faster than unique rows
+        base = int(stops[:, axis].max()) + 1
+        keys, box_index[axis] = np.unique(
+            starts[:, axis].astype(np.int64) * base + stops[:, axis], 
+            return_inverse=True)
+        shape = list(reduced.shape)
+        shape[axis] = len(keys)
+        result = np.empty(shape, dtype=bool)
+        for idx, key in enumerate(keys.tolist()):
+            start, stop = divmod(key, base)
+            region = reduced[(slice(None), ) * axis + (slice(start, stop), )]
+            result[(slice(None), ) * axis + (idx, )] = region.any(axis=axis)
+        reduced = result
+    return reduced[tuple(index.reshape(-1) for index in box_index)]
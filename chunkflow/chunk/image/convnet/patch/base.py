@@ -1,12 +1,29 @@
+import os
+
 import numpy as np
 from .patch_mask import PatchMask
 
 
+def available_cpu_count():
+    """the number of cores available to this process.
+
+    The CPU affinity is not supported in macOS and Windows, 
+    so all the cores of the computer are used there.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+
 class PatchInferencerBase(object):
     """PatchEngine
     
     the input patch is a 
     """
+    # the integer input patches are passed without normalization if True,
+    # and the backend should normalize them to 0-1 value range by itself.
+    accepts_raw_input = False
+
     def __init__(self, input_patch_size: tuple, output_patch_size: tuple, 
                  output_patch_overlap: tuple, num_output_channels: int,
                  dtype: str='float32'):
@@ -18,6 +35,7 @@ class PatchInferencerBase(object):
         self.output_patch_size = output_patch_size
         self.output_patch_overlap = output_patch_overlap
         self.num_output_channels = num_output_channels
+        self.dtype = dtype
         
         assert len(output_patch_overlap) == 3
         assert len(input_patch_size) == 3
@@ -0,0 +1,87 @@
+import platform
+
+import numpy as np
+import onnxruntime as ort
+
+from .base import PatchInferencerBase, available_cpu_count
+
+
+class ONNXRuntime(PatchInferencerBase):
+    """perform inference for an image patch using ONNX Runtime in CPU.
+
+    The model should be exported to an ONNX file with the weights, such as
+    using `torch.onnx.export`. The first input of the model takes a 5d patch
+    normalized to 0-1 value range, and the first output is the output patch.
+    The batch dimension should be dynamic to run a batch of patches
+    together. Otherwise, the batch is split to the static batch size.
+
+    Parameters
+    ----------
+    convnet_model: the ONNX file path.
+    convnet_weight_path: not used. The weights are saved in the ONNX file.
+    num_threads: the number of intra-op threads.
+        The default is the number of cores available to the process.
+    num_interop_threads: the number of inter-op threads.
+    """
+    def __init__(self, convnet_model: str, convnet_weight_path: str,
+                 input_patch_size: tuple,
+                 output_patch_size: tuple,
+                 output_patch_overlap: tuple,
+                 num_output_channels: int = 1,
+                 dtype: str = 'float32',
+                 bump: str = 'wu',
+                 num_threads: int = None,
+                 num_interop_threads: int = None):
+        assert bump == 'wu'
+        super().__init__(input_patch_size, output_patch_size,
+                         output_patch_overlap, num_output_channels,
+                         dtype=dtype)
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = num_threads or available_cpu_count()
+        if num_interop_threads is not None:
+            options.inter_op_num_threads = num_interop_threads
+        self.session = ort.InferenceSession(
+            convnet_model, sess_options=options,
+            providers=['CPUExecutionProvider'])
+
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        # the data type is formatted as tensor(float)
+        self.input_dtype = np.float16 if model_input.type == 'tensor(float16)' \
+            else np.float32
+        # the dynamic dimension is a string or None
+        batch_dim = model_input.shape[0]
+        self.static_batch_size = batch_dim if isinstance(batch_dim, int) else None
+
+    @property
+    def compute_device(self):
+        return platform.processor()
+
+    def _run(self, input_patch: np.ndarray):
+        return self.session.run(None, {self.input_name: input_patch})[0]
+
+    def __call__(self, input_patch):
+        # make sure that the patch is 5d ndarray
+        input_patch = self._reshape_patch_to_5d(input_patch)
+        input_patch = np.ascontiguousarray(input_patch, dtype=self.input_dtype)
+
+        batch_size = input_patch.shape[0]
+        if self.static_batch_size is None or \
+                self.static_batch_size == batch_size:
+            output_patch = self._run(input_patch)
+        else:
+            # pad the batch to multiples of the static batch size
+            step = self.static_batch_size
+            padded_size = -(-batch_size // step) * step
+            padded = np.zeros((padded_size, *input_patch.shape[1:]),
+                              dtype=input_patch.dtype)
+            padded[:batch_size] = input_patch
+            output_patch = np.concatenate([self._run(padded[i:i+step])
+                for i in range(0, padded_size, step)], axis=0)[:batch_size]
+
+        output_patch = self._crop_output_patch(output_patch)
+        output_patch = output_patch.astype(self.dtype, copy=False)
+        output_patch *= self.output_patch_mask
+        return output_patch
@@ -1,7 +1,11 @@
 # from .inference_engine import InferenceEngine
 # import imp
+import platform
+from warnings import warn
+
+import numpy as np
 import torch
-from .base import PatchInferencerBase
+from .base import PatchInferencerBase, available_cpu_count
 from chunkflow.lib import load_source
 
 torch.backends.cudnn.benchmark = True
@@ -23,14 +27,45 @@ class PyTorch(PatchInferencerBase):
     loading model. This is useful for loading some models trained using
     old version pytorch (<=0.4.0). You can also define `pre_process` 
     and `post_process` function to insert your own customized processing.
+
+    The default `pre_process` takes the integer input patch directly and
+    normalizes it in the device, which also reduces the data transfer to GPU.
+    If you define your own `pre_process`, the input patch is normalized to 
+    0-1 value range before it unless you also define `accepts_raw_input = True`
+    in your model file.
+
+    The model is always run in evaluation mode, so the batch normalization
+    and dropout layers do not depend on the other patches in a batch. 
+    If the batch size is larger than 1, a random batch is checked against 
+    the patches running one by one while loading the model, and a ValueError
+    is raised if the output differs. 
+
+    For CPU inference, the model could be traced or scripted with TorchScript
+    and frozen once while loading. The number of intra-op threads is set to 
+    the number of cores available to the process by default, which could 
+    be less than all the cores of the host in a container.
+
+    Parameters
+    ----------
+    batch_size: the number of patches in a batch.
+    jit: trace or script the model with TorchScript and freeze it.
+    num_threads: the number of intra-op threads. 
+    num_interop_threads: the number of inter-op threads.
     """
+    # the model is put in GPU if it is available
+    use_gpu = True
+
     def __init__(self, convnet_model: str, convnet_weight_path: str,
                  input_patch_size: tuple, 
                  output_patch_size: tuple, 
                  output_patch_overlap: tuple,
                  num_output_channels: int = 1, 
                  dtype: str='float32',
-                 bump: str='wu'):
+                 bump: str='wu',
+                 batch_size: int = 1,
+                 jit: str = None,
+                 num_threads: int = None,
+                 num_interop_threads: int = None):
         # To-Do: support zung function
         assert bump == 'wu'
         super().__init__(input_patch_size, output_patch_size, 
@@ -38,12 +73,13 @@ class PyTorch(PatchInferencerBase):
                          dtype=dtype)
 
         self.num_output_channels = num_output_channels
-        if torch.cuda.is_available():
+        if self.use_gpu and torch.cuda.is_available():
             self.is_gpu = True
             # put mask to gpu
             self.output_patch_mask = torch.from_numpy(self.output_patch_mask).cuda()
         else:
             self.is_gpu = False
+            self._set_num_threads(num_threads, num_interop_threads)
 
         net_source = load_source(convnet_model)
 
@@ -70,26 +106,101 @@ class PyTorch(PatchInferencerBase):
         #print("Model's state_dict:")
         #for param_tensor in self.model.state_dict():
         #    print(param_tensor, "\t", self.model.state_dict()[param_tensor].size())
-
+        
+        # the batch normalization and dropout layers should 
+        # not use the batch statistics
+        self.model.eval()
 
         if hasattr(net_source, "pre_process"):
             self.pre_process = net_source.pre_process
+            self.accepts_raw_input = getattr(net_source, 'accepts_raw_input', False)
         else:
             self.pre_process = self._pre_process
+            self.accepts_raw_input = True
 
         if hasattr(net_source, "post_process"):
             self.post_process = net_source.post_process
         else:
             self.post_process = self._identity
+
+        if jit is not None:
+            self._compile(jit, batch_size)
+
+        if batch_size > 1:
+            self._check_batch_determinism(batch_size)
     
     @property
     def compute_device(self):
-        return torch.cuda.get_device_name(0)
+        if self.is_gpu:
+            return torch.cuda.get_device_name(0)
+        else:
+            return platform.processor()
+
+    def _set_num_threads(self, num_threads: int, num_interop_threads: int):
+        if num_threads is None:
+            num_threads = available_cpu_count()
+        torch.set_num_threads(num_threads)
+
+        if num_interop_threads is not None:
+            try:
+                torch.set_num_interop_threads(num_interop_threads)
+            except RuntimeError:
+                # it could only be set once before any parallel work started
+                warn('the number of inter-op threads was already set to ' + 
+                     f'{torch.get_num_interop_threads()}.')
+
+    def _random_input(self, batch_size: int):
+        shape = (batch_size, 1, *self.input_patch_size)
+        input_patch = np.random.rand(*shape).astype(self.dtype)
+        if self.accepts_raw_input:
+            # the default pre process takes integer input
+            input_patch = (input_patch * 255).astype(np.uint8)
+        return input_patch
+
+    def _compile(self, jit: str, batch_size: int):
+        """convert the model to TorchScript and freeze it."""
+        if jit == 'trace':
+            with torch.no_grad():
+                example = self.pre_process(self._random_input(batch_size))
+                # the output could be a dict or a tuple
+                self.model = torch.jit.trace(self.model, example, strict=False)
+        elif jit == 'script':
+            self.model = torch.jit.script(self.model)
+        else:
+            raise ValueError(f'invalid jit mode: {jit}')
+
+        # inline the weights as constants and fold the operations
+        self.model = torch.jit.freeze(self.model)
+
+    def _check_batch_determinism(self, batch_size: int):
+        """the output of a batch should be the same with running the 
+        patches one by one."""
+        input_patches = self._random_input(batch_size)
+        output_patches = self(input_patches)
+        for idx in range(batch_size):
+            output_patch = self(input_patches[idx:idx+1, ...])
+            if not np.allclose(output_patches[idx:idx+1, ...], output_patch, 
+                               rtol=1e-3, atol=1e-3):
+                raise ValueError(
+                    f'the output of batch size {batch_size} is different with ' + 
+                    'batch size 1. The model should not depend on the other ' +
+                    'patches in a batch.')
 
     def _pre_process(self, input_patch):
+        dtype_max = None
+        if np.issubdtype(input_patch.dtype, np.integer):
+            dtype_max = np.iinfo(input_patch.dtype).max
+            if input_patch.dtype not in (np.uint8, np.int16, np.int32, np.int64):
+                # torch do not support other integer types, such as uint16
+                input_patch = input_patch.astype(np.int32)
+        
         input_patch = torch.from_numpy(input_patch)
         if self.is_gpu:
             input_patch = input_patch.cuda()
+
+        if dtype_max is not None:
+            # normalize to 0-1 value range
+            input_patch = input_patch.to(getattr(torch, np.dtype(self.dtype).name)) / dtype_max
         return input_patch
     
     def _identity(self, patch):
@@ -99,7 +210,7 @@ class PyTorch(PatchInferencerBase):
         # make sure that the patch is 5d ndarray
         input_patch = self._reshape_patch_to_5d(input_patch)
 
-        with torch.no_grad():
+        with _inference_mode():
             net_input = self.pre_process(input_patch)
             # the network input and output should be dict
             net_output = self.model(net_input)
@@ -117,3 +228,11 @@ class PyTorch(PatchInferencerBase):
                 output_patch = output_patch.data.cpu()
             output_patch = output_patch.numpy()
             return output_patch
+
+
+def _inference_mode():
+    # the inference mode was introduced in pytorch 1.9
+    if hasattr(torch, 'inference_mode'):
+        return torch.inference_mode()
+    else:
+        return torch.no_grad()
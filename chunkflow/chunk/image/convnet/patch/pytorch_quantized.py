@@ -0,0 +1,136 @@
+from warnings import warn
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from chunkflow.chunk import Chunk
+from .pytorch import PyTorch
+
+
+class PyTorchQuantized(PyTorch):
+    """perform inference for an image patch using int8 quantized pytorch model in CPU.
+
+    The model is loaded in the same way with the pytorch backend, and then
+    quantized with one of the following modes:
+
+    static: the weights and activations are quantized to int8. The model is 
+        traced with torch.fx, and the value range of activations is observed 
+        in the calibration batches sampled from a calibration chunk while 
+        loading the model, so all the workers and reruns use the same scales. 
+        The model should be symbolically traceable.
+    dynamic: only the weights of linear and recurrent layers are quantized, 
+        and the activations are quantized on the fly. The convolutional layers
+        are kept in float32. The output depends on the other patches in a batch.
+
+    The quantized output should be compared with the float32 output of the 
+    pytorch backend on a reference chunk, such as using the 
+    `evaluate-affinity-map` operator, before a production run.
+
+    Parameters
+    ----------
+    quantization: static or dynamic.
+    calibration_batches: the number of batches to calibrate the static quantization.
+    calibration_file: the HDF5 or TIFF file of a 3D image chunk representative of 
+        the dataset. The patches are sampled from it with a fixed random seed.
+        If it is not provided, the random input is used, and the scales of 
+        activations might not fit the real input.
+    """
+    # the quantized operators only run in CPU
+    use_gpu = False
+
+    def __init__(self, convnet_model: str, convnet_weight_path: str,
+                 input_patch_size: tuple,
+                 output_patch_size: tuple,
+                 output_patch_overlap: tuple,
+                 num_output_channels: int = 1,
+                 dtype: str = 'float32',
+                 bump: str = 'wu',
+                 batch_size: int = 1,
+                 jit: str = None,
+                 num_threads: int = None,
+                 num_interop_threads: int = None,
+                 quantization: str = 'static',
+                 calibration_batches: int = 8,
+                 calibration_file: str = None):
+        assert dtype == 'float32'
+        # the model is compiled and checked after quantization
+        super().__init__(convnet_model, convnet_weight_path, input_patch_size,
+                         output_patch_size, output_patch_overlap,
+                         num_output_channels=num_output_channels,
+                         dtype=dtype, bump=bump,
+                         num_threads=num_threads,
+                         num_interop_threads=num_interop_threads)
+        self.quantization = quantization
+        self.batch_size = batch_size
+
+        if quantization == 'static':
+            assert calibration_batches > 0
+            self._calibrate(calibration_file, calibration_batches)
+        elif quantization == 'dynamic':
+            self.model = quantize_dynamic(self.model, dtype=torch.qint8)
+        else:
+            raise ValueError(f'invalid quantization mode: {quantization}')
+
+        if jit is not None:
+            self._compile(jit, batch_size)
+        if batch_size > 1 and quantization == 'static':
+            # the dynamic quantization depends on the batch 
+            self._check_batch_determinism(batch_size)
+
+    @property
+    def compute_device(self):
+        return super().compute_device + '-int8'
+
+    def _calibrate(self, calibration_file: str, calibration_batches: int):
+        """observe the value range of activations and convert the model to int8."""
+        example = self.pre_process(self._random_input(self.batch_size))
+        self.model = prepare_fx(self.model,
+                                get_default_qconfig_mapping(),
+                                (example, ))
+
+        # the fixed seed makes the scales reproducible
+        random_state = np.random.RandomState(0)
+        patch_num = calibration_batches * self.batch_size
+        if calibration_file is None:
+            warn('calibrating the static quantization with random input.')
+            input_patches = random_state.rand(
+                patch_num, 1, *self.input_patch_size).astype(self.dtype)
+            if self.accepts_raw_input:
+                input_patches = (input_patches * 255).astype(np.uint8)
+        else:
+            input_patches = self._sample_patches(
+                calibration_file, patch_num, random_state)
+
+        for i in range(0, patch_num, self.batch_size):
+            self(input_patches[i:i + self.batch_size])
+
+        with torch.no_grad():
+            self.model = convert_fx(self.model)
+
+    def _sample_patches(self, calibration_file: str, patch_num: int, 
+                        random_state: np.random.RandomState):
+        if calibration_file.endswith('.h5'):
+            chunk = Chunk.from_h5(calibration_file)
+        elif calibration_file.endswith(('.tif', '.tiff')):
+            chunk = Chunk.from_tif(calibration_file)
+        else:
+            raise ValueError(f'invalid calibration file: {calibration_file}')
+        assert chunk.ndim == 3
+
+        # the window view do not copy the data
+        windows = sliding_window_view(chunk.array, self.input_patch_size)
+        offsets = [random_state.randint(0, s, size=patch_num) 
+                   for s in windows.shape[:3]]
+        input_patches = windows[tuple(offsets)][:, np.newaxis, ...]
+        
+        if np.issubdtype(input_patches.dtype, np.integer) and \
+                not self.accepts_raw_input:
+            # normalize the patches in the same way with the inferencer
+            return (input_patches / np.iinfo(input_patches.dtype).max).astype(
+                self.dtype)
+        elif np.issubdtype(input_patches.dtype, np.floating):
+            return input_patches.astype(self.dtype)
+        return input_patches
@@ -0,0 +1,67 @@
+from threading import Lock
+
+import numpy as np
+
+from .base import PatchInferencerBase
+
+
+class Remote(PatchInferencerBase):
+    """
+        Remote(PatchInferencerBase)
+
+    send the patches to a inference server in the same node.
+    The server owns the ConvNet model, and runs the patches of multiple
+    pipelines in dynamic batches.
+
+    The integer input patches are sent without normalization to reduce the
+    transfered bytes, and the server normalizes them.
+    """
+    accepts_raw_input = True
+
+    def __init__(self, convnet_model: str, convnet_weight_path: str,
+                 input_patch_size: tuple, output_patch_overlap: tuple,
+                 output_patch_size: tuple = None,
+                 num_output_channels: int = 1,
+                 dtype: str = 'float32',
+                 bump: str = 'wu'):
+        # the server is imported here to avoid circular import
+        from ..server import connect
+
+        super().__init__(input_patch_size, output_patch_size,
+                         output_patch_overlap, num_output_channels,
+                         dtype=dtype)
+        # the convnet model is the socket path of server
+        self.address = convnet_model
+        self.connection = connect(self.address)
+        self.lock = Lock()
+        self.request_id = 0
+
+        # make sure that the server use the same patch geometry
+        self.connection.send(('hello', {
+            'input_patch_size': self.input_patch_size,
+            'output_patch_size': self.output_patch_size,
+            'output_patch_overlap': self.output_patch_overlap,
+            'num_output_channels': self.num_output_channels,
+            'dtype': self.dtype
+        }))
+        status, result = self.connection.recv()
+        if status != 'ok':
+            self.connection.close()
+            raise ValueError(result)
+        self._compute_device = result['compute_device']
+
+    @property
+    def compute_device(self):
+        return self._compute_device
+
+    def __call__(self, input_patch):
+        input_patch = self._reshape_patch_to_5d(input_patch)
+        with self.lock:
+            self.request_id += 1
+            self.connection.send(('infer', self.request_id,
+                                  np.ascontiguousarray(input_patch)))
+            status, request_id, result = self.connection.recv()
+            assert request_id == self.request_id
+        if status != 'ok':
+            raise RuntimeError(f'inference server failed: {result}')
+        return result
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+__doc__ = """
+Patch inference server shared by multiple pipelines in a node.
+
+The server owns the ConvNet model, and receives the input patches from
+the chunkflow pipelines through a Unix socket. The patches from different
+pipelines are grouped into dynamic batches, so the model batch stays full
+even if some pipelines are waiting for I/O. The weights are only loaded
+once in a node.
+
+The pipelines connect to the server using the `remote` inference backend.
+"""
+import os
+import stat
+import socket
+from time import time
+from threading import Thread, Lock
+from multiprocessing.connection import Connection
+
+import numpy as np
+from gevent.monkey import get_original
+
+from chunkflow.lib.tracer import tracer
+from .inferencer import create_patch_inferencer
+
+# the socket and queue modules were monkey patched by gevent in
+# chunkflow/__init__.py, and the patched ones do not work across real threads.
+Queue = get_original('queue', 'Queue')
+Empty = get_original('queue', 'Empty')
+_socket = get_original('socket', 'socket')
+
+
+def connect(address: str):
+    """connect to the inference server with the Unix socket path."""
+    sock = _socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(address)
+    return Connection(sock.detach())
+
+
+class _Request(object):
+    def __init__(self, connection: Connection, request_id: int,
+                 patches: np.ndarray):
+        self.connection = connection
+        self.request_id = request_id
+        self.patches = patches
+
+
+class InferenceServer(object):
+    """serve the patch inference requests with dynamic batching.
+
+    Parameters
+    ------------
+    address:
+        the Unix socket path.
+    framework:
+        the inference backend, such as pytorch.
+    convnet_model:
+        convnet model path.
+    convnet_weight_path:
+        convnet weight path.
+    batch_size:
+        the maximum number of patches in a batch.
+    max_latency:
+        the maximum time in seconds to wait for more patches to fill a batch.
+    verbose:
+        print the batching status or not.
+    framework_options:
+        the backend specific options, such as the number of threads.
+    kwargs:
+        the patch geometry passed to the backend, such as input_patch_size.
+        The pipelines should use the same geometry.
+    """
+    def __init__(self, address: str, framework: str, convnet_model: str,
+                 convnet_weight_path: str, batch_size: int = 8,
+                 max_latency: float = 0.01, verbose: int = 1, 
+                 framework_options: dict = None, **kwargs):
+        assert batch_size > 0
+        assert max_latency >= 0
+        self.address = os.path.expanduser(address)
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.verbose = verbose
+
+        self.patch_inferencer = create_patch_inferencer(
+            framework, convnet_model, convnet_weight_path, 
+            **kwargs, **(framework_options or {}))
+        self.geometry = {key: _to_list(value) for key, value in kwargs.items()
+                         if key != 'bump'}
+
+        self.requests = Queue()
+        self.lock = Lock()
+        self.stats = {'batches': 0, 'patches': 0, 'requests': 0}
+        self.listener = None
+        self.closed = False
+
+    def serve_forever(self):
+        """accept the connections until the server is closed."""
+        if os.path.exists(self.address):
+            self._remove_stale_socket()
+        listener = _socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.address)
+        listener.listen()
+        # the socket file is only removed by the server binding it
+        self.listener = listener
+
+        batcher = Thread(target=self._batch_forever, name='batcher', daemon=True)
+        batcher.start()
+        if self.verbose:
+            print(f'inference server is listening on {self.address}')
+
+        try:
+            while not self.closed:
+                try:
+                    sock, _ = self.listener.accept()
+                except OSError:
+                    # the listener was closed
+                    break
+                # the accepted socket was created by the gevent patched 
+                # socket class, which set the file descriptor to non-blocking.
+                fd = sock.detach()
+                os.set_blocking(fd, True)
+                connection = Connection(fd)
+                Thread(target=self._receive, args=(connection,),
+                       name='receiver', daemon=True).start()
+        finally:
+            self.close()
+
+    def _remove_stale_socket(self):
+        """remove the socket file left by a previous server.
+
+        Raise an error if another server is still listening on it.
+        """
+        if not stat.S_ISSOCK(os.stat(self.address).st_mode):
+            raise FileExistsError(f'{self.address} is not a socket file.')
+        probe = _socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.address)
+        except ConnectionRefusedError:
+            # nobody is listening
+            os.remove(self.address)
+            return
+        finally:
+            probe.close()
+        raise RuntimeError(
+            f'another inference server is listening on {self.address}.')
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        if self.listener is not None:
+            try:
+                self.listener.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.listener.close()
+        # stop the batcher
+        self.requests.put(None)
+        if self.listener is not None and os.path.exists(self.address):
+            os.remove(self.address)
+
+    def _receive(self, connection: Connection):
+        """receive the requests of a pipeline."""
+        try:
+            while True:
+                message = connection.recv()
+                if message[0] == 'hello':
+                    connection.send(self._hello(message[1]))
+                elif message[0] == 'infer':
+                    _, request_id, patches = message
+                    self.requests.put(_Request(connection, request_id, patches))
+                else:
+                    raise ValueError(f'unknown message: {message[0]}')
+        except (EOFError, OSError):
+            # the pipeline was finished
+            pass
+
+    def _hello(self, geometry: dict):
+        """check the patch geometry of a pipeline."""
+        geometry = {key: _to_list(value) for key, value in geometry.items()}
+        if geometry != self.geometry:
+            return ('error', f'the patch geometry {geometry} do not match ' +
+                    f'the server: {self.geometry}')
+        return ('ok', {'compute_device': self.patch_inferencer.compute_device})
+
+    def _batch_forever(self):
+        # the request which could not fit in the previous batch
+        pending = None
+        while True:
+            if pending is None:
+                pending = self.requests.get()
+            if pending is None:
+                # the server was closed
+                return
+
+            batch = [pending]
+            patch_num = len(pending.patches)
+            pending = None
+            with tracer.span('batch', category='inference-server'):
+                deadline = time() + self.max_latency
+                while patch_num < self.batch_size:
+                    try:
+                        request = self.requests.get(
+                            timeout=max(deadline - time(), 0))
+                    except Empty:
+                        break
+                    if request is None or \
+                            patch_num + len(request.patches) > self.batch_size:
+                        pending = request
+                        break
+                    batch.append(request)
+                    patch_num += len(request.patches)
+
+            self._infer(batch)
+            if pending is None and self.closed:
+                return
+
+    def _infer(self, batch: list):
+        """run a batch and send the outputs back to the pipelines."""
+        try:
+            input_patches = self._assemble(batch)
+            with tracer.span('forward', category='inference-server',
+                             patches=len(input_patches)):
+                output_patches = self.patch_inferencer(input_patches)
+        except Exception as exception:
+            for request in batch:
+                self._reply(request, ('error', request.request_id, repr(exception)))
+            return
+
+        start = 0
+        for request in batch:
+            stop = start + len(request.patches)
+            self._reply(request, ('ok', request.request_id,
+                                  output_patches[start:stop]))
+            start = stop
+
+        self.stats['batches'] += 1
+        self.stats['patches'] += len(input_patches)
+        self.stats['requests'] += len(batch)
+        if self.verbose > 1:
+            print(f'inference of {len(batch)} requests with ' +
+                  f'{len(input_patches)} patches.')
+
+    def _assemble(self, batch: list):
+        """concatenate the input patches of requests."""
+        patches = [request.patches for request in batch]
+        dtypes = set(p.dtype for p in patches)
+
+        is_integer = any(np.issubdtype(dtype, np.integer) for dtype in dtypes)
+        if is_integer and (len(dtypes) > 1 or
+                           not self.patch_inferencer.accepts_raw_input):
+            # normalize to 0-1 value range
+            patches = [p.astype(self.patch_inferencer.dtype) / np.iinfo(p.dtype).max
+                       if np.issubdtype(p.dtype, np.integer) else p
+                       for p in patches]
+
+        if len(patches) == 1:
+            return patches[0]
+        return np.concatenate(patches, axis=0)
+
+    def _reply(self, request: _Request, message: tuple):
+        try:
+            request.connection.send(message)
+        except OSError:
+            # the pipeline was gone
+            pass
+
+
+def _to_list(value):
+    if isinstance(value, (tuple, list)):
+        return [_to_list(v) for v in value]
+    elif isinstance(value, np.integer):
+        return int(value)
+    else:
+        return value
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+__doc__ = """
+Downsample pyramid of a chunk shared by operators.
+
+The mip levels are computed in a single pass, and each level is downsampled
+from the previous one. The levels are cached with the chunk, so the
+operators using the same chunk, such as `save` with thumbnail and
+`downsample-upload`, only downsample it once. The higher levels are
+computed only if some operator needs them.
+"""
+from threading import Lock, Thread
+
+import numpy as np
+import tinybrain
+
+from cloudvolume.lib import Vec
+
+from chunkflow.lib.metadata_cache import ThreadLocalVolume
+from .base import Chunk
+
+# the creation of cached pyramids of chunks
+_pyramids_lock = Lock()
+
+
+class Pyramid(object):
+    """the downsampled levels of a 3D chunk.
+
+    For image, the levels are downsampled by average pooling. For
+    segmentation, the most frequent object ID is chosen using the countless
+    algorithm. The type of chunk is determined by the data type.
+    Image: uint8, floating
+    Segmentation: uint16, uint32, uint64,...
+
+    Parameters
+    ------------
+    chunk:
+        the 3D chunk of level 0.
+    factor:
+        the downsampling factor in z,y,x of each level.
+    """
+    def __init__(self, chunk: Chunk, factor: tuple = (1, 2, 2)):
+        assert chunk.ndim == 3
+        self.factor = Vec(*factor)
+        self.levels = [chunk]
+        self.lock = Lock()
+
+    @classmethod
+    def from_chunk(cls, chunk: Chunk, factor: tuple = (1, 2, 2)):
+        """get the pyramid cached with the chunk or create a new one."""
+        with _pyramids_lock:
+            pyramid = getattr(chunk, 'pyramid', None)
+            if pyramid is None or np.any(pyramid.factor != Vec(*factor)):
+                pyramid = cls(chunk, factor=factor)
+                # the pyramid is released together with the chunk
+                chunk.pyramid = pyramid
+        return pyramid
+
+    def __getitem__(self, level: int):
+        """the chunk of a level. The missing levels are computed."""
+        with self.lock:
+            while len(self.levels) <= level:
+                self.levels.append(self._downsample(self.levels[-1]))
+        return self.levels[level]
+
+    def _downsample(self, chunk: Chunk):
+        # tinybrain use F order and require 4D array!
+        arr = np.transpose(chunk.array)[..., np.newaxis]
+        factor = tuple(self.factor[::-1])
+        if chunk.is_segmentation:
+            arr = tinybrain.downsample_segmentation(arr, factor=factor)[0]
+        else:
+            arr = tinybrain.downsample_with_averaging(arr, factor=factor)[0]
+        arr = np.transpose(arr[..., 0])
+        global_offset = tuple(Vec(*chunk.global_offset) // self.factor)
+        return Chunk(arr, global_offset=global_offset)
+
+    def upload(self, volumes: dict):
+        """upload the levels to the volumes concurrently.
+
+        Parameters
+        ------------
+        volumes:
+            the volume of each level, such as the volumes of mip levels.
+            The volumes should be opened with autocrop. The handles of a 
+            ThreadLocalVolume are opened in the uploading threads.
+        """
+        # compute all the levels first
+        self[max(volumes.keys())]
+
+        # the queue module was monkey patched by gevent, so the thread pool 
+        # executor do not work across real threads
+        errors = []
+        def upload_level(level):
+            try:
+                chunk = self[level]
+                volume = volumes[level]
+                if isinstance(volume, ThreadLocalVolume):
+                    volume = volume.get()
+                # note that we should use F order in the indexing
+                volume[chunk.slices[::-1]] = np.transpose(chunk.array)
+            except BaseException as exception:
+                errors.append(exception)
+
+        threads = [Thread(target=upload_level, args=(level,), daemon=True)
+                   for level in volumes.keys()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
@@ -1,11 +1,13 @@
 import numpy as np
-from cloudvolume import CloudVolume
 from cloudvolume.lib import Bbox
 from cloudvolume.storage import Storage
 
 from chunkflow.chunk.validate import validate_by_template_matching
 from tinybrain import downsample_with_averaging
 from chunkflow.chunk import Chunk
+from chunkflow.lib.block_cache import BlockCache
+from chunkflow.lib.metadata_cache import ThreadLocalVolume
+from chunkflow.lib.tracer import tracer
 from .base import OperatorBase
 
 
@@ -17,6 +19,8 @@ class CutoutOperator(OperatorBase):
                  fill_missing: bool = False,
                  validate_mip: int = None,
                  blackout_sections: bool = None,
+                 cache_dir: str = None,
+                 cache_size: float = None,
                  dry_run: bool = False,
                  name: str = 'cutout',
                  verbose: bool = True):
@@ -29,21 +33,47 @@ class CutoutOperator(OperatorBase):
         self.blackout_sections = blackout_sections
         self.dry_run = dry_run
 
+        if cache_dir:
+            # the cache size is in GB
+            self.block_cache = BlockCache(
+                cache_dir, 
+                max_size=None if cache_size is None else int(cache_size * 1e9),
+                verbose=verbose)
+        else:
+            self.block_cache = None
+
+        # the volume handles of each thread are reused across tasks 
+        self._vol = ThreadLocalVolume(self.volume_path,
+                                      bounded=False,
+                                      fill_missing=self.fill_missing,
+                                      progress=self.verbose,
+                                      mip=self.mip,
+                                      cache=False,
+                                      green_threads=True)
+        if validate_mip:
+            self._validate_vol = ThreadLocalVolume(self.volume_path,
+                                                   bounded=False,
+                                                   fill_missing=self.fill_missing,
+                                                   progress=self.verbose,
+                                                   mip=self.validate_mip,
+                                                   cache=False,
+                                                   green_threads=True)
+
         if blackout_sections:
             with Storage(volume_path) as stor:
                 self.blackout_section_ids = stor.get_json(
                     'blackout_section_ids.json')['section_ids']
 
-    def __call__(self, output_bbox):
-        #gevent.monkey.patch_all(thread=False)
-        vol = CloudVolume(self.volume_path,
-                          bounded=False,
-                          fill_missing=self.fill_missing,
-                          progress=self.verbose,
-                          mip=self.mip,
-                          cache=False,
-                          green_threads=True)
-       
+    @property
+    def vol(self):
+        return self._vol.get()
+
+    @property
+    def validate_vol(self):
+        return self._validate_vol.get()
+
+    def __call__(self, output_bbox, log=None):
+        vol = self.vol
         chunk_slices = tuple(
             slice(s.start - m, s.stop + m)
             for s, m in zip(output_bbox.to_slices(), self.expand_margin_size))
@@ -57,7 +87,12 @@ class CutoutOperator(OperatorBase):
                                              self.volume_path))
 
         # always reverse the indexes since cloudvolume use x,y,z indexing
-        chunk = vol[chunk_slices[::-1]]
+        # the decoding of blocks happens inside CloudVolume while downloading
+        with tracer.span('download', category=self.name):
+            if self.block_cache is None:
+                chunk = vol[chunk_slices[::-1]]
+            else:
+                chunk = self._cutout_with_cache(vol, chunk_slices, log)
         # the cutout is fortran ordered, so need to transpose and make it C order
         chunk = chunk.transpose()
         # we can delay this transpose later
@@ -77,13 +112,29 @@ class CutoutOperator(OperatorBase):
         chunk = Chunk(chunk, global_offset=global_offset)
 
         if self.blackout_sections:
-            chunk = self._blackout_sections(chunk)
+            with tracer.span('blackout-sections', category=self.name):
+                chunk = self._blackout_sections(chunk)
 
         if self.validate_mip:
-            self._validate_chunk(chunk, vol)
+            with tracer.span('validate', category=self.name):
+                self._validate_chunk(chunk, vol)
         
         return chunk
 
+    def _cutout_with_cache(self, vol, chunk_slices, log):
+        """read the cached storage blocks and only download the missing ones."""
+        stats = {}
+        chunk = self.block_cache.cutout(
+            self.volume_path, self.mip, 
+            Bbox.from_slices(chunk_slices[::-1]),
+            vol.chunk_size, vol.voxel_offset, vol.bounds,
+            lambda bbox: vol[bbox.to_slices()],
+            vol.dtype, num_channels=vol.num_channels, stats=stats,
+            fill_missing=self.fill_missing)
+        if log is not None:
+            log.setdefault('block_cache', {})[self.name] = stats
+        return chunk
+
     def _blackout_sections(self, chunk):
         """
         make some sections black.
@@ -109,14 +160,7 @@ class CutoutOperator(OperatorBase):
         if chunk.ndim == 4 and chunk.shape[0] > 1:
             chunk = chunk[0, :, :, :]
         
-        validate_vol = CloudVolume(self.volume_path,
-                                   bounded=False,
-                                   fill_missing=self.fill_missing,
-                                   progress=self.verbose,
-                                   mip=self.validate_mip,
-                                   cache=False,
-                                   green_threads=True)
-
+        validate_vol = self.validate_vol
 
         chunk_mip = self.mip
         if self.verbose:
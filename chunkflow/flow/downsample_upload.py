@@ -1,14 +1,15 @@
 from chunkflow.chunk import Chunk
+from chunkflow.chunk.pyramid import Pyramid
+from chunkflow.lib.metadata_cache import ThreadLocalVolume
+from chunkflow.lib.write_behind import uploader
 from .base import OperatorBase
-from cloudvolume import CloudVolume
-import tinybrain
-import numpy as np
-from cloudvolume.lib import Bbox
 
 class DownsampleUploadOperator(OperatorBase):
     """
     Multiple mip level downsampling including image and segmenation.
 
+    The mip levels are computed by the pyramid shared with the other
+    operators using the same chunk, such as save with thumbnail.
     For image, the algorithm will be automatically choosen as average pooling.
     For segmentation, the algorithm will be Will Silversman's countless algorithm to perform model pooling. The most frequent segmentation ID will be choosen.
 
@@ -22,6 +23,8 @@ class DownsampleUploadOperator(OperatorBase):
                  start_mip: int = None,
                  stop_mip: int = 5,
                  fill_missing: bool = True,
+                 write_behind: bool = False,
+                 slab_size: int = None,
                  name='downsample-upload',
                  verbose: bool = False):
         """
@@ -30,52 +33,91 @@ class DownsampleUploadOperator(OperatorBase):
         start_mip: (int) the mip level for starting uploading
         stop_mip: (int) the mip level for stoping uploading. Note that the indexing follows python indexing, this stop mip will not be included. For example, if you would like to upload mip level 1 to 4, the start mip will be 1, and the stop mip should be 5.
         fill_missing: (bool) fill missing blocks with zeros or not. See same parameter in cloudvolume.
+        write_behind: (bool) upload in background threads and return the futures.
+        slab_size: (int) downsample the chunk in z slabs aligned with this size, and upload a slab while downsampling the next one. Only the pyramids of a few slabs are kept in memory. It should be a multiple of the block size of volume in z of all the mip levels.
         """
         super().__init__(name=name, verbose=verbose)
         
         if start_mip is None:
             start_mip = chunk_mip + 1
 
+        # every worker and uploading thread opens its own volume handles
         vols = dict()
         for mip in range(start_mip, stop_mip):
-            vols[mip] = CloudVolume(volume_path,
-                                    fill_missing=fill_missing,
-                                    bounded=False,
-                                    autocrop=True,
-                                    mip=mip,
-                                    green_threads=True,
-                                    progress=verbose)
+            vols[mip] = ThreadLocalVolume(volume_path,
+                                          fill_missing=fill_missing,
+                                          bounded=False,
+                                          autocrop=True,
+                                          mip=mip,
+                                          green_threads=True,
+                                          progress=verbose)
+
+        if slab_size is not None:
+            # z is not downsampled, so the slabs of all the mip levels are 
+            # aligned with the blocks if the slab size is a multiple of them
+            for mip, vol in vols.items():
+                block_size_z = vol.get().chunk_size[2]
+                assert slab_size % block_size_z == 0, \
+                    f'the slab size {slab_size} should be a multiple of ' + \
+                    f'the block size {block_size_z} in z of mip {mip}.'
 
         self.vols = vols
         self.chunk_mip = chunk_mip
         self.start_mip = start_mip
         self.stop_mip = stop_mip
+        self.write_behind = write_behind
+        self.slab_size = slab_size
 
     def __call__(self, chunk):
         assert 3 == chunk.ndim 
-        global_offset = chunk.global_offset
 
-        num_mips = self.stop_mip - self.chunk_mip
+        # the pyramid is shared with other operators using the same chunk, 
+        # such as save with thumbnail
+        pyramid = Pyramid.from_chunk(chunk)
+        volumes = {mip - self.chunk_mip: self.vols[mip] 
+                   for mip in range(self.start_mip, self.stop_mip)}
 
-        # tinybrain use F order and require 4D array!
-        chunk2 = np.transpose(chunk)
-        chunk2 = np.reshape(chunk2, (*chunk2.shape, 1))
+        if self.slab_size is not None:
+            return self._upload_slabs(chunk, volumes)
 
-        if np.issubdtype(chunk.dtype, np.floating) or chunk.dtype == np.uint8:
-            pyramid = tinybrain.downsample_with_averaging(chunk2,
-                                                          factor=(2, 2, 1),
-                                                          num_mips=num_mips)
+        if self.write_behind:
+            # compute all the levels before uploading in background
+            pyramid[max(volumes.keys())]
+            return [uploader.submit(pyramid.upload, {level: volume})
+                    for level, volume in volumes.items()]
         else:
-            pyramid = tinybrain.downsample_segmentation(chunk2,
-                                                        factor=(2, 2, 1),
-                                                        num_mips=num_mips)
+            pyramid.upload(volumes)
+            return []
+
+    def _upload_slabs(self, chunk, volumes):
+        """downsample and upload the chunk in z slabs.
 
-        for mip in range(self.start_mip, self.stop_mip):
-            # the first chunk in pyramid is already downsampled!
-            downsampled_chunk = pyramid[mip - self.chunk_mip - 1]
-            # compute new offset, only downsample the y,x dimensions
-            offset = np.divide(global_offset, np.asarray(
-                        [1, 2**(mip - self.chunk_mip), 2**(mip - self.chunk_mip)]))
-            bbox = Bbox.from_delta(offset, downsampled_chunk.shape[0:3][::-1])
-            # upload downsampled chunk, note that we should use F order in the indexing
-            self.vols[mip][bbox.to_slices()[::-1]] = downsampled_chunk
+        Only x and y are downsampled, so the slabs are independent. 
+        The pyramid of a slab is uploaded in background while the next 
+        slab is downsampling.
+        """
+        z_offset = self.vols[self.start_mip].get().voxel_offset[2]
+        z_start = chunk.global_offset[0]
+        z_stop = z_start + chunk.shape[0]
+        future = None
+        while z_start < z_stop:
+            # the next slab boundary
+            z_end = min((z_start - z_offset) // self.slab_size * self.slab_size 
+                        + z_offset + self.slab_size, z_stop)
+            slab = Chunk(chunk.array[z_start - chunk.global_offset[0] : 
+                                     z_end - chunk.global_offset[0], ...],
+                         global_offset=(z_start, *chunk.global_offset[1:]))
+            # the slab pyramid is not shared, so it is released after uploading
+            pyramid = Pyramid(slab)
+            pyramid[max(volumes.keys())]
+            if future is not None:
+                # only one slab is waiting for uploading
+                future.result()
+            future = uploader.submit(pyramid.upload, volumes)
+            z_start = z_end
+
+        if self.write_behind:
+            return [future]
+        else:
+            future.result()
+            return []
@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 import os
 import sys
+import json
 from functools import update_wrapper, wraps
+from threading import Lock
 from time import time
 
 import numpy as np
@@ -13,6 +15,9 @@ from cloudvolume import CloudVolume
 from cloudvolume.storage import SimpleStorage
 
 from chunkflow.lib.aws.sqs_queue import SQSQueue
+from chunkflow.lib.metadata_cache import metadata_cache
+from chunkflow.lib.tracer import tracer
+from chunkflow.lib.write_behind import uploader, wait_uploads
 from chunkflow.chunk import Chunk
 from chunkflow.chunk.affinity_map import AffinityMap
 from chunkflow.chunk.segmentation import Segmentation
@@ -33,6 +38,8 @@ from .mesh_manifest import MeshManifestOperator
 from .neuroglancer import NeuroglancerOperator
 from .normalize_section_contrast import NormalizeSectionContrastOperator
 from .normalize_section_shang import NormalizeSectionShangOperator
+from .overlap_add import OverlapAddOperator
+from .pipeline import chunk_liveness, prefetch, release_chunks, run_workers
 from .save import SaveOperator
 from .save_pngs import SavePNGsOperator
 from .skeletonize import SkeletonizeOperator
@@ -41,6 +48,8 @@ from .view import ViewOperator
 
 # global dict to hold the operators and parameters
 state = {'operators': {}}
+# the operators are shared by workers in multiple threads
+operators_lock = Lock()
 DEFAULT_CHUNK_NAME = 'chunk'
 
 
@@ -48,12 +57,40 @@ def get_initial_task():
     return {'skip': False, 'log': {'timer': {}}}
 
 
+def register_operator(operator_name, operator_class, *args, **kwargs):
+    """construct the operator only once, so all the workers share 
+    the same operator instance, such as the loaded ConvNet model."""
+    with operators_lock:
+        if operator_name not in state['operators']:
+            state['operators'][operator_name] = operator_class(*args, **kwargs)
+    return state['operators'][operator_name]
+
+
 def handle_task_skip(task, name):
     if task['skip'] and task['skip_to'] == name:
         # have already skipped to target operator
         task['skip'] = False
 
 
+def timed_stream(stream, timer: dict, name: str):
+    """accumulate the time of producing the items of a stream in the timer.
+
+    The time of consuming the items in downstream is excluded.
+    """
+    elapsed = 0
+    iterator = iter(stream)
+    while True:
+        start = time()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            break
+        finally:
+            elapsed += time() - start
+            timer[name] = elapsed
+        yield item
+
+
 def default_none(ctx, _, value):
     """
     click currently can not use None with tuple type
@@ -75,18 +112,58 @@ def default_none(ctx, _, value):
               help='default mip level of chunks.')
 @click.option('--dry-run/--real-run', default=False,
               help='dry run or real run. default is real run.')
-def main(verbose, mip, dry_run):
+@click.option('--queue-depth', type=click.IntRange(min=0), default=0,
+              help='run each operator as a pipeline stage in a separate thread, ' +
+              'and the stages are connected by a bounded task queue with this depth. ' +
+              'default is 0 and all the operators run one after another.')
+@click.option('--stage-queue-depth', type=(str, click.IntRange(min=0)), multiple=True,
+              help='queue depth in front of an operator with this name, ' +
+              'such as `--stage-queue-depth inference 2`. ' +
+              'depth 0 groups the operator with its upstream operator in one stage.')
+@click.option('--workers', type=click.IntRange(min=1), default=1,
+              help='number of task loops running concurrently in this process. ' +
+              'The tasks produced by the first operator, such as fetch-task, are ' +
+              'distributed to the workers, and all the workers share the same ' +
+              'operator instances, such as the loaded ConvNet model.')
+@click.option('--trace-file', type=click.Path(dir_okay=False), default=None,
+              help='record the time spans of operators and export them as a ' +
+              'Chrome trace JSON file. Open it in chrome://tracing or Perfetto.')
+@click.option('--free-chunks/--keep-chunks', default=True,
+              help='delete a chunk from the task right after the last operator ' +
+              'using it to reduce the memory usage. default is freeing chunks.')
+@click.option('--metadata-ttl', type=click.FloatRange(min=0), default=None,
+              help='time to live (sec) of the cached volume metadata, such as ' +
+              'the info file. default is caching it until the process exits.')
+@click.option('--metadata-cache-dir', type=click.Path(file_okay=False), default=None,
+              help='local directory to persist the volume metadata, ' +
+              'so it could be shared by multiple processes.')
+@click.option('--upload-workers', type=click.IntRange(min=1), default=2,
+              help='number of background uploading threads for the ' +
+              'operators in write-behind mode, such as save.')
+@click.option('--upload-queue-depth', type=click.IntRange(min=1), default=4,
+              help='maximum number of uploading jobs waiting in the queue. ' +
+              'The pipeline will wait if the queue is full.')
+def main(verbose, mip, dry_run, queue_depth, stage_queue_depth, workers, trace_file,
+         free_chunks, metadata_ttl, metadata_cache_dir, upload_workers, 
+         upload_queue_depth):
     """Compose operators and create your own pipeline."""
     state['verbose'] = verbose
     state['mip'] = mip
     state['dry_run'] = dry_run
+    metadata_cache.configure(ttl=metadata_ttl, cache_dir=metadata_cache_dir)
+    uploader.configure(worker_num=upload_workers, queue_depth=upload_queue_depth)
+    if trace_file:
+        tracer.enable()
     if dry_run:
         print(yellow('\nYou are using dry-run mode, will not do the work!'))
     pass
 
 
 @main.resultcallback()
-def process_commands(operators, verbose, mip, dry_run):
+def process_commands(operators, verbose, mip, dry_run, queue_depth, 
+                     stage_queue_depth, workers, trace_file, free_chunks,
+                     metadata_ttl, metadata_cache_dir, upload_workers,
+                     upload_queue_depth):
     """This result callback is invoked with an iterable of all 
     the chained subcommands. As in this example each subcommand 
     returns a function we can chain them together to feed one 
@@ -95,14 +172,95 @@ def process_commands(operators, verbose, mip, dry_run):
     # It turns out that a tuple will not work correctly!
     stream = [get_initial_task(), ]
 
-    # Pipe it through all stream operators.
-    for operator in operators:
-        stream = operator(stream)
+    stage_queue_depth = dict(stage_queue_depth)
+
+    if free_chunks:
+        dead_chunk_names = chunk_liveness([op.params for op in operators])
+        if verbose > 1:
+            for operator, chunk_names in zip(operators, dead_chunk_names):
+                if chunk_names:
+                    print(f'release chunks {chunk_names} after {operator.name}')
+    else:
+        dead_chunk_names = [set() for _ in operators]
+    
+    def pipe(stream, start: int = 0, stop: int = len(operators)):
+        # Pipe it through all stream operators.
+        for idx in range(start, stop):
+            operator = operators[idx]
+            depth = stage_queue_depth.get(operator.name, queue_depth)
+            if idx > 0 and depth > 0:
+                # the upstream operators run in a separate stage
+                stream = prefetch(stream, queue_depth=depth,
+                                  name=operators[idx-1].name)
+            stream = operator(stream)
+            # the task will be thrown away after the last operator anyway
+            if dead_chunk_names[idx] and idx < len(operators) - 1:
+                stream = release_chunks(stream, dead_chunk_names[idx])
+        return stream
+
+    try:
+        if workers > 1 and len(operators) > 1:
+            # the first operator produces tasks for all the workers
+            stream = pipe(stream, stop=1)
+            run_workers(stream, lambda s: pipe(s, start=1),
+                        worker_num=workers)
+        else:
+            stream = pipe(stream)
+            # Evaluate the stream and throw away the items.
+            if stream:
+                for _ in stream:
+                    pass
+    finally:
+        try:
+            # wait for the write-behind uploads, so the results of the 
+            # finished tasks are saved even if a later task failed
+            uploader.drain()
+        finally:
+            # export the spans even if the processing failed
+            if trace_file:
+                print('export trace to ', trace_file)
+                tracer.export(trace_file)
+
+
+def trace_operator(name, tasks, stream):
+    """record a span and a timer for each task yielded by an operator.
+
+    The time waiting for the upstream operators is excluded, so the span
+    starts when the operator received the task, or when the operator was 
+    asked for a new task if it produces tasks by itself, such as fetch-task.
+    """
+    received = None
+    def upstream():
+        nonlocal received
+        for task in stream:
+            received = tracer.now()
+            yield task
 
-    # Evaluate the stream and throw away the items.
-    if stream:
-        for _ in stream:
-            pass
+    tasks = tasks(upstream())
+    if tasks is None:
+        # the operator is not a generator and consumed the stream already
+        return
+    while True:
+        received = None
+        start = tracer.now()
+        try:
+            task = next(tasks)
+        except StopIteration:
+            return
+        stop = tracer.now()
+        if received is not None:
+            start = received
+
+        if isinstance(task, dict):
+            if not task.get('skip') and 'log' in task:
+                # some operators record the time of the processing itself
+                task['log'].setdefault('timer', {}).setdefault(name, stop - start)
+            if tracer.enabled and task.get('bbox') is not None:
+                tracer.add_span(name, start, stop, category='operator',
+                                bbox=task['bbox'].to_filename())
+            else:
+                tracer.add_span(name, start, stop, category='operator')
+        yield task
 
 
 def operator(func):
@@ -113,8 +271,15 @@ def operator(func):
     @wraps(func)
     def wrapper(*args, **kwargs):
         def operator(stream):
-            return func(stream, *args, **kwargs)
-
+            return trace_operator(operator.name, 
+                                  lambda tasks: func(tasks, *args, **kwargs),
+                                  stream)
+        
+        # the operator name is used to configure the pipeline stages
+        # and record the time spans
+        operator.name = kwargs.get('name', wrapper.__name__.replace('_', '-'))
+        # the chunk name parameters are used to release chunks early
+        operator.params = kwargs
         return operator
 
     return wrapper
@@ -351,6 +516,7 @@ def setup_env(volume_start, volume_stop, volume_size, layer_path, max_ram_size,
         vol = CloudVolume(layer_path, info=info)
         if overwrite_info:
             vol.commit_info()
+            metadata_cache.invalidate(layer_path)
       
         thumbnail_factor = 2**thumbnail_mip
         thumbnail_block_size = (output_chunk_size[0]//factor,
@@ -368,6 +534,7 @@ def setup_env(volume_start, volume_stop, volume_size, layer_path, max_ram_size,
         thumbnail_vol = CloudVolume(thumbnail_layer_path, info=thumbnail_info)
         if overwrite_info:
             thumbnail_vol.commit_info()
+            metadata_cache.invalidate(thumbnail_layer_path)
        
     print('create a list of bounding boxes...')
     roi_start = (volume_start[0], 
@@ -410,9 +577,9 @@ def setup_env(volume_start, volume_stop, volume_size, layer_path, max_ram_size,
 @operator
 def cloud_watch(tasks, name, log_name):
     """Real time speedometer in AWS CloudWatch."""
-    state['operators'][name] = CloudWatchOperator(log_name=log_name,
-                                                  name=name,
-                                                  verbose=state['verbose'])
+    register_operator(name, CloudWatchOperator, log_name=log_name,
+                      name=name,
+                      verbose=state['verbose'])
     for task in tasks:
         handle_task_skip(task, name)
         if not task['skip']:
@@ -469,11 +636,11 @@ def fetch_task(queue_name, visibility_timeout, retry_times):
 def agglomerate(tasks, name, threshold, aff_threshold_low, aff_threshold_high,
                 fragments_chunk_name, scoring_function, input_chunk_name, output_chunk_name):
     """Watershed and agglomeration to segment affinity map."""
-    state['operators'][name] = AgglomerateOperator(name=name, verbose=state['verbose'],
-                                                   threshold=threshold, 
-                                                   aff_threshold_low=aff_threshold_low,
-                                                   aff_threshold_high=aff_threshold_high,
-                                                   scoring_function=scoring_function)
+    register_operator(name, AgglomerateOperator, name=name, verbose=state['verbose'],
+                      threshold=threshold,
+                      aff_threshold_low=aff_threshold_low,
+                      aff_threshold_high=aff_threshold_high,
+                      scoring_function=scoring_function)
     for task in tasks:
         if fragments_chunk_name and fragments_chunk_name in task:
             fragments = task[fragments_chunk_name]
@@ -619,8 +786,8 @@ def write_tif(tasks, name, input_chunk_name, file_name):
 @operator
 def save_pngs(tasks, name, input_chunk_name, output_path):
     """Save as 2D PNG images."""
-    state['operators'][name] = SavePNGsOperator(output_path=output_path,
-                                                name=name)
+    register_operator(name, SavePNGsOperator, output_path=output_path,
+                      name=name)
     for task in tasks:
         handle_task_skip(task, name)
         if not task['skip']:
@@ -641,12 +808,12 @@ def save_pngs(tasks, name, input_chunk_name, output_path):
 @operator
 def skeletonize(tasks, name, input_chunk_name, output_name, voxel_size, output_path):
     """Skeletonize the neurons/objects in a segmentation chunk"""
-    operator = SkeletonizeOperator(output_path,
-                                   name=name,
-                                   verbose=state['verbose'])
+    register_operator(name, SkeletonizeOperator, output_path,
+                      name=name,
+                      verbose=state['verbose'])
     for task in tasks:
         seg = task[input_chunk_name]
-        skels = operator(seg, voxel_size)
+        skels = state['operators'][name](seg, voxel_size)
         task[output_name] = skels
         yield task
 
@@ -662,11 +829,14 @@ def delete_task_in_queue(tasks, name):
         if task['skip'] or state['dry_run']:
             print('skip deleting task in queue!')
         else:
+            # the task is only finished after the results were uploaded
+            wait_uploads(task)
             queue = task['queue']
             task_handle = task['task_handle']
             queue.delete(task_handle)
             print('deleted task {} in queue: {}'.format(
                 task_handle, queue.queue_name))
+        yield task
 
 
 @main.command('delete-chunk')
@@ -715,13 +885,22 @@ def delete_chunk(tasks, name, chunk_name):
     type=str, default='chunk', help='Variable name to store the cutout to for later retrieval.'
     + 'Chunkflow operators by default operates on a variable named "chunk" but' +
     ' sometimes you may need to have a secondary volume to work on.')
+@click.option('--cache-dir', type=click.Path(file_okay=False), default=None,
+              help='local directory to cache the storage blocks. The overlapping ' +
+              'blocks of neighboring tasks will be read from local disk. ' +
+              'The directory could be shared by multiple processes.')
+@click.option('--cache-size', type=click.FloatRange(min=0), default=None,
+              help='maximum size (GB) of the block cache. ' +
+              'The least recently used blocks will be evicted. default is unlimited.')
 @operator
 def cutout(tasks, name, volume_path, mip, chunk_start, chunk_size, expand_margin_size,
-           fill_missing, validate_mip, blackout_sections, output_chunk_name):
+           fill_missing, validate_mip, blackout_sections, output_chunk_name,
+           cache_dir, cache_size):
     """Cutout chunk from volume."""
     if mip is None:
         mip = state['mip']
-    state['operators'][name] = CutoutOperator(
+    register_operator(
+        name, CutoutOperator,
         volume_path,
         mip=mip,
         expand_margin_size=expand_margin_size,
@@ -729,6 +908,8 @@ def cutout(tasks, name, volume_path, mip, chunk_start, chunk_size, expand_margin
         fill_missing=fill_missing,
         validate_mip=validate_mip,
         blackout_sections=blackout_sections,
+        cache_dir=cache_dir,
+        cache_size=cache_size,
         dry_run=state['dry_run'],
         name=name)
 
@@ -753,7 +934,8 @@ def cutout(tasks, name, volume_path, mip, chunk_start, chunk_size, expand_margin
         if not task['skip']:
             start = time()
             assert output_chunk_name not in task
-            task[output_chunk_name] = state['operators'][name](bbox)
+            task[output_chunk_name] = state['operators'][name](
+                bbox, log=task['log'])
             task['log']['timer'][name] = time() - start
             task['cutout_volume_path'] = volume_path
         yield task
@@ -785,6 +967,33 @@ def evaluate_segmenation(tasks, name, segmentation_chunk_name,
         yield task
 
 
+@main.command('evaluate-affinity-map')
+@click.option('--name', type=str, default='evaluate-affinity-map',
+              help='name of operator')
+@click.option('--affinity-map-chunk-name', '-a', type=str, default='chunk',
+              help='chunk name of affinity map')
+@click.option('--reference-chunk-name', '-r', type=str, default='reference',
+              help='chunk name of reference affinity map, such as the float32 inference output.')
+@click.option('--threshold', '-t', type=float, default=0.5,
+              help='threshold to count the voxels with flipped binary affinity.')
+@operator
+def evaluate_affinity_map(tasks, name, affinity_map_chunk_name,
+                          reference_chunk_name, threshold):
+    """Evaluate affinity map by the error against a reference.
+
+    The report is printed and recorded in the task log.
+    """
+    for task in tasks:
+        handle_task_skip(task, name)
+        if not task['skip']:
+            affinity_map = AffinityMap.from_chunk(task[affinity_map_chunk_name])
+            report = affinity_map.evaluate(task[reference_chunk_name],
+                                           threshold=threshold)
+            print(f'{name}: ', report)
+            task['log'][name] = report
+        yield task
+
+
 @main.command('downsample-upload')
 @click.option('--name',
               type=str, default='downsample-upload', help='name of operator')
@@ -799,19 +1008,30 @@ def evaluate_segmenation(tasks, name, segmentation_chunk_name,
     'the last index is exclusive.')
 @click.option('--fill-missing/--no-fill-missing',
               default=True, help='fill missing or not when there is all zero blocks.')
+@click.option('--write-behind/--write-through', default=False,
+              help='upload in background and continue the pipeline immediately. ' +
+              'default is waiting for the uploading.')
+@click.option('--slab-size', type=click.IntRange(min=1), default=None,
+              help='downsample the chunk in z slabs aligned with this size, and upload ' +
+              'a slab while downsampling the next one to reduce the peak memory. It ' +
+              'should be a multiple of the block size of volume in z.')
 @operator
 def downsample_upload(tasks, name, input_chunk_name, volume_path, 
-                      chunk_mip, start_mip, stop_mip, fill_missing):
+                      chunk_mip, start_mip, stop_mip, fill_missing, write_behind,
+                      slab_size):
     """Downsample chunk and upload to volume."""
     if chunk_mip is None:
         chunk_mip = state['mip']
 
-    state['operators'][name] = DownsampleUploadOperator(
+    register_operator(
+        name, DownsampleUploadOperator,
         volume_path,
         chunk_mip=chunk_mip,
         start_mip=start_mip,
         stop_mip=stop_mip,
         fill_missing=fill_missing,
+        write_behind=write_behind,
+        slab_size=slab_size,
         name=name,
         verbose=state['verbose'])
 
@@ -819,7 +1039,9 @@ def downsample_upload(tasks, name, input_chunk_name, volume_path,
         handle_task_skip(task, name)
         if not task['skip']:
             start = time()
-            state['operators'][name](task[input_chunk_name])
+            futures = state['operators'][name](task[input_chunk_name])
+            if futures:
+                task.setdefault('pending_uploads', []).extend(futures)
             task['log']['timer'][name] = time() - start
         yield task
 
@@ -864,7 +1086,8 @@ def normalize_contrast_contrast(tasks, name, input_chunk_name, output_chunk_name
                                 upper_clip_fraction, minval, maxval):
     """Normalize the section contrast using precomputed histograms."""
     
-    state['operators'][name] = NormalizeSectionContrastOperator(
+    register_operator(
+        name, NormalizeSectionContrastOperator,
         levels_path,
         lower_clip_fraction=lower_clip_fraction,
         upper_clip_fraction=upper_clip_fraction,
@@ -907,7 +1130,8 @@ def normalize_section_shang(tasks, name, input_chunk_name, output_chunk_name,
     The transformed chunk has floating point values.
     """
 
-    state['operators'][name] = NormalizeSectionShangOperator(
+    register_operator(
+        name, NormalizeSectionShangOperator,
         nominalmin=nominalmin,
         nominalmax=nominalmax,
         clipvalues=clipvalues,
@@ -940,9 +1164,9 @@ def custom_operator(tasks, name, input_chunk_name, output_chunk_name, opprogram,
     a call of `op_call(chunk, args)` can be made to operate on the chunk.
     """
 
-    state['operators'][name] = CustomOperator(opprogram=opprogram,
-                                              args=args,
-                                              name=name)
+    register_operator(name, CustomOperator, opprogram=opprogram,
+                      args=args,
+                      name=name)
     if state['verbose']:
         print('Received args for ', name, ':', args)
 
@@ -977,7 +1201,7 @@ def connected_components(tasks, name, input_chunk_name, output_chunk_name,
             start = time()
             task[output_chunk_name] = task[input_chunk_name].connected_component(
                 threshold=threshold, connectivity=connectivity)
-            task['log']['timer']['name'] = time() - start
+            task['log']['timer'][name] = time() - start
         yield task
 
 
@@ -999,6 +1223,64 @@ def copy_var(tasks, name, from_name, to_name):
         yield task
 
 
+def framework_options(func):
+    """add the options of ConvNet inference frameworks to a command.
+
+    The options are shared by inference and inference-server.
+    """
+    options = [
+        click.option('--framework', '-f',
+                     type=click.Choice(['general', 'identity', 'pznet', 'pytorch',
+                                        'pytorch-quantized', 'pytorch-multitask', 
+                                        'onnx', 'remote']),
+                     default='general', help='inference framework. The convnet model '
+                     + 'is the ONNX file for the onnx framework, and the socket path of '
+                     + 'inference server for the remote framework.'),
+        click.option('--jit', type=click.Choice(['trace', 'script']), default=None,
+                     help='convert the model to TorchScript and freeze it while loading. '
+                     + 'Only for the pytorch frameworks.'),
+        click.option('--num-threads', type=click.IntRange(min=1), default=None,
+                     help='number of intra-op threads of CPU inference. The default is '
+                     + 'the number of cores available to the process. Only for the '
+                     + 'pytorch and onnx frameworks.'),
+        click.option('--num-interop-threads', type=click.IntRange(min=1), default=None,
+                     help='number of inter-op threads of CPU inference. Only for the '
+                     + 'pytorch and onnx frameworks.'),
+        click.option('--quantization', type=click.Choice(['static', 'dynamic']), 
+                     default='static',
+                     help='int8 quantization mode of the pytorch-quantized framework.'),
+        click.option('--calibration-batches', type=click.IntRange(min=1), default=8,
+                     help='number of batches to calibrate the static quantization.'),
+        click.option('--calibration-file', 
+                     type=click.Path(exists=True, dir_okay=False), default=None,
+                     help='HDF5 or TIFF file of a representative image chunk to calibrate '
+                     + 'the static quantization. The default is calibrating with random '
+                     + 'input.'),
+    ]
+    # the options are listed in the help in this order
+    for option in reversed(options):
+        func = option(func)
+    return func
+
+
+def get_framework_options(framework, jit, num_threads, num_interop_threads, 
+                          quantization, calibration_batches, calibration_file):
+    """the backend specific options of a framework."""
+    if framework in ('pytorch', 'pytorch-quantized'):
+        options = {'jit': jit, 'num_threads': num_threads,
+                   'num_interop_threads': num_interop_threads}
+        if framework == 'pytorch-quantized':
+            options['quantization'] = quantization
+            options['calibration_batches'] = calibration_batches
+            options['calibration_file'] = calibration_file
+        return options
+    elif framework == 'onnx':
+        return {'num_threads': num_threads,
+                'num_interop_threads': num_interop_threads}
+    else:
+        return None
+
+
 @main.command('inference')
 @click.option('--name', type=str, default='inference', 
               help='name of this operator')
@@ -1020,19 +1302,41 @@ def copy_var(tasks, name, from_name, to_name):
               type=int, default=3, help='number of output channels')
 @click.option('--dtype', '-d', type=click.Choice(['float32', 'float16']),
               default='float32', help='numerical precision.')
-@click.option('--framework', '-f',
-              type=click.Choice(['general', 'identity', 'pznet', 'pytorch',
-                                 'pytorch-multitask']),
-              default='general', help='inference framework')
+@framework_options
 @click.option('--batch-size', '-b',
               type=int, default=1, help='mini batch size of input patch.')
+@click.option('--double-buffer/--no-double-buffer', default=False,
+              help='gather the next batch and blend the previous batch in background '
+              + 'while the current batch is in the forward pass.')
 @click.option('--bump', type=click.Choice(['wu', 'zung']), default='wu',
               help='bump function type (only support wu now!).')
 @click.option('--mask-output-chunk/--no-mask-output-chunk', default=False,
               help='mask output chunk will make the whole chunk like one output patch. '
               + 'This will also work with non-aligned chunk size.')
+@click.option('--overlap-add/--no-overlap-add', default=False,
+              help='output the weighted chunk without normalization with the weight as '
+              + 'the last channel. The outputs of neighboring tasks should be blended by '
+              + 'accumulate and finalize-accumulation.')
+@click.option('--mask-cache-dir', type=str, default=None,
+              help='directory to save the output chunk mask as a memory mapped file. '
+              + 'The mask is shared by the worker processes in a node.')
+@click.option('--scratch-dir', type=str, default=None,
+              help='directory of scratch files to memory map the output buffer. '
+              + 'This enables chunks larger than RAM.')
+@click.option('--skip-zero-patches/--run-zero-patches', default=True,
+              help='skip the patches with all zero input.')
+@click.option('--mask-volume-path', type=str, default=None,
+              help='mask volume path. The patches fully masked out are skipped.')
+@click.option('--mask-mip', type=int, default=5, help='mip level of mask')
+@click.option('--mask-inverse/--no-mask-inverse', default=False,
+              help='inverse the mask or not.')
+@click.option('--mask-fill-missing/--no-mask-fill-missing', default=False,
+              help='fill missing blocks of mask with black or not.')
 @click.option('--mask-myelin-threshold', '-y', default=None, type=float,
               help='mask myelin if netoutput have myelin channel.')
+@click.option('--slab-size', type=click.IntRange(min=1), default=None,
+              help='stream the output in z slabs aligned with this size, such as '
+              + 'the block size of output volume. The slabs should be consumed by save.')
 @click.option('--input-chunk-name', '-i',
               type=str, default='chunk', help='input chunk name')
 @click.option('--output-chunk-name', '-o',
@@ -1040,10 +1344,28 @@ def copy_var(tasks, name, from_name, to_name):
 @operator
 def inference(tasks, name, convnet_model, convnet_weight_path, input_patch_size,
               output_patch_size, output_patch_overlap, output_crop_margin, patch_num,
-              num_output_channels, dtype, framework, batch_size, bump, mask_output_chunk,
-              mask_myelin_threshold, input_chunk_name, output_chunk_name):
+              num_output_channels, dtype, framework, batch_size, jit, num_threads,
+              num_interop_threads, quantization, calibration_batches, calibration_file, 
+              double_buffer, bump, 
+              mask_output_chunk, overlap_add, mask_cache_dir, scratch_dir, 
+              skip_zero_patches, mask_volume_path, mask_mip, mask_inverse, mask_fill_missing, 
+              mask_myelin_threshold, slab_size, input_chunk_name, output_chunk_name):
     """Perform convolutional network inference for chunks."""
-    with Inferencer(
+    if mask_volume_path:
+        # the mask is read in low resolution to select the patches
+        mask_operator = register_operator(
+            f'{name}-mask', MaskOperator, mask_volume_path, mask_mip, state['mip'],
+            inverse=mask_inverse, fill_missing=mask_fill_missing,
+            verbose=state['verbose'], name=f'{name}-mask')
+    else:
+        mask_operator = None
+
+    framework_options = get_framework_options(
+        framework, jit, num_threads, num_interop_threads, quantization,
+        calibration_batches, calibration_file)
+
+    with register_operator(
+        name, Inferencer,
         convnet_model,
         convnet_weight_path,
         input_patch_size=input_patch_size,
@@ -1053,16 +1375,20 @@ def inference(tasks, name, convnet_model, convnet_weight_path, input_patch_size,
         output_crop_margin=output_crop_margin,
         patch_num=patch_num,
         framework=framework,
+        framework_options=framework_options,
         dtype=dtype,
         batch_size=batch_size,
+        double_buffer=double_buffer,
         bump=bump,
         mask_output_chunk=mask_output_chunk,
+        overlap_add=overlap_add,
+        mask_cache_dir=mask_cache_dir,
+        scratch_dir=scratch_dir,
+        skip_zero_patches=skip_zero_patches,
         mask_myelin_threshold=mask_myelin_threshold,
         dry_run=state['dry_run'],
         verbose=state['verbose']) as inferencer:
         
-        state['operators'][name] = inferencer 
-
         for task in tasks:
             handle_task_skip(task, name)
             if not task['skip']:
@@ -1070,15 +1396,235 @@ def inference(tasks, name, convnet_model, convnet_weight_path, input_patch_size,
                     task['log'] = {'timer': {}}
                 start = time()
 
-                task[output_chunk_name] = state['operators'][name](
-                    task[input_chunk_name])
+                input_chunk = task[input_chunk_name]
+                if mask_operator is None:
+                    mask, mask_factor = None, (1, 1, 1)
+                else:
+                    mask = mask_operator.read_mask(
+                        Bbox.from_slices(input_chunk.slices[-3:]), log=task['log'])
+                    mask_factor = mask_operator.mask_factor
+                if slab_size is None:
+                    task[output_chunk_name] = inferencer(
+                        input_chunk, mask=mask, mask_factor=mask_factor, 
+                        log=task['log'])
+                else:
+                    # the inference runs while the downstream operator, 
+                    # such as save, is consuming the slabs.
+                    task[output_chunk_name] = timed_stream(
+                        inferencer.infer_slabs(
+                            input_chunk, slab_size, mask=mask, 
+                            mask_factor=mask_factor, log=task['log']),
+                        task['log']['timer'], name)
 
                 task['log']['timer'][name] = time() - start
-                task['log']['compute_device'] = state[
-                    'operators'][name].compute_device
+                task['log']['compute_device'] = inferencer.compute_device
             yield task
 
 
+@main.command('accumulate')
+@click.option('--name', type=str, default='accumulate', help='name of operator')
+@click.option('--accumulation-path', '-p', type=str, required=True,
+              help='storage path of the weighted inference outputs.')
+@click.option('--input-chunk-name', '-i',
+              type=str, default='chunk', help='input chunk name')
+@operator
+def accumulate(tasks, name, accumulation_path, input_chunk_name):
+    """Save the weighted inference output of overlap-add blending.
+
+    The input chunk is the output of inference with --overlap-add.
+    """
+    register_operator(name, OverlapAddOperator, accumulation_path,
+                      verbose=state['verbose'], name=name)
+    for task in tasks:
+        handle_task_skip(task, name)
+        if not task['skip']:
+            start = time()
+            state['operators'][name].accumulate(task[input_chunk_name],
+                                                task['bbox'])
+            task['log']['timer'][name] = time() - start
+        yield task
+
+
+@main.command('finalize-accumulation')
+@click.option('--name', type=str, default='finalize-accumulation', 
+              help='name of operator')
+@click.option('--accumulation-path', '-p', type=str, required=True,
+              help='storage path of the weighted inference outputs.')
+@click.option('--margin-size', '-m', type=int, nargs=3, required=True,
+              help='margin size of the weighted outputs beyond the task bounding box. '
+              + 'It is normally half of the output patch overlap.')
+@click.option('--roi-start', '-s', type=int, nargs=3, required=True,
+              help='(z y x), start of the region covered by the accumulate tasks.')
+@click.option('--roi-stop', '-t', type=int, nargs=3, required=True,
+              help='(z y x), stop of the region covered by the accumulate tasks.')
+@click.option('--output-chunk-name', '-o',
+              type=str, default='chunk', help='output chunk name')
+@operator
+def finalize_accumulation(tasks, name, accumulation_path, margin_size, 
+                          roi_start, roi_stop, output_chunk_name):
+    """Blend the weighted inference outputs overlapping with the task bounding box.
+
+    The task bounding boxes should be the same with the accumulate tasks.
+    The neighboring tasks inside of the region should all be accumulated.
+    """
+    register_operator(name, OverlapAddOperator, accumulation_path,
+                      margin_size=margin_size, roi_start=roi_start, 
+                      roi_stop=roi_stop, verbose=state['verbose'], 
+                      name=name)
+    for task in tasks:
+        handle_task_skip(task, name)
+        if not task['skip']:
+            start = time()
+            task[output_chunk_name] = state['operators'][name].finalize(
+                task['bbox'])
+            task['log']['timer'][name] = time() - start
+        yield task
+
+
+@main.command('inference-server')
+@click.option('--socket-path', '-p', type=str, required=True,
+              help='Unix socket path of the server.')
+@click.option('--convnet-model', '-m',
+              type=str, default=None, help='convnet model path or type.')
+@click.option('--convnet-weight-path', '-w',
+              type=str, default=None, help='convnet weight path')
+@click.option('--input-patch-size', '-s',
+              type=int, nargs=3, required=True, help='input patch size')
+@click.option('--output-patch-size', '-z', type=int, nargs=3, default=None, 
+              callback=default_none, help='output patch size')
+@click.option('--output-patch-overlap', '-v', type=int, nargs=3, 
+              default=(4, 64, 64), help='patch overlap')
+@click.option('--num-output-channels', '-c',
+              type=int, default=3, help='number of output channels')
+@click.option('--dtype', '-d', type=click.Choice(['float32', 'float16']),
+              default='float32', help='numerical precision.')
+@framework_options
+@click.option('--batch-size', '-b', type=click.IntRange(min=1), default=8, 
+              help='maximum number of patches in a batch.')
+@click.option('--max-latency', '-l', type=float, default=0.01,
+              help='maximum time in seconds to wait for more patches to fill a batch.')
+@click.option('--bump', type=click.Choice(['wu', 'zung']), default='wu',
+              help='bump function type (only support wu now!).')
+@generator
+def inference_server(socket_path, convnet_model, convnet_weight_path, input_patch_size,
+                     output_patch_size, output_patch_overlap, num_output_channels,
+                     dtype, framework, jit, num_threads, num_interop_threads, 
+                     quantization, calibration_batches, calibration_file, 
+                     batch_size, max_latency, bump):
+    """Serve the patch inference of pipelines in a node with dynamic batching.
+
+    The pipelines should use the remote inference framework with the socket 
+    path as the convnet model, and the same patch geometry.
+    The server runs until it is interrupted.
+    """
+    from chunkflow.chunk.image.convnet.server import InferenceServer
+    if framework == 'remote':
+        raise click.BadParameter('the server could not forward to another server.', 
+                                 param_hint='--framework')
+    if output_patch_size is None:
+        output_patch_size = input_patch_size
+
+    framework_options = get_framework_options(
+        framework, jit, num_threads, num_interop_threads, quantization,
+        calibration_batches, calibration_file) or {}
+    if framework in ('pytorch', 'pytorch-quantized'):
+        # the backend checks the batch size while loading the model
+        framework_options['batch_size'] = batch_size
+
+    server = InferenceServer(
+        socket_path, framework, convnet_model, convnet_weight_path,
+        batch_size=batch_size, max_latency=max_latency, 
+        verbose=state['verbose'],
+        input_patch_size=input_patch_size,
+        output_patch_size=output_patch_size,
+        output_patch_overlap=output_patch_overlap,
+        num_output_channels=num_output_channels,
+        dtype=dtype, bump=bump, framework_options=framework_options)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        print(f'inference server stats: {server.stats}')
+
+    # there is no task produced by the server
+    yield from ()
+
+
+@main.command('autotune')
+@click.option('--convnet-model', '-m',
+              type=str, default=None, help='convnet model path or type.')
+@click.option('--convnet-weight-path', '-w',
+              type=str, default=None, help='convnet weight path')
+@click.option('--input-patch-size', '-s',
+              type=int, nargs=3, required=True, help='input patch size')
+@click.option('--output-patch-size', '-z', type=int, nargs=3, default=None, 
+              callback=default_none, help='output patch size')
+@click.option('--output-patch-overlap', '-v', type=int, nargs=3, multiple=True,
+              default=[(4, 64, 64)], help='candidate patch overlap. Repeat it for more candidates.')
+@click.option('--output-crop-margin', type=int, nargs=3, multiple=True, default=None,
+              help='candidate margin size of output cropping. Repeat it for more candidates. '
+              + 'The default is the same with the patch overlap.')
+@click.option('--patch-num', '-n', type=int, nargs=3, default=(2, 2, 2),
+              help='patch number in z,y,x of the synthetic chunk.')
+@click.option('--num-output-channels', '-c',
+              type=int, default=3, help='number of output channels')
+@click.option('--dtype', '-d', type=click.Choice(['float32', 'float16']),
+              default='float32', help='numerical precision.')
+@click.option('--framework', '-f',
+              type=click.Choice(['general', 'identity', 'pznet', 'pytorch',
+                                 'pytorch-quantized', 'onnx', 'remote']),
+              default='general', help='inference framework')
+@click.option('--batch-size', '-b', type=click.IntRange(min=1), multiple=True,
+              default=[1, 2, 4, 8], help='candidate batch size. Repeat it for more candidates.')
+@click.option('--jit', type=click.Choice(['trace', 'script']), default=None,
+              help='convert the model to TorchScript. Only for the pytorch frameworks.')
+@click.option('--num-threads', type=click.IntRange(min=1), default=None,
+              help='number of intra-op threads. Only for the pytorch and onnx frameworks.')
+@click.option('--repeats', '-r', type=click.IntRange(min=1), default=2,
+              help='number of chunks to measure for each configuration.')
+@click.option('--max-ram-size', type=float, default=None,
+              help='the configurations using more RAM (GB) in buffers are not selected.')
+@click.option('--output-file', '-o', type=str, default='autotune.json',
+              help='the JSON file to write the best configuration and all the results.')
+@generator
+def autotune(convnet_model, convnet_weight_path, input_patch_size, output_patch_size,
+             output_patch_overlap, output_crop_margin, patch_num, num_output_channels,
+             dtype, framework, batch_size, jit, num_threads, repeats, max_ram_size,
+             output_file):
+    """Select the batch size and patch geometry by measured throughput.
+
+    The candidates are benchmarked with a synthetic chunk in this computer.
+    """
+    from chunkflow.chunk.image.convnet.autotune import autotune as tune
+    if framework in ('pytorch', 'pytorch-quantized'):
+        framework_options = {'jit': jit, 'num_threads': num_threads}
+    elif framework == 'onnx':
+        framework_options = {'num_threads': num_threads}
+    else:
+        framework_options = None
+
+    best, results = tune(
+        batch_size, output_patch_overlap, output_crop_margin or [None],
+        patch_num=patch_num, repeats=repeats,
+        max_memory=None if max_ram_size is None else max_ram_size * 1e9,
+        verbose=state['verbose'],
+        convnet_model=convnet_model,
+        convnet_weight_path=convnet_weight_path,
+        input_patch_size=input_patch_size,
+        output_patch_size=output_patch_size,
+        num_output_channels=num_output_channels,
+        dtype=dtype, framework=framework,
+        framework_options=framework_options)
+
+    print('\nthe best configuration: ', best)
+    with open(output_file, 'w') as f:
+        json.dump({'best': best, 'results': results}, f, indent=2)
+    # there is no task produced
+    yield from ()
+
+
 @main.command('mask')
 @click.option('--name', type=str, default='mask', help='name of this operator')
 @click.option('--input-chunk-name', '-i',
@@ -1102,20 +1648,27 @@ def inference(tasks, name, convnet_model, convnet_weight_path, input_patch_size,
               help='default is doing maskout. ' +
               'check all zero will return boolean result.')
 @click.option('--skip-to', type=str, default='save', help='skip to a operator')
+@click.option('--cache-dir', type=click.Path(file_okay=False), default=None,
+              help='local directory to cache the mask blocks. ' +
+              'The directory could be shared by multiple operators and processes.')
+@click.option('--cache-size', type=click.FloatRange(min=0), default=None,
+              help='maximum size (GB) of the block cache. default is unlimited.')
 @operator
 def mask(tasks, name, input_chunk_name, output_chunk_name, volume_path, 
-         mip, inverse, fill_missing, check_all_zero, skip_to):
+         mip, inverse, fill_missing, check_all_zero, skip_to, cache_dir, cache_size):
     """Mask the chunk. The mask could be in higher mip level and we
     will automatically upsample it to the same mip level with chunk.
     """
-    state['operators'][name] = MaskOperator(volume_path,
-                                            mip,
-                                            state['mip'],
-                                            inverse=inverse,
-                                            fill_missing=fill_missing,
-                                            check_all_zero=check_all_zero,
-                                            verbose=state['verbose'],
-                                            name=name)
+    register_operator(name, MaskOperator, volume_path,
+                      mip,
+                      state['mip'],
+                      inverse=inverse,
+                      fill_missing=fill_missing,
+                      check_all_zero=check_all_zero,
+                      cache_dir=cache_dir,
+                      cache_size=cache_size,
+                      verbose=state['verbose'],
+                      name=name)
 
     for task in tasks:
         handle_task_skip(task, name)
@@ -1124,12 +1677,13 @@ def mask(tasks, name, input_chunk_name, output_chunk_name, volume_path,
             if check_all_zero:
                 # skip following operators since the mask is all zero after required inverse
                 task['skip'] = state['operators'][name].is_all_zero(
-                    task['bbox'])
+                    task['bbox'], log=task['log'])
                 if task['skip']:
                     print(yellow(f'the mask of {name} is all zero, will skip to {skip_to}'))
                 task['skip_to'] = skip_to
             else:
-                task[output_chunk_name] = state['operators'][name](task[input_chunk_name])
+                task[output_chunk_name] = state['operators'][name](
+                    task[input_chunk_name], log=task['log'])
             # Note that mask operation could be used several times,
             # this will only record the last masking operation
             task['log']['timer'][name] = time() - start
@@ -1152,13 +1706,13 @@ def mask(tasks, name, input_chunk_name, output_chunk_name, volume_path,
 def mask_out_objects(tasks, name, input_chunk_name, output_chunk_name,
                      dust_size_threshold, selected_obj_ids):
     
-    operator = MaskOutObjectsOperator(
+    register_operator(
+        name, MaskOutObjectsOperator,
         dust_size_threshold,
         selected_obj_ids,
         name=name,
         verbose=state['verbose']
     )
-    state['operators'][name] = operator
     
     for task in tasks:
         task[output_chunk_name] = state['operators'][name](task[input_chunk_name])
@@ -1222,7 +1776,8 @@ def mesh(tasks, name, input_chunk_name, mip, voxel_size, output_path, output_for
     if mip is None:
         mip = state['mip']
 
-    state['operators'][name] = MeshOperator(
+    register_operator(
+        name, MeshOperator,
         output_path,
         output_format,
         mip=mip,
@@ -1247,7 +1802,7 @@ def mesh(tasks, name, input_chunk_name, mip, voxel_size, output_path, output_for
 @operator
 def mesh_manifest(tasks, name, input_name, prefix, volume_path):
     """Generate mesh manifest files."""
-    state['operators'][name] = MeshManifestOperator(volume_path)
+    register_operator(name, MeshManifestOperator, volume_path)
     if prefix:
         state['operators'][name](prefix)
     else:
@@ -1276,9 +1831,9 @@ def mesh_manifest(tasks, name, input_name, prefix, volume_path):
 @operator
 def neuroglancer(tasks, name, voxel_size, port, chunk_names):
     """Visualize the chunk using neuroglancer."""
-    state['operators'][name] = NeuroglancerOperator(name=name,
-                                                    port=port,
-                                                    voxel_size=voxel_size)
+    register_operator(name, NeuroglancerOperator, name=name,
+                      port=port,
+                      voxel_size=voxel_size)
     for task in tasks:
         chunks = dict()
         for chunk_name in chunk_names.split(","):
@@ -1313,32 +1868,92 @@ def quantize(tasks, name, input_chunk_name, output_chunk_name):
 @click.option('--create-thumbnail/--no-create-thumbnail',
     default=False, help='create thumbnail or not. ' +
     'the thumbnail is a downsampled and quantized version of the chunk.')
+@click.option('--write-behind/--write-through', default=False,
+              help='upload in background and continue the pipeline immediately. ' +
+              'default is waiting for the uploading.')
+@click.option('--merge-dir', type=str, default=None,
+              help='shared directory to stage the storage blocks partially covered by ' +
+              'the chunk. A block is uploaded once all the parts have arrived, so the ' +
+              'blocks are never downloaded and modified.')
+@click.option('--skip-zero-blocks/--upload-zero-blocks', default=False,
+              help='do not upload the storage blocks with all zero voxels. The skipped ' +
+              'blocks are recorded in the log. The volume should be read with fill missing.')
+@click.option('--quantize-range', type=float, nargs=2, default=None, 
+              callback=default_none,
+              help='value range of chunk mapped to the full range of integer volume, ' +
+              'such as 0 1 for affinity map. The default is from 0 to the chunk maximum.')
 @operator
-def save(tasks, name, volume_path, input_chunk_name, upload_log, create_thumbnail):
+def save(tasks, name, volume_path, input_chunk_name, upload_log, create_thumbnail,
+         write_behind, merge_dir, skip_zero_blocks, quantize_range):
     """Save chunk to volume."""
-    state['operators'][name] = SaveOperator(volume_path,
-                                            state['mip'],
-                                            upload_log=upload_log,
-                                            create_thumbnail=create_thumbnail,
-                                            verbose=state['verbose'],
-                                            name=name)
+    register_operator(name, SaveOperator, volume_path,
+                      state['mip'],
+                      upload_log=upload_log,
+                      create_thumbnail=create_thumbnail,
+                      write_behind=write_behind,
+                      merge_dir=merge_dir,
+                      skip_zero_blocks=skip_zero_blocks,
+                      quantize_range=quantize_range,
+                      verbose=state['verbose'],
+                      name=name)
 
     for task in tasks:
         # we got a special case for handling skip
         if task['skip'] and task['skip_to'] == name:
             task['skip'] = False
+            if skip_zero_blocks:
+                # the zero blocks are only recorded without creating a chunk
+                future = state['operators'][name].save_zeros(
+                    task['bbox'], log=task.get('log', {'timer': {}}))
+                if future is not None:
+                    task.setdefault('pending_uploads', []).append(future)
+                task['output_volume_path'] = volume_path
+                yield task
+                continue
             # create fake chunk to save
             task[input_chunk_name] = state['operators'][name].create_chunk_with_zeros(
                 task['bbox'])
 
         if not task['skip']:
             # the time elapsed was recorded internally
-            state['operators'][name](task[input_chunk_name],
-                                     log=task.get('log', {'timer': {}}))
+            future = state['operators'][name](task[input_chunk_name],
+                                              log=task.get('log', {'timer': {}}))
+            if future is not None:
+                task.setdefault('pending_uploads', []).append(future)
             task['output_volume_path'] = volume_path
         yield task
 
 
+@main.command('flush-merge-buffer')
+@click.option('--name', type=str, default='flush-merge-buffer', 
+              help='name of this operator')
+@click.option('--volume-path', '-v', type=str, required=True, help='volume path')
+@click.option('--merge-dir', type=str, required=True,
+              help='shared directory of the staged storage blocks used by save.')
+@click.option('--skip-zero-blocks/--upload-zero-blocks', default=False,
+              help='do not upload the storage blocks with all zero voxels.')
+@operator
+def flush_merge_buffer(tasks, name, volume_path, merge_dir, skip_zero_blocks):
+    """Write the partial blocks left in the merge buffer of save.
+    
+    The blocks not completed by the tasks, such as the blocks at the boundary of 
+    region of interest, are merged with the existing blocks in the volume. 
+    Run it after all the tasks saving to the volume finished.
+    """
+    register_operator(name, SaveOperator, volume_path,
+                      state['mip'],
+                      upload_log=False,
+                      merge_dir=merge_dir,
+                      skip_zero_blocks=skip_zero_blocks,
+                      verbose=state['verbose'],
+                      name=name)
+    for task in tasks:
+        handle_task_skip(task, name)
+        if not task['skip'] and not state['dry_run']:
+            state['operators'][name].flush()
+        yield task
+
+
 @main.command('channel-voting')
 @click.option('--name', type=str, default='channel-voting', help='name of operator')
 @click.option('--input-chunk-name', type=str, default=DEFAULT_CHUNK_NAME)
@@ -1366,7 +1981,7 @@ def channel_voting(tasks, name, input_chunk_name, output_chunk_name):
 @operator
 def view(tasks, name, image_chunk_name, segmentation_chunk_name):
     """Visualize the chunk using cloudvolume view in browser."""
-    state['operators'][name] = ViewOperator(name=name)
+    register_operator(name, ViewOperator, name=name)
     for task in tasks:
         handle_task_skip(task, name)
         if not task['skip']:
@@ -11,7 +11,7 @@ import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
-pd.set_option('precision', 0)
+pd.set_option('display.precision', 0)
 
 def load_log(log_dir):
     
@@ -1,10 +1,11 @@
 from warnings import warn
 import numpy as np
 
-from cloudvolume import CloudVolume
 from cloudvolume.lib import Bbox
 
 from chunkflow.chunk import Chunk
+from chunkflow.lib.block_cache import BlockCache
+from chunkflow.lib.metadata_cache import ThreadLocalVolume
 from .base import OperatorBase
 
 
@@ -16,6 +17,8 @@ class MaskOperator(OperatorBase):
                  inverse: bool = False,
                  fill_missing: bool = False,
                  check_all_zero=False,
+                 cache_dir: str = None,
+                 cache_size: float = None,
                  verbose: int = 1,
                  name: str = 'mask'):
         super().__init__(name=name, verbose=verbose)
@@ -25,32 +28,64 @@ class MaskOperator(OperatorBase):
         self.inverse = inverse
         self.volume_path = volume_path
         self.check_all_zero = check_all_zero
-
-        self.mask_vol = CloudVolume(volume_path,
-                                    bounded=False,
-                                    fill_missing=fill_missing,
-                                    progress=verbose,
-                                    parallel=1,
-                                    mip=mask_mip)
+        self.fill_missing = fill_missing
+
+        # the volume handle of each thread is reused across tasks 
+        self._mask_vol = ThreadLocalVolume(volume_path,
+                                           bounded=False,
+                                           fill_missing=fill_missing,
+                                           progress=verbose,
+                                           parallel=1,
+                                           mip=mask_mip)
+
+        if cache_dir:
+            # the same mask blocks are normally used by several mask operators
+            # and neighboring tasks. the cache size is in GB.
+            self.block_cache = BlockCache(
+                cache_dir,
+                max_size=None if cache_size is None else int(cache_size * 1e9),
+                verbose=verbose)
+        else:
+            self.block_cache = None
 
         if verbose:
             print(f'build mask operator based on {volume_path} at mip {mask_mip}')
 
-    def __call__(self, x):
+    @property
+    def mask_vol(self):
+        return self._mask_vol.get()
+
+    def __call__(self, x, log=None):
         if self.check_all_zero:
             assert isinstance(x, Bbox)
-            return self.is_all_zero(x)
+            return self.is_all_zero(x, log=log)
         else:
             assert isinstance(x, Chunk)
-            return self.maskout(x)
+            return self.maskout(x, log=log)
+
+    @property
+    def mask_factor(self):
+        """the downsampling factor of mask in z,y,x."""
+        xyfactor = 2**(self.mask_mip - self.chunk_mip)
+        return (1, xyfactor, xyfactor)
 
-    def is_all_zero(self, bbox):
-        mask_in_high_mip = self._read_mask_in_high_mip(bbox)
+    def read_mask(self, chunk_bbox, log=None):
+        """read the mask of a chunk without upsampling.
+
+        The global offset of returned chunk is in the mask mip level.
+        """
+        mask = self._read_mask_in_high_mip(chunk_bbox, log=log)
+        global_offset = tuple(s // f for s, f in zip(
+            chunk_bbox.minpt[-3:], self.mask_factor))
+        return Chunk(mask, global_offset=global_offset)
+
+    def is_all_zero(self, bbox, log=None):
+        mask_in_high_mip = self._read_mask_in_high_mip(bbox, log=log)
         # To-Do: replace with np.array_equiv function
         # return np.array_equiv(mask_in_high_mip, 0)
         return np.alltrue(mask_in_high_mip == 0)
 
-    def maskout(self, chunk):
+    def maskout(self, chunk, log=None):
         if self.verbose:
             print('mask out chunk using {} in mip {}'.format(
                 self.volume_path, self.mask_mip))
@@ -60,7 +95,12 @@ class MaskOperator(OperatorBase):
             return chunk
 
         chunk_bbox = Bbox.from_slices(chunk.slices[-3:])
-        mask_in_high_mip = self._read_mask_in_high_mip(chunk_bbox)
+        mask_in_high_mip = self._read_mask_in_high_mip(chunk_bbox, log=log)
+
+        if not chunk.array.flags.writeable:
+            # the chunk is still uploading, such as by save with write-behind
+            chunk = type(chunk)(np.array(chunk.array), 
+                                global_offset=chunk.global_offset)
 
         if np.alltrue(mask_in_high_mip == 0):
             warn('the mask is all black, mask all the voxels directly')
@@ -97,9 +137,10 @@ class MaskOperator(OperatorBase):
         #    raise ValueError('invalid chunk or mask dimension.')
         return chunk
 
-    def _read_mask_in_high_mip(self, chunk_bbox):
+    def _read_mask_in_high_mip(self, chunk_bbox, log=None):
         """
         chunk_bbox: the bounding box of the chunk in lower mip level
+        log: the task log to record the block cache statistics
         """
         # print("download mask chunk...")
         # make sure that the slices only contains zyx without channel
@@ -129,7 +170,20 @@ class MaskOperator(OperatorBase):
         mask_slices = (chunk_slices[-3], ) + mask_slices
         
         # the slices did not contain the channel dimension
-        mask = self.mask_vol[mask_slices[::-1]]
+        if self.block_cache is None:
+            mask = self.mask_vol[mask_slices[::-1]]
+        else:
+            stats = {}
+            mask = self.block_cache.cutout(
+                self.volume_path, self.mask_mip,
+                Bbox.from_slices(mask_slices[::-1]),
+                self.mask_vol.chunk_size, self.mask_vol.voxel_offset,
+                self.mask_vol.bounds,
+                lambda bbox: self.mask_vol[bbox.to_slices()],
+                self.mask_vol.dtype, num_channels=self.mask_vol.num_channels,
+                stats=stats, fill_missing=self.fill_missing)
+            if log is not None:
+                log.setdefault('block_cache', {})[self.name] = stats
         # this is a cloudvolume VolumeCutout rather than a normal numpy array
         # which will make np.alltrue(mask_in_high_mip == 0) to be
         # VolumeCutout(False) rather than False, so we need to transform it 
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+__doc__ = """
+Overlap-add blending of ConvNet inference outputs across tasks.
+
+In the first pass, each task infers the patches of its own chunk without
+cropping the margin. The core of the task chunk, which is not covered by
+any other task, is normalized and saved directly. The weighted outputs in
+the border of the task chunk and in the margin are saved with the patch
+weight as the last channel, split by the task they belong to. In the
+second pass, each task adds the weighted outputs of itself and its
+neighboring tasks in its border, normalizes the sum by the accumulated
+weight, and fills in the core.
+
+The tasks of both passes should be in a regular grid with the same chunk
+size, such as produced by `generate-tasks`.
+"""
+from io import BytesIO
+from itertools import product
+
+import numpy as np
+
+from cloudvolume.lib import Bbox, Vec
+from cloudvolume.storage import SimpleStorage
+
+from chunkflow.chunk import Chunk
+from .base import OperatorBase
+
+
+class OverlapAddOperator(OperatorBase):
+    """accumulate and finalize the weighted inference outputs.
+
+    Parameters
+    ------------
+    accumulation_path:
+        the storage path of the weighted outputs, such as gs://bucket/path.
+    margin_size:
+        the margin size of the weighted outputs beyond the task chunk in z,y,x.
+        It is half of the output patch overlap if the input chunk was
+        expanded by the half overlap and the difference of input and
+        output patch size.
+    roi_start:
+        the start of the region covered by the tasks in z,y,x.
+    roi_stop:
+        the stop of the region covered by the tasks in z,y,x.
+        The neighboring tasks outside of the region do not exist, and
+        all the other ones should have been accumulated.
+    """
+    def __init__(self, accumulation_path: str, margin_size: tuple = None,
+                 roi_start: tuple = None, roi_stop: tuple = None,
+                 verbose: bool = True, name: str = 'overlap-add'):
+        super().__init__(name=name, verbose=verbose)
+        self.accumulation_path = accumulation_path
+        self.margin_size = None if margin_size is None else Vec(*margin_size)
+        if roi_start is None or roi_stop is None:
+            self.roi = None
+        else:
+            self.roi = Bbox(roi_start, roi_stop)
+
+    def _file_name(self, bbox: Bbox, source: Bbox = None):
+        """the file of a task, or the weighted output of a neighboring task in it."""
+        if source is None:
+            return bbox.to_filename() + '.npz'
+        return f'{bbox.to_filename()}_from_{source.to_filename()}.npy'
+
+    def accumulate(self, chunk: Chunk, bbox: Bbox):
+        """save the weighted output of a task.
+
+        Parameters
+        ------------
+        chunk:
+            the weighted output with the weight as the last channel.
+        bbox:
+            the bounding box of task chunk in z,y,x.
+        """
+        assert chunk.ndim == 4
+        chunk_bbox = Bbox.from_slices(chunk.slices[-3:])
+        margin_size = bbox.minpt - chunk_bbox.minpt
+        assert np.array_equal(chunk_bbox.maxpt - bbox.maxpt, margin_size)
+        core = _core(bbox, margin_size)
+        array = np.asarray(chunk.array)
+        
+        def cutout(region: Bbox):
+            return array[(slice(None), *_slices(region, chunk_bbox.minpt))]
+
+        # only this task covers the core, so it could be normalized now
+        output = cutout(core)
+        output, weight = output[:-1], output[-1]
+        arrays = {'core': np.divide(output, weight, out=np.zeros_like(output),
+                                    where=(weight > 0))}
+        # the border is also covered by the neighboring tasks
+        for piece in _pieces(bbox, core):
+            arrays[piece.to_filename()] = cutout(piece)
+        buf = BytesIO()
+        np.savez(buf, **arrays)
+        files = [(self._file_name(bbox), buf.getvalue())]
+
+        # the margin belongs to the neighboring tasks
+        for neighbor in _neighbors(bbox):
+            overlap = Bbox.intersection(chunk_bbox, neighbor)
+            if overlap.subvoxel():
+                continue
+            buf = BytesIO()
+            np.save(buf, cutout(overlap))
+            files.append((self._file_name(neighbor, source=bbox), buf.getvalue()))
+
+        with SimpleStorage(self.accumulation_path) as storage:
+            storage.put_files(files, content_type='application/octet-stream',
+                              compress='gzip')
+
+    def finalize(self, bbox: Bbox):
+        """add the weighted outputs overlapping with a task and normalize them.
+
+        Parameters
+        ------------
+        bbox:
+            the bounding box of task chunk in z,y,x.
+
+        Returns
+        ---------
+            the normalized output chunk.
+        """
+        assert self.margin_size is not None
+        assert self.roi is not None
+        # the weighted outputs of the neighboring tasks in the task
+        file_bboxes = {}
+        for neighbor in _neighbors(bbox):
+            if Bbox.intersection(neighbor, self.roi).subvoxel():
+                # the task is outside of the volume
+                continue
+            overlap = Bbox.intersection(Bbox(neighbor.minpt - self.margin_size,
+                                             neighbor.maxpt + self.margin_size),
+                                        bbox)
+            if not overlap.subvoxel():
+                file_bboxes[self._file_name(bbox, source=neighbor)] = overlap
+        file_name = self._file_name(bbox)
+
+        with SimpleStorage(self.accumulation_path) as storage:
+            results = storage.get_files([file_name, *file_bboxes.keys()])
+
+        contents = {}
+        for result in results:
+            if result['error'] is not None:
+                raise result['error']
+            if result['content'] is None:
+                raise FileNotFoundError(
+                    f'the weighted output {result["filename"]} does not exist.')
+            contents[result['filename']] = result['content']
+
+        arrays = np.load(BytesIO(contents.pop(file_name)))
+        core = _core(bbox, self.margin_size)
+        core_output = arrays['core']
+        accumulation = np.zeros((core_output.shape[0] + 1, *bbox.size3()),
+                                dtype=core_output.dtype)
+        for piece in _pieces(bbox, core):
+            accumulation[(slice(None), *_slices(piece, bbox.minpt))] += \
+                arrays[piece.to_filename()]
+        for name, content in contents.items():
+            overlap = file_bboxes[name]
+            accumulation[(slice(None), *_slices(overlap, bbox.minpt))] += \
+                np.load(BytesIO(content))
+
+        if self.verbose:
+            print(f'added {len(contents)} weighted outputs of neighboring tasks.')
+
+        output, weight = accumulation[:-1], accumulation[-1]
+        # the voxels without any patch are zero
+        np.divide(output, weight, out=output, where=(weight > 0))
+        output[(slice(None), *_slices(core, bbox.minpt))] = core_output
+        return Chunk(output, global_offset=(0, *bbox.minpt))
+
+
+def _core(bbox: Bbox, margin_size: Vec):
+    """the part of a task not covered by the margin of neighboring tasks."""
+    core = Bbox(bbox.minpt + margin_size, bbox.maxpt - margin_size)
+    assert core.valid(), 'the chunk size should be at least twice of the margin.'
+    return core
+
+
+def _neighbors(bbox: Bbox):
+    """the bounding boxes of the neighboring tasks in the grid."""
+    chunk_size = bbox.size3()
+    for offset in product((-1, 0, 1), repeat=3):
+        if offset != (0, 0, 0):
+            start = bbox.minpt + Vec(*offset) * chunk_size
+            yield Bbox(start, start + chunk_size)
+
+
+def _pieces(bbox: Bbox, core: Bbox):
+    """split the bounding box excluding the core into boxes."""
+    edges = tuple(zip(bbox.minpt, core.minpt, core.maxpt, bbox.maxpt))
+    for index in product(range(3), repeat=3):
+        if index == (1, 1, 1):
+            continue
+        piece = Bbox(tuple(e[i] for e, i in zip(edges, index)),
+                     tuple(e[i + 1] for e, i in zip(edges, index)))
+        if not piece.subvoxel():
+            yield piece
+
+
+def _slices(bbox: Bbox, offset: Vec):
+    """the slices of a bounding box in an array starting from the offset."""
+    return tuple(slice(b - o, e - o) for b, e, o in zip(
+        bbox.minpt, bbox.maxpt, offset))
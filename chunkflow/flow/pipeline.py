@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+__doc__ = """
+Pipelined execution of chained operators.
+
+Each stage evaluates its part of the operator chain in a background thread,
+and the stages are connected by bounded queues. As a result, the I/O heavy
+operators, such as cutout and save, could overlap with the computational
+heavy operators, such as inference.
+
+Multiple workers could also run the task loops concurrently in one process
+and share the same operator instances.
+
+The chunks in a task are released as soon as no downstream operator uses them.
+"""
+from threading import Lock, Thread
+
+from gevent.monkey import get_original
+
+# the queue module was monkey patched by gevent in chunkflow/__init__.py,
+# and the patched queue do not work across real threads.
+Queue = get_original('queue', 'Queue')
+
+
+class _StageEnd(object):
+    """mark the end of a stage stream."""
+    pass
+
+
+class _StageError(object):
+    """wrap the exception raised inside a stage thread."""
+    def __init__(self, exception: BaseException):
+        self.exception = exception
+
+
+def prefetch(stream, queue_depth: int = 1, name: str = 'stage'):
+    """evaluate the upstream tasks in a background thread.
+
+    Parameters
+    ------------
+    stream:
+        the upstream iterable of tasks.
+    queue_depth:
+        the maximum number of finished tasks waiting in the queue.
+        The upstream thread will be blocked if the queue is full.
+    name:
+        the name of the background thread.
+
+    Returns
+    ---------
+        a generator yielding the same tasks in the same order.
+    """
+    assert queue_depth > 0
+    queue = Queue(maxsize=queue_depth)
+
+    def produce():
+        try:
+            for task in stream:
+                queue.put(task)
+            queue.put(_StageEnd())
+        except BaseException as exception:
+            # the exception will be raised again in the consumer thread
+            queue.put(_StageError(exception))
+
+    # use daemon thread, so an unfinished stage will not block exiting
+    thread = Thread(target=produce, name=name, daemon=True)
+    thread.start()
+
+    while True:
+        task = queue.get()
+        if isinstance(task, _StageEnd):
+            break
+        elif isinstance(task, _StageError):
+            raise task.exception
+        else:
+            yield task
+    thread.join()
+
+
+class SharedStream(object):
+    """a task stream shared by multiple workers in different threads."""
+    def __init__(self, stream):
+        self.stream = iter(stream)
+        self.lock = Lock()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        # a generator can not be evaluated in multiple threads at the same time
+        with self.lock:
+            return next(self.stream)
+
+
+def run_workers(stream, pipe, worker_num: int):
+    """run multiple task loops concurrently in this process.
+
+    Parameters
+    ------------
+    stream:
+        the task stream shared by all the workers.
+    pipe:
+        a function to build the task stream of a worker from the shared stream.
+    worker_num:
+        the number of workers.
+    """
+    stream = SharedStream(stream)
+    finished = Queue()
+
+    def work():
+        try:
+            # Evaluate the stream and throw away the items.
+            worker_stream = pipe(stream)
+            if worker_stream:
+                for _ in worker_stream:
+                    pass
+            finished.put(None)
+        except BaseException as exception:
+            finished.put(exception)
+
+    for idx in range(worker_num):
+        Thread(target=work, name=f'worker-{idx}', daemon=True).start()
+
+    for _ in range(worker_num):
+        exception = finished.get()
+        if exception is not None:
+            # stop the process if any of the worker failed
+            raise exception
+
+
+# the parameters of operators referring to the chunks in a task
+INPUT_NAME_PARAMS = ('input_chunk_name', 'image_chunk_name', 
+                     'segmentation_chunk_name', 'groundtruth_chunk_name',
+                     'fragments_chunk_name', 'from_name', 'chunk_name', 
+                     'input_name', 'affinity_map_chunk_name', 
+                     'reference_chunk_name')
+OUTPUT_NAME_PARAMS = ('output_chunk_name', 'output_name', 'to_name')
+
+
+def _chunk_names(params: dict, param_names: tuple):
+    names = set()
+    for param_name in param_names:
+        if params.get(param_name):
+            names.add(params[param_name])
+    if param_names is INPUT_NAME_PARAMS and params.get('chunk_names'):
+        # a list of chunk names separated by comma, such as neuroglancer
+        names.update(params['chunk_names'].split(','))
+    return names
+
+
+def chunk_liveness(operator_params: list):
+    """find the chunks that are not used anymore after each operator.
+
+    The chunks are referred by the chunk name parameters of operators, 
+    such as `input_chunk_name` and `output_chunk_name`. Only the chunks 
+    created by an operator in the pipeline are released.
+
+    Parameters
+    ------------
+    operator_params:
+        the parameter dict of each operator in the pipeline.
+
+    Returns
+    ---------
+        a list of chunk name sets. The chunks could be released after 
+        the operator with the same index.
+    """
+    created = set()
+    last_use = dict()
+    for idx, params in enumerate(operator_params):
+        outputs = _chunk_names(params, OUTPUT_NAME_PARAMS)
+        created.update(outputs)
+        for chunk_name in outputs | _chunk_names(params, INPUT_NAME_PARAMS):
+            last_use[chunk_name] = idx
+    
+    dead_names = [set() for _ in operator_params]
+    for chunk_name, idx in last_use.items():
+        if chunk_name in created:
+            dead_names[idx].add(chunk_name)
+    return dead_names
+
+
+def release_chunks(stream, chunk_names: set):
+    """remove the chunks that are not used anymore from the tasks."""
+    for task in stream:
+        if isinstance(task, dict):
+            for chunk_name in chunk_names:
+                # the chunk might not be created if the task was skipped
+                task.pop(chunk_name, None)
+        yield task
@@ -1,130 +1,520 @@
 import time
 import os
 import json
+from copy import deepcopy
+from itertools import product
 import numpy as np
 
-from cloudvolume import CloudVolume
-from cloudvolume.lib import Vec, Bbox, yellow
+from cloudvolume.lib import Vec, Bbox, yellow, min2
 from cloudvolume.storage import Storage
 
-from chunkflow.lib.igneous.tasks import downsample_and_upload
+from chunkflow.lib.block_cache import _box_cover
+from chunkflow.lib.igneous.downsample_scales import \
+    compute_plane_downsampling_scales
 from chunkflow.chunk import Chunk
+from chunkflow.chunk.pyramid import Pyramid
+from chunkflow.lib.merge_buffer import MergeBuffer, split_aligned
+from chunkflow.lib.metadata_cache import ThreadLocalVolume
+from chunkflow.lib.tracer import tracer
+from chunkflow.lib.write_behind import uploader
 
 from .base import OperatorBase
-from chunkflow.lib.igneous.tasks import downsample_and_upload
-#from .downsample_upload import DownsampleUploadOperator
 
 
 class SaveOperator(OperatorBase):
+    """save chunks to a volume.
+
+    Parameters
+    ------------
+    merge_dir:
+        the shared directory to stage the partial storage blocks. If it is
+        set, only the blocks fully covered by the chunk are uploaded directly, 
+        and the partial blocks are uploaded by the task completing them. 
+        The blocks never completed are written by `flush` after all the 
+        tasks finished. Otherwise, the partial blocks are downloaded and 
+        modified.
+    skip_zero_blocks:
+        do not upload the storage blocks with all zero voxels. The volume 
+        should be read with fill_missing. The skipped blocks fully covered 
+        by the chunk are recorded in the log as `zero_blocks`, so they 
+        could be distinguished from the missing blocks. The existing 
+        blocks in the volume are not deleted.
+    quantize_range:
+        the value range of chunk mapped to the full range of integer volume, 
+        such as (0, 1) for affinity maps. The values outside are clipped. 
+        The default range is from 0 to the maximum value of chunk.
+    """
     def __init__(self,
                  volume_path: str,
                  mip: int,
                  upload_log: bool = True,
                  create_thumbnail: bool = False,
+                 write_behind: bool = False,
+                 merge_dir: str = None,
+                 skip_zero_blocks: bool = False,
+                 quantize_range: tuple = None,
                  verbose: bool = True,
                  name: str = 'save'):
         super().__init__(name=name, verbose=verbose)
         
         self.upload_log = upload_log
         self.create_thumbnail = create_thumbnail
+        self.write_behind = write_behind
         self.mip = mip
         self.verbose = verbose
         self.volume_path = volume_path
+        self.skip_zero_blocks = skip_zero_blocks
+        self.quantize_range = quantize_range
+        
+        # the volumes are opened in the first usage, since they might be 
+        # created by an upstream operator, such as setup-env. Every worker
+        # and uploading thread opens its own handles.
+        self._volume = ThreadLocalVolume(
+            volume_path,
+            fill_missing=True,
+            bounded=False,
+            autocrop=True,
+            mip=mip,
+            cache=False,
+            green_threads=True,
+            progress=verbose)
+        self._thumbnail_volume = ThreadLocalVolume(
+            os.path.join(volume_path, 'thumbnail'),
+            compress='gzip',
+            fill_missing=True,
+            bounded=False,
+            autocrop=True,
+            mip=mip,
+            cache=False,
+            green_threads=True,
+            progress=verbose)
+
+        if merge_dir:
+            self.merge_buffer = MergeBuffer(merge_dir, verbose=verbose)
+        else:
+            self.merge_buffer = None
 
         if upload_log:
             log_path = os.path.join(volume_path, 'log')
             self.log_storage = Storage(log_path)
 
-    def create_chunk_with_zeros(self, bbox, num_channels, dtype):
+    @property
+    def volume(self):
+        return self._volume.get()
+
+    @property
+    def thumbnail_volume(self):
+        return self._thumbnail_volume.get()
+
+    def create_chunk_with_zeros(self, bbox, num_channels=None, dtype=None):
         """Create a fake all zero chunk. 
-        this is used in skip some operation based on mask."""
+        this is used in skip some operation based on mask.
+        The default number of channels and data type follow the volume."""
+        if num_channels is None:
+            num_channels = self.volume.num_channels
+        if dtype is None:
+            dtype = self.volume.dtype
         shape = (num_channels, *bbox.size3())
         arr = np.zeros(shape, dtype=dtype)
         chunk = Chunk(arr, global_offset=(0, *bbox.minpt))
         return chunk
 
     def __call__(self, chunk, log=None):
-        assert isinstance(chunk, Chunk)
+        """save the chunk.
+
+        In write-behind mode, the uploading runs in background, and a future
+        is returned. The future should be waited before the task is finished.
+
+        The chunk could also be a stream of chunks, such as the z slabs of 
+        streaming inference. 
+        """
+        if not isinstance(chunk, Chunk):
+            return self._save_stream(chunk, log)
         if self.verbose:
             print('save chunk.')
         
         start = time.time()
-        
-        # gevent.monkey.patch_all(thread=False)
-        volume = CloudVolume(
-            self.volume_path,
-            fill_missing=True,
-            bounded=False,
-            autocrop=True,
-            mip=self.mip,
-            cache=False,
-            green_threads=True,
-            progress=self.verbose)
 
-        chunk = self._auto_convert_dtype(chunk, volume)
+        if self.write_behind:
+            # the chunk is made readonly instead of copied while uploading, 
+            # and the downstream operators modifying it in place should 
+            # copy it first. The log could be changed, so its snapshot 
+            # is uploaded.
+            chunk.array.flags.writeable = False
+            future = uploader.submit(self._upload, chunk, deepcopy(log), start)
+            if log:
+                log['timer'][self.name] = time.time() - start
+            return future
+        else:
+            self._upload(chunk, log, start)
+
+    def _save_stream(self, chunks, log=None):
+        """save the chunks while the next chunk is producing.
+
+        Each chunk is uploaded in background once it is produced, 
+        and the log is uploaded after all the chunks were saved.
+        The chunks are owned by this operator after they were produced, 
+        so they are made readonly instead of copied. 
+        """
+        start = time.time()
+        futures = []
+        bbox = None
+        # the list is shared by the uploading threads
+        zero_blocks = []
+        for chunk in chunks:
+            assert isinstance(chunk, Chunk)
+            # the producer should not reuse or modify the chunk any more
+            chunk.array.flags.writeable = False
+            futures.append(uploader.submit(self._upload_chunk, chunk, 
+                                           zero_blocks))
+            bbox = chunk.bbox if bbox is None else Bbox.expand(bbox, chunk.bbox)
+
+        if self.write_behind:
+            # the jobs are run in order, so the chunks were all dequeued 
+            # before this job starts, and waiting for them will not deadlock
+            future = uploader.submit(self._finish_stream, futures, bbox, 
+                                     zero_blocks, deepcopy(log), start)
+            if log:
+                log['timer'][self.name] = time.time() - start
+            return future
+        else:
+            self._finish_stream(futures, bbox, zero_blocks, log, start)
+
+    def _finish_stream(self, futures, bbox, zero_blocks, log, start):
+        for future in futures:
+            future.result()
         
-        # transpose czyx to xyzc order
-        arr = np.transpose(chunk.array)
-        volume[chunk.slices[::-1]] = arr
+        if log:
+            log['timer'][self.name] = time.time() - start
+            self._log_zero_blocks(log, zero_blocks)
+
+        if self.upload_log and bbox is not None:
+            with tracer.span('upload-log', category=self.name):
+                self._upload_log(log, bbox)
+
+    def _upload_chunk(self, chunk, zero_blocks: list = None):
+        # the encoding of blocks happens inside CloudVolume while uploading
+        for slab, arr in self._convert_slabs(chunk):
+            with tracer.span('upload', category=self.name):
+                if self.merge_buffer is None and not self.skip_zero_blocks:
+                    self.volume[slab.slices[::-1]] = arr
+                else:
+                    self._upload_blocks(slab, arr, zero_blocks)
         
         if self.create_thumbnail:
-            self._create_thumbnail(chunk)
+            with tracer.span('thumbnail', category=self.name):
+                self._create_thumbnail(chunk)
+
+    def _upload_blocks(self, chunk, arr, zero_blocks: list = None):
+        """upload the chunk block by block.
+        
+        The fully covered blocks are uploaded directly, and the partial 
+        blocks are staged in the merge buffer if there is one.
+        """
+        volume = self.volume
+        # the coordinates follow the xyz order of volume
+        offset = Vec(*chunk.global_offset[::-1][:3])
+        bounds = volume.bounds
+        bbox = Bbox.intersection(Bbox(offset, offset + Vec(*arr.shape[:3])), 
+                                 bounds)
+        if bbox.subvoxel():
+            return
+
+        if self.merge_buffer is None:
+            self._write(bbox, arr[_slices(bbox, offset)], zero_blocks)
+            return
+
+        aligned_bbox, partial_bboxes = split_aligned(
+            bbox, volume.chunk_size, volume.voxel_offset, bounds)
+        if aligned_bbox is not None:
+            self._write(aligned_bbox, arr[_slices(aligned_bbox, offset)], 
+                        zero_blocks)
+
+        merged_num = 0
+        for block_bbox in partial_bboxes:
+            part_bbox = Bbox.intersection(block_bbox, bbox)
+            block = self.merge_buffer.stage(
+                self.volume_path, self.mip, block_bbox, part_bbox,
+                arr[_slices(part_bbox, offset)])
+            if block is not None:
+                # all the parts have arrived
+                self._write(block_bbox, block, zero_blocks)
+                merged_num += 1
+        
+        if self.verbose:
+            print(f'staged {len(partial_bboxes)} partial blocks, ' +
+                  f'and uploaded {merged_num} merged blocks.')
+
+    def _write(self, bbox, arr, zero_blocks: list = None):
+        """write a region inside the volume bounds, and skip the all zero 
+        blocks if needed."""
+        volume = self.volume
+        if not self.skip_zero_blocks:
+            volume[bbox.to_slices()] = arr
+            return
+
+        grid_shape, block_bbox_of = self._block_grid(bbox)
+        nonzero = np.zeros(grid_shape, dtype=bool)
+        for grid_index in product(*(range(s) for s in grid_shape)):
+            block_bbox = block_bbox_of(grid_index)
+            region = Bbox.intersection(block_bbox, bbox)
+            if np.any(arr[_slices(region, bbox.minpt)]):
+                nonzero[grid_index] = True
+            elif region == block_bbox and zero_blocks is not None:
+                # the partial blocks are not recorded, since the other 
+                # part of the block might not be zero
+                zero_blocks.append(block_bbox.to_filename())
+
+        if self.verbose:
+            print(f'skip {nonzero.size - np.count_nonzero(nonzero)} ' + 
+                  f'all zero blocks in {nonzero.size} blocks.')
+
+        # upload the nonzero blocks in a few boxes
+        for grid_start_index, grid_stop_index in _box_cover(nonzero):
+            region = Bbox.intersection(Bbox(
+                block_bbox_of(grid_start_index).minpt,
+                block_bbox_of(tuple(i - 1 for i in grid_stop_index)).maxpt), bbox)
+            volume[region.to_slices()] = arr[_slices(region, bbox.minpt)]
+
+    def _block_grid(self, bbox):
+        """the grid of storage blocks covering a region in the volume.
+
+        Returns
+        ---------
+            the grid shape, and a function returning the bounding box of 
+            the block at a grid index.
+        """
+        volume = self.volume
+        block_size = Vec(*volume.chunk_size)
+        voxel_offset = Vec(*volume.voxel_offset)
+        # the grid index of blocks covering the region
+        grid_start = (bbox.minpt - voxel_offset) // block_size
+        grid_stop = (bbox.maxpt - voxel_offset - 1) // block_size + 1
+
+        def block_bbox_of(grid_index):
+            start = voxel_offset + (grid_start + Vec(*grid_index)) * block_size
+            # the last block could be smaller
+            return Bbox.intersection(Bbox(start, start + block_size), 
+                                     volume.bounds)
+
+        return tuple(grid_stop - grid_start), block_bbox_of
+
+    def save_zeros(self, bbox, log=None):
+        """save an all zero chunk for a task skipped by an upstream operator.
+
+        Only used with skip_zero_blocks. The chunk is not created. The blocks 
+        fully covered by the bounding box are recorded in the log as 
+        `zero_blocks`, and the zero parts of partial blocks are staged if 
+        there is a merge buffer. The thumbnail is not created, since it is 
+        also read with fill_missing.
+
+        Parameters
+        ------------
+        bbox:
+            the bounding box of the task in z,y,x.
+        """
+        assert self.skip_zero_blocks
+        start = time.time()
+        if self.write_behind:
+            future = uploader.submit(self._save_zeros, bbox, deepcopy(log), start)
+            if log:
+                log['timer'][self.name] = time.time() - start
+            return future
+        else:
+            self._save_zeros(bbox, log, start)
+
+    def _save_zeros(self, bbox, log, start):
+        volume = self.volume
+        # the coordinates follow the xyz order of volume
+        region = Bbox.intersection(Bbox(bbox.minpt[::-1], bbox.maxpt[::-1]), 
+                                   volume.bounds)
+        zero_blocks = []
+        if not region.subvoxel():
+            grid_shape, block_bbox_of = self._block_grid(region)
+            for grid_index in product(*(range(s) for s in grid_shape)):
+                block_bbox = block_bbox_of(grid_index)
+                if Bbox.intersection(block_bbox, region) == block_bbox:
+                    zero_blocks.append(block_bbox.to_filename())
+
+        if self.merge_buffer is not None and not region.subvoxel():
+            _, partial_bboxes = split_aligned(
+                region, volume.chunk_size, volume.voxel_offset, volume.bounds)
+            channel_shape = (volume.num_channels,) if volume.num_channels > 1 else ()
+            for block_bbox in partial_bboxes:
+                # the other parts of the block might not be zero
+                part_bbox = Bbox.intersection(block_bbox, region)
+                block = self.merge_buffer.stage(
+                    self.volume_path, self.mip, block_bbox, part_bbox,
+                    np.zeros((*part_bbox.size3(), *channel_shape), 
+                             dtype=volume.dtype))
+                if block is not None:
+                    self._write(block_bbox, block, zero_blocks)
+
+        if log:
+            log['timer'][self.name] = time.time() - start
+            self._log_zero_blocks(log, zero_blocks)
+
+        if self.upload_log:
+            with tracer.span('upload-log', category=self.name):
+                self._upload_log(log, bbox)
+
+    def flush(self):
+        """write the partial blocks left in the merge buffer.
+
+        The existing voxels of a block outside of the staged parts are kept,
+        so the block is downloaded, modified and uploaded. 
+
+        Returns
+        ---------
+            the number of flushed blocks.
+        """
+        if self.merge_buffer is None:
+            return 0
+
+        def merge(block_bbox, parts):
+            block = np.array(self.volume[block_bbox.to_slices()])
+            for part_bbox, part in parts:
+                region = block[_slices(part_bbox, block_bbox.minpt)]
+                # the part of 3D chunk do not have the channel axis 
+                region[...] = part.reshape(region.shape)
+            with tracer.span('upload', category=self.name):
+                self._write(block_bbox, block)
+        
+        return self.merge_buffer.flush(self.volume_path, self.mip, merge)
+
+    def _log_zero_blocks(self, log, zero_blocks):
+        if self.skip_zero_blocks:
+            # the block file names of volume in xyz order 
+            log['zero_blocks'] = sorted(zero_blocks)
+
+    def _upload(self, chunk, log, start):
+        zero_blocks = []
+        self._upload_chunk(chunk, zero_blocks)
 
         # add timer for save operation itself
         if log:
             log['timer'][self.name] = time.time() - start
+            self._log_zero_blocks(log, zero_blocks)
 
         if self.upload_log:
-            self._upload_log(log, chunk.bbox)
+            with tracer.span('upload-log', category=self.name):
+                self._upload_log(log, chunk.bbox)
+
+    def _convert_slabs(self, chunk):
+        """convert the data type to fit volume datatype.
 
-    def _auto_convert_dtype(self, chunk, volume):
-        """convert the data type to fit volume datatype"""
-        if volume.dtype != chunk.dtype:
+        The chunk is converted in z slabs aligned with the storage blocks, 
+        and a slab is uploaded before converting the next one, so only the 
+        buffers of one slab are allocated instead of the whole chunk.
+
+        Returns
+        ---------
+            a generator of the converted slabs and their arrays in xyzc order.
+        """
+        volume = self.volume
+        if volume.dtype == chunk.dtype:
+            # transpose czyx to xyzc order
+            yield chunk, np.transpose(chunk.array)
+            return
+
+        if self.verbose:
             print(yellow(f'converting chunk data type {chunk.dtype} ' + 
                          f'to volume data type: {volume.dtype}'))
-            # float_chunk = chunk.astype(np.float64)
-            # chunk = float_chunk / np.iinfo(chunk.dtype).max * np.iinfo(self.volume.dtype).max
-            chunk = chunk / chunk.array.max() * np.iinfo(volume.dtype).max
-            return chunk.astype(volume.dtype)
+        dtype = np.dtype(volume.dtype)
+        if np.issubdtype(dtype, np.integer):
+            if self.quantize_range is None:
+                low, high = 0, chunk.array.max()
+            else:
+                low, high = self.quantize_range
+            iinfo = np.iinfo(dtype)
+            scale = iinfo.max / (high - low) if high > low else 0.
         else:
-            return chunk
+            scale = None
+
+        block_z = volume.chunk_size[2]
+        z_offset = volume.voxel_offset[2]
+        z_start = chunk.global_offset[-3]
+        z_stop = z_start + chunk.shape[-3]
+        buffer = None
+        temp = None
+        while z_start < z_stop:
+            # the next block boundary in z
+            z_end = min((z_start - z_offset) // block_z * block_z + 
+                        z_offset + block_z, z_stop)
+            with tracer.span('convert', category=self.name):
+                z_slice = slice(z_start - chunk.global_offset[-3],
+                                z_end - chunk.global_offset[-3])
+                arr = chunk.array[..., z_slice, :, :]
+                if buffer is None or buffer.shape != arr.shape:
+                    buffer = np.empty(arr.shape, dtype=dtype)
+                    temp = None if scale is None else np.empty(
+                        arr.shape, dtype=np.float32)
+                if scale is None:
+                    np.copyto(buffer, arr, casting='unsafe')
+                else:
+                    np.subtract(arr, low, out=temp, casting='unsafe')
+                    temp *= scale
+                    np.clip(temp, 0, iinfo.max, out=temp)
+                    np.copyto(buffer, temp, casting='unsafe')
+            slab = Chunk(buffer, global_offset=(
+                *chunk.global_offset[:-3], z_start, *chunk.global_offset[-2:]))
+            yield slab, np.transpose(buffer)
+            z_start = z_end
 
     def _create_thumbnail(self, chunk):
         if self.verbose:
             print('creating thumbnail...')
 
-        thumbnail_layer_path = os.path.join(self.volume_path, 'thumbnail')
-        thumbnail_volume = CloudVolume(
-            thumbnail_layer_path,
-            compress='gzip',
-            fill_missing=True,
-            bounded=False,
-            autocrop=True,
-            mip=self.mip,
-            cache=False,
-            green_threads=True,
-            progress=self.verbose)
+        thumbnail_volume = self.thumbnail_volume
 
         # only use the last channel, it is the Z affinity
         # if this is affinitymap
-        image = chunk[-1, :, :, :]
-        if np.issubdtype(image.dtype, np.floating):
-            image = (image * 255).astype(np.uint8)
+        if chunk.ndim == 4:
+            chunk = Chunk(chunk.array[-1, :, :, :], 
+                          global_offset=chunk.global_offset[-3:])
+        
+        level = self._thumbnail_level(chunk)
+        if level <= 0:
+            print(yellow('no downsampled mip level in thumbnail volume.'))
+            return
+        thumbnail_mip = self.mip + level
+
+        # the pyramid is shared with downsample-upload of the same chunk
+        pyramid = Pyramid.from_chunk(chunk)
+        image = pyramid[level]
         
-        #self.thumbnail_operator(image)
-        # transpose to xyzc
-        image = np.transpose(image)
-        image_bbox = Bbox.from_slices(chunk.slices[::-1][:3])
-
-        downsample_and_upload(image,
-                              image_bbox,
-                              thumbnail_volume,
-                              Vec(*(image.shape)),
-                              mip=self.mip,
-                              max_mip=6,
-                              axis='z',
-                              skip_first=True,
-                              only_last_mip=True)
+        # the quantization is only applied to the last mip level
+        if np.issubdtype(image.dtype, np.floating):
+            image = Chunk((image.array * 255).astype(np.uint8), 
+                          global_offset=image.global_offset)
+
+        # the thumbnail volume handle is not shared by other threads
+        thumbnail_volume.mip = thumbnail_mip
+        thumbnail_volume[image.slices[::-1]] = np.transpose(image.array)
+
+    def _thumbnail_level(self, chunk):
+        """the number of downsampling levels of the thumbnail.
+
+        The levels are chosen in the same way with the igneous downsampling.
+        The chunk is downsampled until it is smaller than the underlying 
+        block size of the next mip level, and the thumbnail is at most mip 6.
+        """
+        thumbnail_volume = self.thumbnail_volume
+        size = min2(thumbnail_volume.mip_volume_size(self.mip), 
+                    Vec(*chunk.shape[::-1][:3]))
+        if self.mip + 1 in thumbnail_volume.available_mips:
+            underlying_mip = self.mip + 1
+        else:
+            underlying_mip = self.mip
+        underlying_shape = thumbnail_volume.mip_underlying(
+            underlying_mip).astype(np.float32)
+        # z is not downsampled
+        underlying_shape[2] = float('inf')
+        scales = compute_plane_downsampling_scales(
+            size=size, preserve_axis='z', 
+            max_downsampled_size=int(min(*underlying_shape)))
+        # the first scale is the chunk itself
+        return len(scales[:max(6 - self.mip, 0)]) - 1
 
     def _upload_log(self, log, output_bbox):
         assert log
@@ -138,3 +528,9 @@ class SaveOperator(OperatorBase):
                                   '.json',
                                   content=json.dumps(log),
                                   content_type='application/json')
+
+
+def _slices(bbox: Bbox, offset: Vec):
+    """the slices of a bounding box in an array starting from the offset."""
+    return tuple(slice(b - o, e - o) for b, e, o in zip(
+        bbox.minpt, bbox.maxpt, offset))
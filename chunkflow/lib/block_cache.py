@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+__doc__ = """
+Persistent block cache in local disk.
+
+The storage blocks of a volume are saved as numpy files in a local directory,
+and keyed by the layer path, mip level and the block coordinates.
+The neighboring tasks with overlapping margins could read the shared blocks
+from local disk instead of downloading them again.
+
+The cache directory could be shared by multiple processes in a computer.
+The block files are written atomically, and the least recently used blocks
+are evicted if the total size exceeds the limit. The cache directory is only
+scanned after a process wrote a fraction of the limit, so the total size 
+could exceed the limit by this fraction for each process.
+"""
+import os
+import re
+import fcntl
+from threading import Lock
+from tempfile import NamedTemporaryFile
+from itertools import product
+
+import numpy as np
+
+from cloudvolume.lib import Bbox, Vec
+
+# the fraction of the maximum size written before scanning the cache 
+# directory, and evicted below the maximum size in a scan
+_EVICTION_FRACTION = 0.1
+
+
+class BlockCache(object):
+    """local disk cache of storage blocks with LRU eviction.
+
+    Parameters
+    ------------
+    cache_dir:
+        the local directory to store the blocks.
+    max_size:
+        the maximum total size of cached blocks in bytes.
+        The cache is not bounded if it is None.
+    verbose:
+        print the cache status or not.
+    """
+    def __init__(self, cache_dir: str, max_size: int = None,
+                 verbose: bool = False):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_size = max_size
+        self.verbose = verbose
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.lock_file = os.path.join(self.cache_dir, '.lock')
+        # the bytes written since the last scan. The cache directory 
+        # is scanned in the first eviction, since it might be full already.
+        self._written_size = None
+        self.lock = Lock()
+
+    def _block_file(self, layer_path: str, mip: int, block_bbox: Bbox):
+        # the layer path contains protocol and slashes, such as gs://bucket/path
+        layer_dir = re.sub(r'[^\w.-]+', '_', layer_path).strip('_')
+        return os.path.join(self.cache_dir, layer_dir, str(mip),
+                            block_bbox.to_filename() + '.npy')
+
+    def get(self, layer_path: str, mip: int, block_bbox: Bbox):
+        """read a block from cache. return None if it is not cached."""
+        file_name = self._block_file(layer_path, mip, block_bbox)
+        try:
+            block = np.load(file_name)
+            # refresh the modification time as the last usage time
+            os.utime(file_name)
+        except (FileNotFoundError, ValueError, OSError):
+            # the block was not cached, evicted by another process,
+            # or partially written by a killed process.
+            return None
+        return block
+
+    def put(self, layer_path: str, mip: int, block_bbox: Bbox, block: np.ndarray):
+        """save a block to cache."""
+        file_name = self._block_file(layer_path, mip, block_bbox)
+        block_dir = os.path.dirname(file_name)
+        os.makedirs(block_dir, exist_ok=True)
+        # write to a temporal file first, so other processes never read
+        # a partially written block
+        with NamedTemporaryFile(dir=block_dir, suffix='.tmp', delete=False) as f:
+            np.save(f, np.asarray(block))
+            size = f.tell()
+        os.replace(f.name, file_name)
+        with self.lock:
+            if self._written_size is not None:
+                self._written_size += size
+
+    def evict(self):
+        """remove the least recently used blocks if the cache is too large."""
+        if self.max_size is None:
+            return
+        
+        with self.lock:
+            if self._written_size is not None and \
+                    self._written_size < self.max_size * _EVICTION_FRACTION:
+                return
+            self._written_size = 0
+
+        with open(self.lock_file, 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # another process is evicting
+                return
+            try:
+                self._evict()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _evict(self):
+        files = []
+        total_size = 0
+        for root, _, file_names in os.walk(self.cache_dir):
+            for file_name in file_names:
+                if not file_name.endswith('.npy'):
+                    continue
+                file_name = os.path.join(root, file_name)
+                try:
+                    stat = os.stat(file_name)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, file_name))
+                total_size += stat.st_size
+
+        if total_size <= self.max_size:
+            return
+
+        # evict a bit more to avoid evicting in every task
+        target_size = self.max_size * (1 - _EVICTION_FRACTION)
+        if self.verbose:
+            print(f'evict block cache from {total_size} bytes to {target_size} bytes')
+        for _, size, file_name in sorted(files):
+            try:
+                os.remove(file_name)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+            if total_size <= target_size:
+                break
+
+    def cutout(self, layer_path: str, mip: int, bbox: Bbox,
+               block_size: Vec, voxel_offset: Vec, bounds: Bbox,
+               download, dtype, num_channels: int = 1, stats: dict = None,
+               fill_missing: bool = False):
+        """cutout a region using the cached blocks.
+
+        The coordinates follow the order of the volume, such as xyz in
+        CloudVolume. The blocks not cached are downloaded and cached.
+
+        Parameters
+        ------------
+        layer_path:
+            the path of the volume layer.
+        mip:
+            the mip level of volume.
+        bbox:
+            the bounding box to cutout.
+        block_size:
+            the storage block size of the volume.
+        voxel_offset:
+            the start of the block grid.
+        bounds:
+            the bounding box of the volume. The region outside is filled
+            with zeros.
+        download:
+            a function to download a bounding box aligned with the blocks
+            and return an array with a trailing channel dimension.
+        dtype:
+            the data type of volume.
+        num_channels:
+            the number of channels of volume.
+        stats:
+            a dict to accumulate the hit/miss number of blocks and the
+            number of bytes read from the cache.
+        fill_missing:
+            the download function fills the missing blocks with zeros. 
+            The all zero blocks are not cached, since the missing blocks 
+            might be written later.
+
+        Returns
+        ---------
+            an array with the size of bbox and a trailing channel dimension.
+        """
+        if stats is None:
+            stats = {}
+        for key in ('hits', 'misses', 'bytes_saved'):
+            stats.setdefault(key, 0)
+
+        block_size = Vec(*block_size)
+        voxel_offset = Vec(*voxel_offset)
+        output = np.zeros((*bbox.size3(), num_channels), dtype=dtype)
+
+        # the region inside the volume
+        inner_bbox = Bbox.intersection(bbox, bounds)
+        if inner_bbox.subvoxel():
+            return output
+
+        # the grid index of blocks covering the region
+        grid_start = (inner_bbox.minpt - voxel_offset) // block_size
+        grid_stop = (inner_bbox.maxpt - voxel_offset - 1) // block_size + 1
+        grid_shape = tuple(grid_stop - grid_start)
+
+        def block_bbox_of(grid_index):
+            start = voxel_offset + (grid_start + Vec(*grid_index)) * block_size
+            block_bbox = Bbox(start, start + block_size)
+            # the last block could be smaller
+            return Bbox.intersection(block_bbox, bounds)
+
+        def paste(block, block_bbox):
+            region = Bbox.intersection(block_bbox, bbox)
+            output[_slices(region, bbox.minpt)] = block[_slices(region, block_bbox.minpt)]
+
+        missing = np.zeros(grid_shape, dtype=bool)
+        for grid_index in product(*(range(s) for s in grid_shape)):
+            block_bbox = block_bbox_of(grid_index)
+            block = self.get(layer_path, mip, block_bbox)
+            if block is None:
+                missing[grid_index] = True
+            else:
+                stats['hits'] += 1
+                stats['bytes_saved'] += block.nbytes
+                paste(block, block_bbox)
+
+        miss_num = int(np.count_nonzero(missing))
+        stats['misses'] += miss_num
+        for grid_start_index, grid_stop_index in _box_cover(missing):
+            region_bbox = Bbox(block_bbox_of(grid_start_index).minpt,
+                               block_bbox_of(tuple(i - 1 for i in grid_stop_index)).maxpt)
+            region = np.asarray(download(region_bbox))
+            if region.ndim == 3:
+                region = region[..., np.newaxis]
+
+            for grid_index in product(*(range(a, b) for a, b in zip(
+                    grid_start_index, grid_stop_index))):
+                block_bbox = block_bbox_of(grid_index)
+                block = region[_slices(block_bbox, region_bbox.minpt)]
+                if not fill_missing or block.any():
+                    self.put(layer_path, mip, block_bbox, block)
+                paste(block, block_bbox)
+
+        if miss_num > 0:
+            self.evict()
+
+        if self.verbose:
+            print(f'block cache hits: {missing.size - miss_num}, misses: {miss_num}')
+        return output
+
+
+def _slices(bbox: Bbox, offset: Vec):
+    """the slices of a bounding box in an array starting from the offset."""
+    return tuple(slice(b - o, e - o) for b, e, o in zip(
+        bbox.minpt, bbox.maxpt, offset))
+
+
+def _box_cover(mask: np.ndarray):
+    """cover the true voxels in a boolean array with boxes greedily.
+
+    Returns
+    ---------
+        a list of start and stop indexes of the boxes.
+    """
+    mask = np.copy(mask)
+    boxes = []
+    for index in zip(*np.nonzero(mask)):
+        if not mask[index]:
+            # already covered by previous box
+            continue
+        start = list(index)
+        stop = [i + 1 for i in index]
+        # grow the box along each axis from the last one
+        for axis in reversed(range(mask.ndim)):
+            while stop[axis] < mask.shape[axis]:
+                grown = tuple(slice(b, e) if a != axis else slice(e, e+1)
+                              for a, (b, e) in enumerate(zip(start, stop)))
+                if not np.all(mask[grown]):
+                    break
+                stop[axis] += 1
+        mask[tuple(slice(b, e) for b, e in zip(start, stop))] = False
+        boxes.append((tuple(start), tuple(stop)))
+    return boxes
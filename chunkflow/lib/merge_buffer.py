@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+__doc__ = """
+Merge buffer of partial storage blocks in a shared directory.
+
+Writing a region not aligned with the storage blocks of a volume needs to
+download, modify and upload the boundary blocks, and the neighboring tasks
+writing the same block could overwrite each other. Instead, the region is
+split into the blocks fully covered, which could be uploaded directly, and
+the partial blocks. The partial blocks are staged in the merge directory,
+and a block is assembled by the task contributing the last part of it.
+The blocks never completed, such as the blocks at the boundary of a region
+of interest smaller than the volume, are flushed after all the tasks
+finished, and their parts are merged into the existing blocks.
+
+The merge directory could be shared by multiple processes in a computer,
+or in a cluster using a network file system supporting file locks.
+"""
+import os
+import re
+import fcntl
+import shutil
+from tempfile import NamedTemporaryFile
+from itertools import product
+
+import numpy as np
+
+from cloudvolume.lib import Bbox, Vec
+
+
+class MergeBuffer(object):
+    """stage the partial storage blocks and assemble the completed ones.
+
+    Parameters
+    ------------
+    merge_dir:
+        the shared directory to stage the partial blocks.
+    verbose:
+        print the merging status or not.
+    """
+    def __init__(self, merge_dir: str, verbose: bool = False):
+        self.merge_dir = os.path.expanduser(merge_dir)
+        self.verbose = verbose
+        os.makedirs(self.merge_dir, exist_ok=True)
+
+    def _mip_dir(self, layer_path: str, mip: int):
+        # the layer path contains protocol and slashes, such as gs://bucket/path
+        layer_dir = re.sub(r'[^\w.-]+', '_', layer_path).strip('_')
+        return os.path.join(self.merge_dir, layer_dir, str(mip))
+
+    def _block_dir(self, layer_path: str, mip: int, block_bbox: Bbox):
+        return os.path.join(self._mip_dir(layer_path, mip),
+                            block_bbox.to_filename())
+
+    def _load_parts(self, block_dir: str):
+        part_bboxes = [Bbox.from_filename(file_name[:-len('.npy')])
+                       for file_name in os.listdir(block_dir)
+                       if file_name.endswith('.npy')]
+        for part_bbox in part_bboxes:
+            yield part_bbox, np.load(os.path.join(
+                block_dir, part_bbox.to_filename() + '.npy'))
+
+    def stage(self, layer_path: str, mip: int, block_bbox: Bbox,
+              bbox: Bbox, part: np.ndarray):
+        """stage a part of block, and assemble the block if it is completed.
+
+        The parts of a block should not overlap with each other. Staging
+        the same part again, such as in a retried task, replaces it.
+
+        Parameters
+        ------------
+        layer_path:
+            the path of the volume layer.
+        mip:
+            the mip level of volume.
+        block_bbox:
+            the bounding box of block inside the volume bounds.
+        bbox:
+            the bounding box of the part.
+        part:
+            the array of the part with the size of bbox.
+
+        Returns
+        ---------
+            the assembled block if all the parts have arrived, otherwise None.
+        """
+        block_dir = self._block_dir(layer_path, mip, block_bbox)
+        os.makedirs(os.path.dirname(block_dir), exist_ok=True)
+        # the lock file is kept, so all the processes lock the same file
+        with open(block_dir + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                os.makedirs(block_dir, exist_ok=True)
+                # write to a temporal file first, so the block is never
+                # assembled with a partially written part
+                with NamedTemporaryFile(dir=block_dir, suffix='.tmp',
+                                        delete=False) as f:
+                    np.save(f, np.asarray(part))
+                os.replace(f.name, os.path.join(
+                    block_dir, bbox.to_filename() + '.npy'))
+
+                part_bboxes = [Bbox.from_filename(file_name[:-len('.npy')])
+                               for file_name in os.listdir(block_dir)
+                               if file_name.endswith('.npy')]
+                voxel_num = sum(b.volume() for b in part_bboxes)
+                if self.verbose:
+                    print(f'staged {len(part_bboxes)} parts of block {block_bbox}.')
+                if voxel_num < block_bbox.volume():
+                    return None
+
+                block = np.zeros((*block_bbox.size3(), *part.shape[3:]),
+                                 dtype=part.dtype)
+                for part_bbox, array in self._load_parts(block_dir):
+                    region = block[_slices(part_bbox, block_bbox.minpt)]
+                    # a single channel part might not have the channel axis
+                    region[...] = array.reshape(region.shape)
+                shutil.rmtree(block_dir)
+                return block
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def flush(self, layer_path: str, mip: int, merge: callable):
+        """merge the parts of the blocks never completed, and clean up.
+
+        This should only run after all the tasks staging parts have finished.
+
+        Parameters
+        ------------
+        layer_path:
+            the path of the volume layer.
+        mip:
+            the mip level of volume.
+        merge:
+            the function merging the parts into a block, such as reading the
+            block from volume, modifying and writing it back. It is called
+            with the block bounding box and a list of part bounding boxes
+            and arrays.
+
+        Returns
+        ---------
+            the number of flushed blocks.
+        """
+        mip_dir = self._mip_dir(layer_path, mip)
+        if not os.path.isdir(mip_dir):
+            return 0
+
+        block_num = 0
+        for file_name in sorted(os.listdir(mip_dir)):
+            block_dir = os.path.join(mip_dir, file_name)
+            if not os.path.isdir(block_dir):
+                continue
+            with open(block_dir + '.lock', 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    # the block might be assembled by a running task
+                    if os.path.isdir(block_dir):
+                        merge(Bbox.from_filename(file_name),
+                              list(self._load_parts(block_dir)))
+                        shutil.rmtree(block_dir)
+                        block_num += 1
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+        # the lock files of all the blocks are not needed any more
+        shutil.rmtree(mip_dir)
+        if self.verbose:
+            print(f'flushed {block_num} partial blocks.')
+        return block_num
+
+
+def split_aligned(bbox: Bbox, block_size: Vec, voxel_offset: Vec, bounds: Bbox):
+    """split a region into the blocks fully covered and the partial blocks.
+
+    The blocks are clipped by the volume bounds, so the blocks at the
+    volume boundary are fully covered if the region reaches the bounds.
+
+    Parameters
+    ------------
+    bbox:
+        the bounding box of region inside the volume bounds.
+    block_size:
+        the storage block size of the volume.
+    voxel_offset:
+        the start of the block grid.
+    bounds:
+        the bounding box of the volume.
+
+    Returns
+    ---------
+        the bounding box of the fully covered blocks or None, and a list
+        of the bounding boxes of partial blocks.
+    """
+    block_size = Vec(*block_size)
+    voxel_offset = Vec(*voxel_offset)
+
+    # round the region inward to the block grid except the volume bounds
+    start = -((voxel_offset - bbox.minpt) // block_size) * block_size + voxel_offset
+    stop = (bbox.maxpt - voxel_offset) // block_size * block_size + voxel_offset
+    start = Vec(*(b if b == s else a for a, b, s in zip(
+        start, bbox.minpt, bounds.minpt)))
+    stop = Vec(*(b if b == s else a for a, b, s in zip(
+        stop, bbox.maxpt, bounds.maxpt)))
+    if np.all(start < stop):
+        aligned_bbox = Bbox(start, stop)
+    else:
+        aligned_bbox = None
+
+    # the blocks intersecting with the region
+    grid_start = (bbox.minpt - voxel_offset) // block_size
+    grid_stop = (bbox.maxpt - voxel_offset - 1) // block_size + 1
+    partial_bboxes = []
+    for grid_index in product(*(range(a, b) for a, b in zip(grid_start, grid_stop))):
+        block_start = voxel_offset + Vec(*grid_index) * block_size
+        block_bbox = Bbox.intersection(
+            Bbox(block_start, block_start + block_size), bounds)
+        if aligned_bbox is None or \
+                Bbox.intersection(block_bbox, aligned_bbox).subvoxel():
+            partial_bboxes.append(block_bbox)
+    return aligned_bbox, partial_bboxes
+
+
+def _slices(bbox: Bbox, offset: Vec):
+    """the slices of a bounding box in an array starting from the offset."""
+    return tuple(slice(b - o, e - o) for b, e, o in zip(
+        bbox.minpt, bbox.maxpt, offset))
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+__doc__ = """
+Process-wide cache of volume metadata.
+
+The info and provenance files of a volume are fetched only once and
+shared by all the operators and tasks in a process. The cached metadata
+could expire after a time-to-live, and could also be persisted in local
+disk to be shared by multiple processes. The volume handles using the
+cached metadata could be opened for each thread.
+"""
+import os
+import re
+import json
+from copy import deepcopy
+from time import time
+from threading import Lock, local
+from tempfile import NamedTemporaryFile
+
+from cloudvolume import CloudVolume
+from cloudvolume.storage import SimpleStorage
+
+
+class MetadataCache(object):
+    """cache the metadata files of volumes, such as info and provenance.
+
+    Parameters
+    ------------
+    ttl:
+        time to live in seconds. The metadata never expires if it is None.
+    cache_dir:
+        the local directory to persist the metadata.
+        The metadata is only cached in memory if it is None.
+    """
+    def __init__(self, ttl: float = None, cache_dir: str = None):
+        self.entries = {}
+        self.lock = Lock()
+        self.configure(ttl=ttl, cache_dir=cache_dir)
+
+    def configure(self, ttl: float = None, cache_dir: str = None):
+        self.ttl = ttl
+        if cache_dir:
+            cache_dir = os.path.expanduser(cache_dir)
+            os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+
+    def _is_fresh(self, timestamp: float):
+        return self.ttl is None or time() - timestamp < self.ttl
+
+    def _cache_file(self, layer_path: str, key: str):
+        # the layer path contains protocol and slashes, such as gs://bucket/path
+        layer_dir = re.sub(r'[^\w.-]+', '_', layer_path).strip('_')
+        return os.path.join(self.cache_dir, layer_dir, key + '.json')
+
+    def get(self, layer_path: str, key: str = 'info'):
+        """get a metadata file of a volume.
+
+        return None if the file does not exist.
+        """
+        with self.lock:
+            if (layer_path, key) in self.entries:
+                timestamp, value = self.entries[(layer_path, key)]
+                if self._is_fresh(timestamp):
+                    return value
+
+        value = self._load(layer_path, key)
+        if value is None:
+            value = SimpleStorage(layer_path).get_json(key)
+            self._dump(layer_path, key, value)
+
+        with self.lock:
+            self.entries[(layer_path, key)] = (time(), value)
+        return value
+
+    def _load(self, layer_path: str, key: str):
+        if not self.cache_dir:
+            return None
+        file_name = self._cache_file(layer_path, key)
+        try:
+            if not self._is_fresh(os.path.getmtime(file_name)):
+                return None
+            with open(file_name) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _dump(self, layer_path: str, key: str, value):
+        if not self.cache_dir or value is None:
+            return
+        file_name = self._cache_file(layer_path, key)
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        # write to a temporal file first, so other processes never read
+        # a partially written file
+        with NamedTemporaryFile(mode='w', dir=os.path.dirname(file_name),
+                                suffix='.tmp', delete=False) as f:
+            json.dump(value, f)
+        os.replace(f.name, file_name)
+
+    def invalidate(self, layer_path: str):
+        """remove the cached metadata of a volume, such as after updating it."""
+        with self.lock:
+            for key in [k for k in self.entries if k[0] == layer_path]:
+                del self.entries[key]
+        if self.cache_dir:
+            for key in ('info', 'provenance'):
+                file_name = self._cache_file(layer_path, key)
+                if os.path.exists(file_name):
+                    os.remove(file_name)
+
+
+# the global metadata cache shared by all the operators
+metadata_cache = MetadataCache()
+
+
+def open_volume(volume_path: str, **kwargs):
+    """construct a CloudVolume using the cached metadata.
+
+    The volume handle is supposed to be reused across tasks.
+    The other parameters are passed to CloudVolume.
+    """
+    info = metadata_cache.get(volume_path, 'info')
+    provenance = metadata_cache.get(volume_path, 'provenance')
+    # CloudVolume could modify the info, such as adding a new scale
+    return CloudVolume(volume_path,
+                       info=deepcopy(info),
+                       provenance=deepcopy(provenance) if provenance else {},
+                       **kwargs)
+
+
+class ThreadLocalVolume(object):
+    """open a volume handle for each thread using the cached metadata.
+
+    A CloudVolume handle, especially with green threads, should not be 
+    shared by the worker and uploader threads. The handle of a thread is 
+    opened in its first usage, and reused across tasks.
+    The parameters are passed to `open_volume`.
+    """
+    def __init__(self, volume_path: str, **kwargs):
+        self.volume_path = volume_path
+        self.kwargs = kwargs
+        self._local = local()
+
+    def get(self):
+        """the volume handle of the current thread."""
+        volume = getattr(self._local, 'volume', None)
+        if volume is None:
+            volume = open_volume(self.volume_path, **self.kwargs)
+            self._local.volume = volume
+        return volume
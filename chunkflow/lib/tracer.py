@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+__doc__ = """
+Structured span tracing.
+
+A span records the wall-clock time of an operator on a task, or a step
+inside an operator, such as the ConvNet forward pass. The spans could be
+exported as a Chrome trace JSON file, and viewed in chrome://tracing or
+https://ui.perfetto.dev to see where the time goes in a worker.
+
+The tracing is disabled by default, and a disabled span costs nearly nothing.
+"""
+import os
+import json
+from time import perf_counter
+from threading import Lock, current_thread, get_ident
+from contextlib import contextmanager
+
+
+class Tracer(object):
+    """collect spans from all the threads of this process."""
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.thread_names = {}
+        self.lock = Lock()
+        # all the timestamps are relative to this start time
+        self.start = perf_counter()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def clear(self):
+        with self.lock:
+            self.events = []
+            self.thread_names = {}
+
+    def now(self):
+        """current time in seconds for the start and stop of spans."""
+        return perf_counter()
+
+    def add_span(self, name: str, start: float, stop: float,
+                 category: str = 'chunkflow', **args):
+        """record a finished span.
+
+        Parameters
+        ------------
+        name:
+            the name of span, such as the operator name.
+        start:
+            start time from the :meth:`now` function.
+        stop:
+            stop time from the :meth:`now` function.
+        category:
+            the category of span, such as operator or inference.
+        args:
+            extra information shown with the span, such as the bounding box.
+        """
+        if not self.enabled:
+            return
+
+        thread_id = get_ident()
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            # chrome trace use microseconds
+            'ts': (start - self.start) * 1e6,
+            'dur': (stop - start) * 1e6,
+            'pid': os.getpid(),
+            'tid': thread_id,
+        }
+        if args:
+            event['args'] = args
+
+        with self.lock:
+            self.events.append(event)
+            if thread_id not in self.thread_names:
+                self.thread_names[thread_id] = current_thread().name
+
+    @contextmanager
+    def span(self, name: str, category: str = 'chunkflow', **args):
+        """record the time of a code block as a span.
+
+        Example
+        ---------
+            with tracer.span('forward', category='inference'):
+                output = model(input)
+        """
+        if not self.enabled:
+            yield
+            return
+
+        start = self.now()
+        try:
+            yield
+        finally:
+            self.add_span(name, start, self.now(), category=category, **args)
+
+    def to_chrome_trace(self):
+        """the spans in Chrome trace event format."""
+        with self.lock:
+            events = list(self.events)
+            thread_names = dict(self.thread_names)
+
+        pid = os.getpid()
+        metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+                     'args': {'name': thread_name}}
+                    for tid, thread_name in thread_names.items()]
+        return {'traceEvents': metadata + events, 'displayTimeUnit': 'ms'}
+
+    def export(self, file_name: str):
+        """write the spans to a Chrome trace JSON file."""
+        with open(file_name, 'w') as f:
+            json.dump(self.to_chrome_trace(), f)
+
+
+# the global tracer shared by all the operators
+tracer = Tracer()
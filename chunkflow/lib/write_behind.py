@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+__doc__ = """
+Write-behind uploading in background threads.
+
+The uploading jobs are put into a bounded queue and run by a pool of
+background threads, so the pipeline could continue to process the next task
+while the results are uploading. Each job returns a future, which could be
+waited before the task is marked as finished, such as deleting the task
+in the queue.
+"""
+from concurrent.futures import Future, wait
+from threading import Lock, Thread
+
+from gevent.monkey import get_original
+
+# the queue module was monkey patched by gevent in chunkflow/__init__.py,
+# and the patched queue do not work across real threads.
+Queue = get_original('queue', 'Queue')
+
+
+class WriteBehindUploader(object):
+    """run uploading jobs in background threads.
+
+    Parameters
+    ------------
+    worker_num:
+        the number of uploading threads.
+    queue_depth:
+        the maximum number of jobs waiting in the queue. Submitting a new job
+        will be blocked if the queue is full, so the finished chunks waiting
+        for uploading will not use up the RAM.
+    """
+    def __init__(self, worker_num: int = 2, queue_depth: int = 4):
+        self.configure(worker_num=worker_num, queue_depth=queue_depth)
+        self.threads = []
+        self.futures = set()
+        self.lock = Lock()
+
+    def configure(self, worker_num: int = 2, queue_depth: int = 4):
+        assert worker_num > 0
+        assert queue_depth > 0
+        self.worker_num = worker_num
+        self.queue_depth = queue_depth
+
+    def _start(self):
+        # the threads are started in the first submission, so the uploader
+        # could be configured before using it.
+        self.queue = Queue(maxsize=self.queue_depth)
+        for idx in range(self.worker_num):
+            thread = Thread(target=self._work, name=f'uploader-{idx}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _work(self):
+        while True:
+            future, func, args, kwargs = self.queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(func(*args, **kwargs))
+            except BaseException as exception:
+                future.set_exception(exception)
+
+    def submit(self, func, *args, **kwargs):
+        """run the function in background and return a future."""
+        with self.lock:
+            if not self.threads:
+                self._start()
+            future = Future()
+            self.futures.add(future)
+        future.add_done_callback(self._discard)
+        self.queue.put((future, func, args, kwargs))
+        return future
+
+    def _discard(self, future):
+        # only keep the futures of running and failed jobs, 
+        # so the exception will be raised while draining.
+        if future.cancelled() or future.exception() is None:
+            with self.lock:
+                self.futures.discard(future)
+
+    def drain(self):
+        """wait for all the submitted jobs, and raise the exception if any job failed."""
+        with self.lock:
+            futures = list(self.futures)
+        done, _ = wait(futures)
+        for future in done:
+            # raise the exception in the job
+            future.result()
+
+
+def wait_uploads(task: dict):
+    """wait for the write-behind uploads of a task to finish.
+
+    The exception of a failed upload is raised, so the task will not be
+    marked as finished.
+    """
+    for future in task.pop('pending_uploads', []):
+        future.result()
+
+
+# the global uploader shared by all the operators
+uploader = WriteBehindUploader()
@@ -8,4 +8,14 @@ from chunkflow.chunk.affinity_map import AffinityMap
 def test_affinity_map_construction():
     arr = np.random.rand(3,3,4,5).astype(np.float32)
     aff = AffinityMap(arr, global_offset=(0, -1,-1,-1))
- 
+
+
+def test_evaluate():
+    reference = np.random.rand(3, 4, 5, 6).astype(np.float32)
+    arr = reference.copy()
+    arr[0, 0, 0, 0] = 1 - arr[0, 0, 0, 0]
+    aff = AffinityMap(arr)
+    report = aff.evaluate(reference, threshold=0.5)
+    assert np.isclose(report['max_abs_error'], 
+                      abs(1 - 2 * reference[0, 0, 0, 0]))
+    assert report['flipped_ratio'] == 1 / arr.size
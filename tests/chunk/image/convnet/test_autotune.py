@@ -0,0 +1,37 @@
+import pytest
+
+from chunkflow.chunk.image.convnet.autotune import autotune, is_compatible
+
+
+def test_is_compatible():
+    assert is_compatible((4, 16, 16), (2, 8, 8), (2, 8, 8))
+    # the crop margin should not be smaller than the patch overlap
+    assert not is_compatible((4, 16, 16), (2, 8, 8), (2, 4, 4))
+    # the patch overlap should be smaller than the patch size
+    assert not is_compatible((4, 16, 16), (4, 8, 8), (4, 8, 8))
+
+
+def test_autotune():
+    print('\ntest autotune of inference configuration...')
+    best, results = autotune(
+        [1, 4], [(2, 8, 8), (0, 0, 0), (4, 8, 8)], [None],
+        patch_num=(2, 2, 2), repeats=1, verbose=False,
+        convnet_model=None, convnet_weight_path=None,
+        input_patch_size=(4, 16, 16), num_output_channels=2, 
+        framework='identity')
+
+    # the incompatible patch overlap is not benchmarked
+    assert len(results) == 2 * 2
+    assert best in results
+    assert best['voxels_per_second'] == max(
+        r['voxels_per_second'] for r in results)
+    for result in results:
+        assert result['output_crop_margin'] == result['output_patch_overlap']
+        assert result['peak_memory'] > 0
+
+    # the memory limit excludes all the configurations
+    with pytest.raises(ValueError):
+        autotune([1], [(2, 8, 8)], [None], patch_num=(2, 2, 2), repeats=1,
+                 max_memory=0, verbose=False,
+                 convnet_model=None, convnet_weight_path=None,
+                 input_patch_size=(4, 16, 16), framework='identity')
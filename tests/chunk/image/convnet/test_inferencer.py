@@ -1,4 +1,9 @@
+import os
+import shutil
+import tempfile
+
 import numpy as np
+from chunkflow.chunk.image.convnet import inferencer as inferencer_module
 from chunkflow.chunk.image.convnet.inferencer import Inferencer
 from chunkflow.chunk.image.convnet.patch.identity import Identity
 from chunkflow.chunk import Chunk
@@ -138,3 +143,281 @@ def test_non_aligned_input_chunk():
 
     # some of the image voxel is 0, the test can only work with rtol=1
     np.testing.assert_allclose(image, output, rtol=1e-5, atol=1e-5)
+
+
+def test_many_small_patches():
+    print('\ntest block inference with many small patches...')
+    input_patch_size = (4, 16, 16)
+    output_patch_overlap = (2, 8, 8)
+    # a lot of patches with batch size not dividing the patch number
+    input_size = (14, 80, 88)
+
+    image = np.random.randint(1, 255, size=input_size, dtype=np.uint8)
+    image = Chunk(image)
+    with Inferencer(None, None,
+                    input_patch_size,
+                    num_output_channels=2,
+                    output_patch_overlap=output_patch_overlap,
+                    input_size=input_size,
+                    framework='identity',
+                    dtype='float32',
+                    batch_size=7) as inferencer:
+        output = inferencer(image)
+
+    # the blended output should be the same with the input
+    # excluding the cropped margin
+    image = image[2:-2, 8:-8, 8:-8].astype(np.float32) / 255
+    np.testing.assert_allclose(output[0, :, :, :], image, rtol=1e-4, atol=1e-4)
+
+
+def test_output_chunk_mask_cache():
+    print('\ntest output chunk mask cache...')
+    input_patch_size = (4, 16, 16)
+    output_patch_overlap = (2, 8, 8)
+    input_size = (11, 45, 51)
+    mask_cache_dir = tempfile.mkdtemp()
+
+    def infer(offset):
+        image = np.random.randint(1, 255, size=input_size, dtype=np.uint8)
+        image = Chunk(image, global_offset=offset)
+        output = inferencer(image)
+        image = image.astype(np.float32) / 255
+        np.testing.assert_allclose(output[0, :, :, :], image, rtol=1e-5, atol=1e-5)
+        # the mask follows the global offset of the output
+        assert inferencer.output_chunk_mask.global_offset == offset
+    
+    with Inferencer(None, None, input_patch_size,
+                    num_output_channels=1,
+                    output_patch_overlap=output_patch_overlap,
+                    framework='identity',
+                    batch_size=3,
+                    mask_output_chunk=True,
+                    mask_cache_dir=mask_cache_dir) as inferencer:
+        # the mask should be reused in the following task
+        infer((0, 0, 0))
+        mask = inferencer.output_chunk_mask.array
+        infer((11, 45, 51))
+        assert inferencer.output_chunk_mask.array is mask
+   
+    # the mask was saved and memory mapped
+    assert len(os.listdir(mask_cache_dir)) == 1
+    # the bump function is part of the mask file name
+    assert os.listdir(mask_cache_dir)[0].startswith('output_chunk_mask_wu_')
+    assert isinstance(mask, np.memmap)
+    assert not mask.flags.writeable
+    shutil.rmtree(mask_cache_dir)
+
+
+def test_output_chunk_mask_cache_eviction():
+    print('\ntest output chunk mask cache eviction...')
+    with Inferencer(None, None, (4, 16, 16),
+                    num_output_channels=1,
+                    output_patch_overlap=(2, 8, 8),
+                    framework='identity',
+                    mask_output_chunk=True) as inferencer:
+        # every chunk size has its own mask
+        for size_z in range(6, 12):
+            inferencer(Chunk.create(size=(size_z, 32, 32), dtype=np.float32))
+            assert len(inferencer_module._output_chunk_masks) <= \
+                inferencer_module._OUTPUT_CHUNK_MASK_CACHE_SIZE
+
+
+def test_double_buffer():
+    print('\ntest double buffered inference...')
+    input_patch_size = (4, 16, 16)
+    output_patch_overlap = (2, 8, 8)
+    input_size = (11, 45, 51)
+    image = np.random.randint(1, 255, size=input_size, dtype=np.uint8)
+    image = Chunk(image, global_offset=(1, 2, 3))
+
+    outputs = []
+    for double_buffer in (False, True):
+        with Inferencer(None, None, input_patch_size,
+                        num_output_channels=2,
+                        output_patch_overlap=output_patch_overlap,
+                        framework='identity',
+                        batch_size=4,
+                        double_buffer=double_buffer,
+                        mask_output_chunk=True) as inferencer:
+            outputs.append(inferencer(image))
+    
+    # the result should be the same with sequential inference
+    np.testing.assert_array_equal(outputs[0], outputs[1])
+    assert outputs[0].global_offset == outputs[1].global_offset
+
+
+def test_skip_patches():
+    print('\ntest skipping patches...')
+    input_patch_size = (4, 16, 16)
+    output_patch_overlap = (2, 8, 8)
+    input_size = (11, 45, 51)
+    image = np.random.randint(1, 255, size=input_size, dtype=np.uint8)
+    # the patches in the black region should be skipped
+    image[:, :20, :] = 0
+    image = Chunk(image, global_offset=(0, 10, 20))
+
+    # the mask is downsampled in XY plane, only keep x < 26 in the chunk
+    mask = np.zeros((11, 23, 26), dtype=bool)
+    mask[:, :, :13] = True
+    mask = Chunk(mask, global_offset=(0, 5, 10))
+
+    log = {}
+    with Inferencer(None, None, input_patch_size,
+                    num_output_channels=1,
+                    output_patch_overlap=output_patch_overlap,
+                    framework='identity',
+                    batch_size=4,
+                    mask_output_chunk=True) as inferencer:
+        output = inferencer(image, mask=mask, mask_factor=(1, 2, 2), log=log)
+
+    assert log['inference']['skipped_patches'] > 0
+    assert log['inference']['executed_patches'] > 0
+    assert log['inference']['skipped_patches'] + log['inference']['executed_patches'] \
+        == len(inferencer.input_patch_offsets)
+
+    output = output[0, :, :, :]
+    image = image.astype(np.float32) / 255
+    # all the patches covering the region inside the mask were executed
+    np.testing.assert_allclose(output[:, :, :26], image[:, :, :26], 
+                               rtol=1e-5, atol=1e-5)
+    # no patch executed in the region far away from the mask
+    assert np.all(output[:, :, 26+16:] == 0)
+
+
+def test_any_nonzero():
+    array = np.random.rand(12, 20, 24) > 0.999
+    starts = np.random.randint(0, 10, size=(50, 3))
+    stops = starts + np.random.randint(0, 12, size=(50, 3))
+    expected = [array[z:sz, y:sy, x:sx].any() for (z, y, x), (sz, sy, sx) 
+                in zip(starts.tolist(), stops.tolist())]
+    np.testing.assert_array_equal(
+        inferencer_module._any_nonzero(array, starts, stops), expected)
+
+
+def test_out_of_core():
+    print('\ntest out-of-core inference...')
+    input_patch_size = (4, 16, 16)
+    output_patch_overlap = (2, 8, 8)
+    # a different size to avoid reusing the cached output chunk mask
+    input_size = (12, 47, 53)
+    image = np.random.randint(1, 255, size=input_size, dtype=np.uint8)
+    image = Chunk(image)
+    scratch_dir = tempfile.mkdtemp()
+
+    with Inferencer(None, None, input_patch_size,
+                    num_output_channels=2,
+                    output_patch_overlap=output_patch_overlap,
+                    framework='identity',
+                    batch_size=4,
+                    mask_output_chunk=True,
+                    scratch_dir=scratch_dir) as inferencer:
+        output = inferencer(image)
+
+    assert isinstance(output.array, np.memmap)
+    assert isinstance(inferencer.output_chunk_mask.array, np.memmap)
+    # the scratch files were removed automatically
+    assert len(os.listdir(scratch_dir)) == 0
+
+    image = image.astype(np.float32) / 255
+    np.testing.assert_allclose(output[0, :, :, :], image, rtol=1e-5, atol=1e-5)
+    shutil.rmtree(scratch_dir)
+
+
+def test_infer_slabs():
+    print('\ntest streaming inference in z slabs...')
+    input_patch_size = (4, 16, 16)
+    output_patch_overlap = (2, 8, 8)
+    image = np.random.randint(1, 255, size=(18, 40, 48), dtype=np.uint8)
+    image[:6, ...] = 0
+    image = Chunk(image, global_offset=(3, 0, 8))
+    slab_size = 4
+
+    for mask_output_chunk in (True, False):
+        with Inferencer(None, None, input_patch_size,
+                        num_output_channels=2,
+                        output_patch_overlap=output_patch_overlap,
+                        input_size=None if mask_output_chunk else image.shape,
+                        framework='identity',
+                        batch_size=3,
+                        mask_output_chunk=mask_output_chunk) as inferencer:
+            expected = inferencer(image)
+            slabs = list(inferencer.infer_slabs(image, slab_size))
+
+        assert len(slabs) > 1
+        z = expected.global_offset[1]
+        for slab in slabs:
+            # the slabs are continuous and aligned with slab size
+            assert slab.global_offset[1] == z
+            assert slab.global_offset[2:] == expected.global_offset[2:]
+            if z != expected.global_offset[1]:
+                assert z % slab_size == 0
+            z += slab.shape[1]
+        assert z == expected.global_offset[1] + expected.shape[1]
+
+        output = np.concatenate([slab.array for slab in slabs], axis=1)
+        np.testing.assert_allclose(output, expected.array, rtol=1e-6, atol=1e-6)
+
+
+def test_infer_slabs_interleaved():
+    print('\ntest interleaved streaming inference of chunks...')
+    input_patch_size = (4, 16, 16)
+    output_patch_overlap = (2, 8, 8)
+    image1 = Chunk(np.random.randint(1, 255, size=(18, 40, 48), dtype=np.uint8),
+                   global_offset=(3, 0, 8))
+    image2 = Chunk(np.random.randint(1, 255, size=(10, 24, 32), dtype=np.uint8))
+
+    with Inferencer(None, None, input_patch_size,
+                    num_output_channels=2,
+                    output_patch_overlap=output_patch_overlap,
+                    framework='identity',
+                    batch_size=3,
+                    mask_output_chunk=True) as inferencer:
+        expected1 = inferencer(image1)
+        expected2 = inferencer(image2)
+        
+        slabs = []
+        for slab in inferencer.infer_slabs(image1, 4):
+            # the lock is not held while the slab is consumed, so another 
+            # chunk could be inferred meanwhile
+            np.testing.assert_allclose(inferencer(image2).array, expected2.array)
+            slabs.append(slab)
+        
+        output = np.concatenate([slab.array for slab in slabs], axis=1)
+        np.testing.assert_allclose(output, expected1.array, rtol=1e-6, atol=1e-6)
+
+
+class RawIdentity(Identity):
+    """normalize the raw input patch by itself."""
+    accepts_raw_input = True
+
+    def __call__(self, input_patch):
+        assert input_patch.dtype == np.uint8
+        return super().__call__(input_patch / 255)
+
+
+def test_input_normalization():
+    print('\ntest input normalization...')
+    input_patch_size = (4, 16, 16)
+    output_patch_overlap = (2, 8, 8)
+    image = np.random.randint(1, 255, size=(10, 40, 48), dtype=np.uint8)
+    image = Chunk(image)
+
+    with Inferencer(None, None, input_patch_size,
+                    num_output_channels=1,
+                    output_patch_overlap=output_patch_overlap,
+                    framework='identity',
+                    batch_size=3,
+                    mask_output_chunk=True) as inferencer:
+        # the input patches are normalized while gathering
+        output = inferencer(image)
+        assert inferencer.input_patch_buffer.dtype == np.float32
+        
+        # the input patches are passed to the backend directly
+        inferencer.patch_inferencer = RawIdentity(
+            None, None, input_patch_size, output_patch_overlap)
+        raw_output = inferencer(image)
+        assert inferencer.input_patch_buffer.dtype == np.uint8
+
+    np.testing.assert_allclose(output.array, raw_output.array, rtol=1e-6, atol=1e-6)
+    image = image.astype(np.float32) / 255
+    np.testing.assert_allclose(output[0, :, :, :], image, rtol=1e-5, atol=1e-5)
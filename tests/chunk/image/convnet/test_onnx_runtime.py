@@ -0,0 +1,59 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pytest
+
+from chunkflow.chunk import Chunk
+from chunkflow.chunk.image.convnet.inferencer import Inferencer
+
+onnx = pytest.importorskip('onnx')
+pytest.importorskip('onnxruntime')
+from onnx import helper, numpy_helper, TensorProto
+
+
+def create_model(file_name: str, batch_size=None):
+    """a convolution copying the input to two output channels."""
+    weight = numpy_helper.from_array(
+        np.ones((2, 1, 1, 1, 1), dtype=np.float32), name='weight')
+    graph = helper.make_graph(
+        [helper.make_node('Conv', ['input', 'weight'], ['output'])],
+        'copy',
+        [helper.make_tensor_value_info(
+            'input', TensorProto.FLOAT, [batch_size or 'batch', 1, None, None, None])],
+        [helper.make_tensor_value_info(
+            'output', TensorProto.FLOAT, [batch_size or 'batch', 2, None, None, None])],
+        initializer=[weight])
+    # use an old IR version supported by old onnxruntime
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid('', 13)],
+                              ir_version=7)
+    onnx.save(model, file_name)
+
+
+def test_onnx_runtime():
+    print('\ntest onnx runtime inference...')
+    model_dir = tempfile.mkdtemp()
+    input_patch_size = (4, 16, 16)
+    output_patch_overlap = (2, 8, 8)
+    image = Chunk(np.random.randint(1, 255, size=(11, 45, 51), dtype=np.uint8))
+
+    def infer(framework, convnet_model):
+        with Inferencer(convnet_model, None, input_patch_size,
+                        num_output_channels=2,
+                        output_patch_overlap=output_patch_overlap,
+                        framework=framework,
+                        framework_options={'num_threads': 1} if framework == 'onnx' else None,
+                        batch_size=3,
+                        mask_output_chunk=True) as inferencer:
+            return inferencer(image)
+
+    expected = infer('identity', None)
+    # the model with dynamic batch size and static batch size
+    for batch_size in (None, 2):
+        model_file = os.path.join(model_dir, f'model-{batch_size}.onnx')
+        create_model(model_file, batch_size=batch_size)
+        output = infer('onnx', model_file)
+        np.testing.assert_allclose(output, expected, rtol=1e-5, atol=1e-5)
+
+    shutil.rmtree(model_dir)
@@ -0,0 +1,122 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pytest
+
+from chunkflow.lib import load_source
+from chunkflow.chunk import Chunk
+from chunkflow.chunk.affinity_map import AffinityMap
+from chunkflow.chunk.image.convnet.inferencer import Inferencer
+from chunkflow.chunk.image.convnet.patch.base import available_cpu_count
+
+torch = pytest.importorskip('torch')
+
+MODEL_SOURCE = """
+import torch
+
+class Net(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.conv = torch.nn.Conv3d(1, 2, 3, padding=1)
+        self.norm = torch.nn.BatchNorm3d(2)
+
+    def forward(self, x):
+        return torch.sigmoid(self.norm(self.conv(x)))
+
+InstantiatedModel = Net()
+"""
+
+
+def create_model(model_dir):
+    model_file = os.path.join(model_dir, 'model.py')
+    with open(model_file, 'w') as f:
+        f.write(MODEL_SOURCE)
+    weight_file = os.path.join(model_dir, 'weight.chkpt')
+    net = load_source(model_file).InstantiatedModel
+    # the batch statistics would be different with the running statistics
+    net.norm.running_mean += 0.1
+    torch.save(net.state_dict(), weight_file)
+    return model_file, weight_file
+
+
+def test_pytorch_cpu_batch():
+    print('\ntest pytorch inference with batch size larger than 1 in cpu...')
+    model_dir = tempfile.mkdtemp()
+    model_file, weight_file = create_model(model_dir)
+
+    input_patch_size = (4, 16, 16)
+    output_patch_overlap = (2, 8, 8)
+    image = Chunk(np.random.randint(1, 255, size=(11, 45, 51), dtype=np.uint8))
+
+    outputs = []
+    logs = []
+    for batch_size, jit in ((1, None), (4, None), (4, 'trace')):
+        log = {}
+        with Inferencer(model_file, weight_file, input_patch_size,
+                        num_output_channels=2,
+                        output_patch_overlap=output_patch_overlap,
+                        framework='pytorch',
+                        framework_options={'jit': jit, 'num_threads': 1},
+                        batch_size=batch_size,
+                        mask_output_chunk=True) as inferencer:
+            outputs.append(inferencer(image, log=log))
+        logs.append(log)
+
+    # the model runs in evaluation mode, so the batch do not matter
+    np.testing.assert_allclose(outputs[0], outputs[1], rtol=1e-5, atol=1e-5)
+    np.testing.assert_allclose(outputs[0], outputs[2], rtol=1e-5, atol=1e-5)
+    assert torch.get_num_threads() == 1
+
+    # the forward passes are recorded for every batch
+    patch_num = logs[0]['inference']['executed_patches']
+    assert logs[0]['inference']['batches'] == patch_num
+    assert logs[1]['inference']['batches'] == (patch_num + 3) // 4
+    assert logs[1]['inference']['forward_time'] > 0
+    shutil.rmtree(model_dir)
+
+
+def test_pytorch_quantized():
+    print('\ntest int8 quantized pytorch inference...')
+    model_dir = tempfile.mkdtemp()
+    model_file, weight_file = create_model(model_dir)
+    input_patch_size = (4, 16, 16)
+    output_patch_overlap = (2, 8, 8)
+    image = Chunk(np.random.randint(1, 255, size=(11, 45, 51), dtype=np.uint8))
+
+    calibration_file = os.path.join(model_dir, 'calibration.h5')
+    image.to_h5(calibration_file)
+    quantized_options = {'calibration_batches': 2, 'jit': 'trace',
+                         'calibration_file': calibration_file}
+
+    outputs = []
+    for framework, options in (
+            ('pytorch', {}), 
+            ('pytorch-quantized', quantized_options),
+            ('pytorch-quantized', quantized_options)):
+        with Inferencer(model_file, weight_file, input_patch_size,
+                        num_output_channels=2,
+                        output_patch_overlap=output_patch_overlap,
+                        framework=framework,
+                        framework_options=options,
+                        batch_size=4,
+                        mask_output_chunk=True) as inferencer:
+            # the quantization was calibrated while loading the model
+            outputs.append(inferencer(image))
+            if framework == 'pytorch-quantized':
+                assert inferencer.compute_device.endswith('int8')
+
+    report = AffinityMap.from_chunk(outputs[1]).evaluate(outputs[0])
+    assert 0 < report['max_abs_error'] < 0.05
+    assert report['flipped_ratio'] < 0.01
+    # the scales are the same in all the workers
+    np.testing.assert_array_equal(outputs[1].array, outputs[2].array)
+    shutil.rmtree(model_dir)
+
+
+def test_available_cpu_count(monkeypatch):
+    assert available_cpu_count() >= 1
+    # the CPU affinity is not supported in macOS and Windows
+    monkeypatch.delattr(os, 'sched_getaffinity')
+    assert available_cpu_count() == os.cpu_count()
@@ -0,0 +1,90 @@
+import os
+import shutil
+import socket
+import tempfile
+from threading import Thread
+
+import numpy as np
+import pytest
+
+from chunkflow.chunk import Chunk
+from chunkflow.chunk.image.convnet.inferencer import Inferencer
+from chunkflow.chunk.image.convnet.server import InferenceServer
+
+
+def test_inference_server():
+    print('\ntest inference server shared by multiple pipelines...')
+    input_patch_size = (4, 16, 16)
+    output_patch_overlap = (2, 8, 8)
+    input_size = (11, 45, 51)
+    socket_dir = tempfile.mkdtemp()
+    socket_path = os.path.join(socket_dir, 'inference.sock')
+
+    def create_server():
+        return InferenceServer(
+            socket_path, 'identity', None, None, batch_size=16, max_latency=0.01,
+            input_patch_size=input_patch_size, output_patch_size=input_patch_size,
+            output_patch_overlap=output_patch_overlap, num_output_channels=2,
+            dtype='float32', bump='wu')
+
+    # the socket file left by a previous server is removed
+    stale_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale_socket.bind(socket_path)
+    stale_socket.close()
+
+    server = create_server()
+    server_thread = Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    while server.listener is None:
+        pass
+
+    def create_inferencer(framework, convnet_model):
+        return Inferencer(convnet_model, None, input_patch_size,
+                          num_output_channels=2,
+                          output_patch_overlap=output_patch_overlap,
+                          framework=framework,
+                          batch_size=2,
+                          mask_output_chunk=True)
+
+    images = [Chunk(np.random.randint(1, 255, size=input_size, dtype=np.uint8))
+              for _ in range(3)]
+    outputs = [None] * len(images)
+
+    def run_pipeline(idx):
+        with create_inferencer('remote', socket_path) as inferencer:
+            outputs[idx] = inferencer(images[idx])
+
+    pipelines = [Thread(target=run_pipeline, args=(idx,))
+                 for idx in range(len(images))]
+    for pipeline in pipelines:
+        pipeline.start()
+    for pipeline in pipelines:
+        pipeline.join()
+
+    # the result should be the same with local inference
+    with create_inferencer('identity', None) as inferencer:
+        for image, output in zip(images, outputs):
+            np.testing.assert_allclose(output, inferencer(image), 
+                                       rtol=1e-6, atol=1e-6)
+
+    # the patches of pipelines were batched together
+    assert server.stats['requests'] == server.stats['patches'] // 2
+    assert server.stats['batches'] < server.stats['requests']
+
+    # the pipeline should use the same patch geometry with server
+    with pytest.raises(ValueError):
+        Inferencer(socket_path, None, (4, 32, 32),
+                   num_output_channels=2,
+                   output_patch_overlap=output_patch_overlap,
+                   framework='remote',
+                   mask_output_chunk=True)
+
+    # another server should not take over the socket of a running server
+    with pytest.raises(RuntimeError):
+        create_server().serve_forever()
+    assert os.path.exists(socket_path)
+
+    server.close()
+    server_thread.join()
+    assert not os.path.exists(socket_path)
+    shutil.rmtree(socket_dir)
@@ -0,0 +1,57 @@
+import shutil
+import tempfile
+
+import numpy as np
+from cloudvolume import CloudVolume
+
+from chunkflow.chunk import Chunk
+from chunkflow.chunk.pyramid import Pyramid
+
+
+def test_pyramid():
+    image = Chunk.create(size=(4, 64, 64), dtype=np.uint8,
+                         voxel_offset=(2, 32, 32))
+    pyramid = Pyramid.from_chunk(image)
+    # the pyramid is cached with the chunk
+    assert Pyramid.from_chunk(image) is pyramid
+    assert len(pyramid.levels) == 1
+
+    level = pyramid[2]
+    assert len(pyramid.levels) == 3
+    assert level.shape == (4, 16, 16)
+    assert level.global_offset == (2, 8, 8)
+    # average pooling from the previous level
+    np.testing.assert_array_equal(
+        level.array[0, 0, 0], 
+        np.mean(pyramid[1].array[0, :2, :2], dtype=np.float32).astype(np.uint8))
+
+    # the most frequent object ID
+    segmentation = np.zeros((4, 64, 64), dtype=np.uint32)
+    segmentation[:, :, 16:] = 3
+    segmentation = Chunk(segmentation, global_offset=(0, 0, 0))
+    level = Pyramid.from_chunk(segmentation)[1]
+    assert level.dtype == np.uint32
+    assert set(np.unique(level.array)) == {0, 3}
+
+
+def test_pyramid_upload():
+    image = Chunk.create(size=(4, 64, 64), dtype=np.uint8,
+                         voxel_offset=(2, 32, 32))
+    tempdir = tempfile.mkdtemp()
+    volume_path = 'file://' + tempdir
+    CloudVolume.from_numpy(np.zeros_like(image.transpose()),
+                           vol_path=volume_path,
+                           voxel_offset=(32, 32, 2),
+                           chunk_size=(16, 16, 4),
+                           max_mip=3,
+                           layer_type='image')
+
+    pyramid = Pyramid.from_chunk(image)
+    volumes = {mip: CloudVolume(volume_path, mip=mip, autocrop=True) 
+               for mip in (1, 2, 3)}
+    pyramid.upload(volumes)
+    for mip, volume in volumes.items():
+        uploaded = volume[pyramid[mip].slices[::-1]][..., 0]
+        np.testing.assert_array_equal(np.transpose(uploaded), pyramid[mip].array)
+
+    shutil.rmtree(tempdir)
@@ -1,7 +1,9 @@
 import shutil
 import tempfile
 import numpy as np
+import pytest
 from chunkflow.chunk import Chunk
+from chunkflow.chunk.pyramid import Pyramid
 
 from cloudvolume import CloudVolume
 from cloudvolume.storage import Storage
@@ -62,3 +64,38 @@ def test_psd_map():
     img = np.random.rand(*size).astype(np.float32)
     chunk = Chunk(img, global_offset=[2, 32, 32])
     hierarchical_downsample(chunk, layer_type='image')
+
+def test_slabs():
+    print('test downsample and upload in z slabs...')
+    size = (16, 128, 128)
+    img = np.random.randint(8, size=size, dtype=np.uint64)
+    chunk = Chunk(img, global_offset=[2, 32, 32])
+
+    tempdir = tempfile.mkdtemp()
+    volume_path = 'file://' + tempdir
+    CloudVolume.from_numpy(chunk.transpose(),
+                           vol_path=volume_path,
+                           voxel_offset=(32, 32, 2),
+                           chunk_size=(32, 32, 4),
+                           max_mip=3,
+                           layer_type='segmentation')
+
+    operator = DownsampleUploadOperator(volume_path,
+                                        chunk_mip=0,
+                                        start_mip=1,
+                                        stop_mip=4,
+                                        slab_size=4)
+    operator(chunk)
+
+    # the slabs are independent, so the result is the same with the whole chunk
+    pyramid = Pyramid(chunk)
+    for mip in range(1, 4):
+        vol = CloudVolume(volume_path, mip=mip)
+        uploaded = vol[pyramid[mip].slices[::-1]][..., 0]
+        np.testing.assert_array_equal(np.transpose(uploaded), pyramid[mip].array)
+
+    # the slabs should be aligned with the blocks
+    with pytest.raises(AssertionError):
+        DownsampleUploadOperator(volume_path, chunk_mip=0, start_mip=1,
+                                 stop_mip=4, slab_size=6)
+    shutil.rmtree(tempdir)
@@ -5,6 +5,9 @@ from cloudvolume import CloudVolume
 #from cloudvolume.volumecutout import VolumeCutout
 from cloudvolume.lib import generate_random_string, Bbox
 import os, shutil
+from time import sleep
+
+import pytest
 
 from chunkflow.chunk.image.convnet.inferencer import Inferencer
 from chunkflow.flow.flow import *
@@ -182,5 +185,62 @@ class TestInferencePipeline(unittest.TestCase):
         shutil.rmtree('/tmp/output')
 
 
+def test_delete_task_in_queue():
+    class FakeQueue(object):
+        queue_name = 'fake-queue'
+
+        def __init__(self):
+            self.deleted = []
+
+        def delete(self, task_handle):
+            self.deleted.append(task_handle)
+
+    queue = FakeQueue()
+
+    def fetch_task(stream):
+        for task in stream:
+            for task_handle in range(3):
+                task = get_initial_task()
+                task['queue'] = queue
+                task['task_handle'] = task_handle
+                yield task
+    fetch_task.name = 'fetch-task'
+    fetch_task.params = {}
+
+    state['dry_run'] = False
+    operators = [fetch_task,
+                 delete_task_in_queue.callback(name='delete-task-in-queue')]
+    process_commands(operators, verbose=0, mip=0, dry_run=False,
+                     queue_depth=0, stage_queue_depth=(), workers=1,
+                     trace_file=None, free_chunks=True, metadata_ttl=None,
+                     metadata_cache_dir=None, upload_workers=1,
+                     upload_queue_depth=1)
+    assert queue.deleted == [0, 1, 2]
+
+
+
+def test_drain_uploads_after_failure():
+    uploaded = []
+    def upload(task_id):
+        sleep(0.2)
+        uploaded.append(task_id)
+
+    def save_then_fail(stream):
+        for task in stream:
+            uploader.submit(upload, 0)
+            yield task
+            raise RuntimeError('the next task failed')
+    save_then_fail.name = 'save-then-fail'
+    save_then_fail.params = {}
+
+    with pytest.raises(RuntimeError):
+        process_commands([save_then_fail], verbose=0, mip=0, dry_run=False,
+                         queue_depth=0, stage_queue_depth=(), workers=1,
+                         trace_file=None, free_chunks=True, metadata_ttl=None,
+                         metadata_cache_dir=None, upload_workers=1,
+                         upload_queue_depth=1)
+    # the upload of the finished task was waited
+    assert uploaded == [0]
+
 if __name__ == '__main__':
     unittest.main()
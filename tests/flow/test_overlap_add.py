@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+from itertools import product
+
+import numpy as np
+import pytest
+from cloudvolume.lib import Bbox, Vec
+
+from chunkflow.chunk import Chunk
+from chunkflow.chunk.image.convnet.inferencer import Inferencer
+from chunkflow.flow.overlap_add import OverlapAddOperator
+
+
+def test_overlap_add():
+    task_size = Vec(8, 32, 32)
+    patch_size = (4, 16, 16)
+    patch_overlap = (2, 8, 8)
+    # half of the patch overlap
+    margin_size = Vec(1, 4, 4)
+
+    # the volume of 2x2x2 tasks padded with zeros
+    image = Chunk.create(size=task_size * 2, dtype='uint8')
+    padded = np.pad(np.asarray(image), [(m, m) for m in margin_size])
+
+    tempdir = tempfile.mkdtemp()
+    accumulation_path = 'file://' + tempdir
+    operator = OverlapAddOperator(accumulation_path, margin_size=margin_size,
+                                  roi_start=(0, 0, 0), roi_stop=task_size * 2,
+                                  verbose=False)
+
+    inferencer = Inferencer(None, None, patch_size,
+                            num_output_channels=1,
+                            output_patch_overlap=patch_overlap,
+                            framework='identity',
+                            overlap_add=True,
+                            skip_zero_patches=False,
+                            verbose=False)
+    bboxes = [Bbox(Vec(*idx) * task_size, Vec(*idx) * task_size + task_size)
+              for idx in product((0, 1), repeat=3)]
+    with inferencer:
+        for bbox in bboxes:
+            input_bbox = Bbox(bbox.minpt - margin_size,
+                              bbox.maxpt + margin_size)
+            slices = tuple(slice(b, e) for b, e in zip(
+                input_bbox.minpt + margin_size, input_bbox.maxpt + margin_size))
+            input_chunk = Chunk(padded[slices], global_offset=input_bbox.minpt)
+            output_chunk = inferencer(input_chunk)
+            # the weighted output has the weight as the last channel
+            assert output_chunk.shape == (2, *input_bbox.size3())
+            operator.accumulate(output_chunk, bbox)
+
+    for bbox in bboxes:
+        output_chunk = operator.finalize(bbox)
+        assert output_chunk.shape == (1, *bbox.size3())
+        assert output_chunk.bbox == Bbox.from_slices(
+            (slice(0, 1), *bbox.to_slices()))
+        groundtruth = image.cutout(bbox.to_slices()).array.astype(
+            np.float32) / 255.
+        np.testing.assert_allclose(output_chunk[0], groundtruth, atol=1e-5)
+
+    # a neighboring task inside of the volume was not accumulated
+    bbox = bboxes[-1]
+    file_name = operator._file_name(bbox, source=bboxes[0])
+    for compressed_file_name in os.listdir(tempdir):
+        if compressed_file_name.startswith(file_name):
+            os.remove(os.path.join(tempdir, compressed_file_name))
+    with pytest.raises(FileNotFoundError):
+        operator.finalize(bbox)
+
+    shutil.rmtree(tempdir)
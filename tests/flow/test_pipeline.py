@@ -0,0 +1,82 @@
+import threading
+
+import pytest
+
+from chunkflow.flow.pipeline import (chunk_liveness, prefetch, 
+    release_chunks, run_workers)
+
+
+def test_prefetch():
+    print('test pipelined task stream...')
+    tasks = [{'id': i} for i in range(10)]
+
+    thread_names = []
+    def upstream():
+        for task in tasks:
+            thread_names.append(threading.current_thread().name)
+            yield task
+
+    stream = prefetch(upstream(), queue_depth=2, name='upstream')
+    assert [task['id'] for task in stream] == list(range(10))
+    # the upstream operator should run in a separate stage
+    assert set(thread_names) == {'upstream'}
+
+
+def test_prefetch_exception():
+    print('test exception in pipeline stage...')
+    def upstream():
+        yield {'id': 0}
+        raise ValueError('broken stage')
+
+    stream = prefetch(upstream(), queue_depth=1)
+    assert next(stream)['id'] == 0
+    with pytest.raises(ValueError):
+        next(stream)
+
+
+def test_run_workers():
+    print('test multiple workers sharing a task stream...')
+    tasks = [{'id': i} for i in range(20)]
+    
+    processed = []
+    def pipe(stream):
+        for task in stream:
+            task['worker'] = threading.current_thread().name
+            processed.append(task['id'])
+            yield task
+
+    run_workers(iter(tasks), pipe, worker_num=3)
+    # every task should be processed exactly once
+    assert sorted(processed) == list(range(20))
+    assert all(task['worker'].startswith('worker-') for task in tasks)
+
+    def broken_pipe(stream):
+        for task in stream:
+            raise ValueError('broken worker')
+            yield task
+    
+    with pytest.raises(ValueError):
+        run_workers(iter(tasks), broken_pipe, worker_num=2)
+
+
+def test_chunk_liveness():
+    print('test releasing chunks after the last usage...')
+    operator_params = [
+        {'name': 'fetch-task'},
+        {'name': 'cutout', 'output_chunk_name': 'image'},
+        {'name': 'normalize', 'input_chunk_name': 'image', 
+         'output_chunk_name': 'normalized'},
+        {'name': 'inference', 'input_chunk_name': 'normalized',
+         'output_chunk_name': 'affs'},
+        {'name': 'neuroglancer', 'chunk_names': 'image,affs'},
+        {'name': 'save', 'input_chunk_name': 'affs'},
+        # the mask chunk was not created in the pipeline
+        {'name': 'view', 'image_chunk_name': 'mask'},
+    ]
+    dead_chunk_names = chunk_liveness(operator_params)
+    assert dead_chunk_names == [set(), set(), set(), {'normalized'}, 
+                                {'image'}, {'affs'}, set()]
+
+    tasks = [{'image': 1, 'normalized': 2}, {'skip': True}]
+    tasks = list(release_chunks(tasks, {'normalized'}))
+    assert tasks == [{'image': 1}, {'skip': True}]
@@ -1,13 +1,18 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import os
 import shutil
 import tempfile
+from itertools import product
 from time import sleep
 
 import numpy as np
+import pytest
 from cloudvolume import CloudVolume
+from cloudvolume.lib import Bbox, Vec
 
 from chunkflow.chunk import Chunk
+from chunkflow.chunk.pyramid import Pyramid
 from chunkflow.flow.save import SaveOperator
 
 mip = 0
@@ -42,3 +47,223 @@ def test_save_image():
     
     sleep(2)
     shutil.rmtree(tempdir)
+
+
+def test_save_with_merge_dir():
+    image = Chunk.create(size=size, dtype=np.uint8,
+                         voxel_offset=voxel_offset)
+    tempdir = tempfile.mkdtemp()
+    merge_dir = tempfile.mkdtemp()
+    volume_path = 'file://' + tempdir
+    vol = CloudVolume.from_numpy(np.zeros_like(image.transpose()),
+                                 vol_path=volume_path,
+                                 voxel_offset=voxel_offset[::-1],
+                                 chunk_size=(32, 32, 4),
+                                 max_mip=0,
+                                 layer_type='image')
+
+    op = SaveOperator(volume_path, 0, upload_log=False,
+                      merge_dir=merge_dir, verbose=False)
+
+    # the task grid is not aligned with the storage blocks
+    bbox = image.bbox
+    for z, y, x in product((2, 5), (4, 25), (3, 40)):
+        start = (z, y, x)
+        stop = tuple(e if b == s else s for b, s, e in zip(
+            start, (5, 25, 40), bbox.maxpt))
+        slices = tuple(slice(b, e) for b, e in zip(start, stop))
+        op(image.cutout(slices))
+
+    saved = vol[vol.bounds.to_slices()][..., 0]
+    np.testing.assert_array_equal(np.transpose(saved), image.array)
+    # all the partial blocks were merged
+    assert not any(f.endswith('.npy') for _, _, files in os.walk(merge_dir)
+                   for f in files)
+
+    shutil.rmtree(tempdir)
+    shutil.rmtree(merge_dir)
+
+
+def test_flush_merge_buffer():
+    image = Chunk.create(size=size, dtype=np.uint8,
+                         voxel_offset=voxel_offset)
+    tempdir = tempfile.mkdtemp()
+    merge_dir = tempfile.mkdtemp()
+    volume_path = 'file://' + tempdir
+    # the existing data from an earlier run
+    existing = np.full_like(image.transpose(), 7)
+    vol = CloudVolume.from_numpy(np.zeros_like(existing),
+                                 vol_path=volume_path,
+                                 voxel_offset=voxel_offset[::-1],
+                                 chunk_size=(32, 32, 4),
+                                 max_mip=0,
+                                 layer_type='image')
+    vol[vol.bounds.to_slices()] = existing
+
+    op = SaveOperator(volume_path, 0, upload_log=False,
+                      merge_dir=merge_dir, verbose=False)
+
+    # the region of interest is smaller than one block
+    slices = (slice(3, 5), slice(10, 20), slice(8, 30))
+    op(image.cutout(slices))
+    np.testing.assert_array_equal(vol[vol.bounds.to_slices()][..., 0], existing)
+
+    assert op.flush() == 1
+    expected = np.transpose(existing).copy()
+    roi = tuple(slice(s.start - o, s.stop - o) 
+                for s, o in zip(slices, voxel_offset))
+    expected[roi] = image.array[roi]
+    saved = vol[vol.bounds.to_slices()][..., 0]
+    np.testing.assert_array_equal(np.transpose(saved), expected)
+    # the merge directory was cleaned up
+    assert not any(files for _, _, files in os.walk(merge_dir))
+
+    shutil.rmtree(tempdir)
+    shutil.rmtree(merge_dir)
+
+
+def test_save_skip_zero_blocks():
+    image = Chunk.create(size=size, dtype=np.uint8,
+                         voxel_offset=voxel_offset)
+    # the first block in x is all zero
+    image.array[:, :, :32] = 0
+    tempdir = tempfile.mkdtemp()
+    volume_path = 'file://' + tempdir
+    vol = CloudVolume.from_numpy(np.zeros_like(image.transpose()),
+                                 vol_path=volume_path,
+                                 voxel_offset=voxel_offset[::-1],
+                                 chunk_size=(32, 32, 4),
+                                 max_mip=0,
+                                 layer_type='image')
+    # only keep the info file
+    shutil.rmtree(os.path.join(tempdir, vol.key))
+
+    op = SaveOperator(volume_path, 0, upload_log=False,
+                      skip_zero_blocks=True, verbose=False)
+    log = {'timer': {}}
+    op(image, log=log)
+    assert len(log['zero_blocks']) == 4
+    assert len(os.listdir(os.path.join(tempdir, vol.key))) == 4
+    vol = CloudVolume(volume_path, fill_missing=True)
+    saved = vol[vol.bounds.to_slices()][..., 0]
+    np.testing.assert_array_equal(np.transpose(saved), image.array)
+
+    # the fake chunk of skipped task follows the volume
+    zero_chunk = op.create_chunk_with_zeros(image.bbox)
+    assert zero_chunk.dtype == np.uint8
+    log = {'timer': {}}
+    op(zero_chunk, log=log)
+    assert len(log['zero_blocks']) == 8
+
+    # the skipped task records the zero blocks without creating a chunk
+    zero_blocks = log['zero_blocks']
+    log = {'timer': {}}
+    op.save_zeros(image.bbox, log=log)
+    assert log['zero_blocks'] == zero_blocks
+    # the partially covered blocks are not recorded
+    log = {'timer': {}}
+    op.save_zeros(Bbox(image.bbox.minpt, image.bbox.maxpt - Vec(0, 0, 1)), 
+                  log=log)
+    assert len(log['zero_blocks']) == 4
+
+    shutil.rmtree(tempdir)
+
+
+def test_save_quantize():
+    affinity = np.random.rand(3, *size).astype(np.float32)
+    affinity[:, 0, 0, 0] = 2.
+    affinity = Chunk(affinity, global_offset=(0, *voxel_offset))
+    tempdir = tempfile.mkdtemp()
+    volume_path = 'file://' + tempdir
+    vol = CloudVolume.from_numpy(np.zeros(affinity.shape[::-1], dtype=np.uint8),
+                                 vol_path=volume_path,
+                                 voxel_offset=voxel_offset[::-1],
+                                 chunk_size=(32, 32, 3),
+                                 max_mip=0,
+                                 layer_type='image')
+
+    # the default range is from 0 to the chunk maximum
+    op = SaveOperator(volume_path, 0, upload_log=False, verbose=False)
+    op(affinity)
+    saved = np.transpose(vol[vol.bounds.to_slices()])
+    np.testing.assert_array_equal(
+        saved, (affinity.array / 2. * 255).astype(np.uint8))
+
+    # the values out of range are clipped
+    op = SaveOperator(volume_path, 0, upload_log=False, quantize_range=(0, 1),
+                      verbose=False, name='save-quantize')
+    op(affinity)
+    saved = np.transpose(vol[vol.bounds.to_slices()])
+    np.testing.assert_array_equal(
+        saved, (np.clip(affinity.array, 0, 1) * 255).astype(np.uint8))
+
+    shutil.rmtree(tempdir)
+
+
+def test_save_write_behind():
+    image = Chunk.create(size=size, dtype=np.uint8,
+                         voxel_offset=voxel_offset)
+    expected = np.copy(image.array)
+    tempdir = tempfile.mkdtemp()
+    volume_path = 'file://' + tempdir
+    vol = CloudVolume.from_numpy(np.zeros_like(image.transpose()),
+                                 vol_path=volume_path,
+                                 voxel_offset=voxel_offset[::-1],
+                                 chunk_size=(32, 32, 4),
+                                 max_mip=0,
+                                 layer_type='image')
+
+    op = SaveOperator(volume_path, 0, upload_log=False, write_behind=True,
+                      verbose=False)
+    future = op(image)
+    # the chunk is not copied, and could not be modified while uploading
+    assert not image.array.flags.writeable
+    with pytest.raises(ValueError):
+        image.array[:] = 0
+    future.result()
+    saved = vol[vol.bounds.to_slices()][..., 0]
+    np.testing.assert_array_equal(np.transpose(saved), expected)
+
+    # the chunks of a stream are owned by the operator
+    slabs = [Chunk(np.copy(expected[z:z+4]), 
+                   global_offset=(voxel_offset[0] + z, *voxel_offset[1:])) 
+             for z in range(0, size[0], 4)]
+    op(iter(slabs)).result()
+    assert not any(slab.array.flags.writeable for slab in slabs)
+
+    shutil.rmtree(tempdir)
+
+
+def test_save_thumbnail():
+    image = Chunk.create(size=(4, 256, 256), dtype=np.uint8)
+    tempdir = tempfile.mkdtemp()
+    volume_path = 'file://' + tempdir
+    CloudVolume.from_numpy(np.zeros_like(image.transpose()),
+                           vol_path=volume_path,
+                           chunk_size=(32, 32, 4),
+                           max_mip=0,
+                           layer_type='image')
+    thumbnail = CloudVolume.from_numpy(np.zeros_like(image.transpose()),
+                                       vol_path=os.path.join(volume_path, 'thumbnail'),
+                                       chunk_size=(32, 32, 4),
+                                       max_mip=6,
+                                       layer_type='image')
+    # only the last level is uploaded
+    shutil.rmtree(os.path.join(tempdir, 'thumbnail', thumbnail.key))
+
+    op = SaveOperator(volume_path, 0, upload_log=False, create_thumbnail=True,
+                      verbose=False)
+    op(image)
+
+    # the chunk is downsampled until it is smaller than the underlying 
+    # block size of mip 1
+    assert op._thumbnail_level(image) == 3
+    thumbnail = CloudVolume(os.path.join(volume_path, 'thumbnail'), mip=3)
+    expected = Pyramid(image)[3]
+    saved = thumbnail[expected.slices[::-1]][..., 0]
+    np.testing.assert_array_equal(np.transpose(saved), expected.array)
+    for mip in (1, 2, 4):
+        assert not os.path.exists(os.path.join(
+            tempdir, 'thumbnail', thumbnail.meta.key(mip)))
+
+    shutil.rmtree(tempdir)
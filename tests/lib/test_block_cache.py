@@ -0,0 +1,116 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from cloudvolume.lib import Bbox, Vec
+
+from chunkflow.lib.block_cache import BlockCache, _box_cover
+
+
+def test_block_cache():
+    print('test block cache...')
+    cache_dir = tempfile.mkdtemp()
+    # a fake volume in xyzc order
+    bounds = Bbox((10, 10, 0), (74, 58, 20))
+    volume = np.random.randint(0, 255, size=(*bounds.size3(), 1), dtype=np.uint8)
+    block_size = Vec(16, 16, 8)
+
+    downloaded = []
+    def download(bbox):
+        # the downloaded region should be aligned with blocks
+        assert np.all((bbox.minpt - bounds.minpt) % block_size == 0)
+        downloaded.append(bbox)
+        slices = tuple(slice(b - o, e - o) for b, e, o in zip(
+            bbox.minpt, bbox.maxpt, bounds.minpt))
+        return volume[slices]
+
+    def cutout(cache, bbox, stats):
+        return cache.cutout('gs://bucket/image', 0, bbox, block_size,
+                            bounds.minpt, bounds, download, np.uint8,
+                            stats=stats)
+
+    cache = BlockCache(cache_dir)
+    bbox = Bbox((20, 12, 2), (50, 40, 12))
+    stats = {}
+    arr = cutout(cache, bbox, stats)
+    np.testing.assert_array_equal(arr, volume[10:40, 2:30, 2:12, :])
+    assert stats['hits'] == 0 and stats['misses'] == 3 * 2 * 2
+    # all the missing blocks were downloaded together
+    assert len(downloaded) == 1
+
+    # the overlapping blocks should be read from cache
+    downloaded.clear()
+    bbox = Bbox((40, 30, 2), (80, 60, 12))
+    stats = {}
+    arr = cutout(cache, bbox, stats)
+    expected = np.zeros((40, 30, 10, 1), dtype=np.uint8)
+    # the region outside of volume is filled with zeros
+    expected[:34, :28, :, :] = volume[30:, 20:, 2:12, :]
+    np.testing.assert_array_equal(arr, expected)
+    assert stats['hits'] == 2 * 1 * 2
+    assert stats['misses'] == 3 * 2 * 2 - 4
+    assert stats['bytes_saved'] == 4 * 16 * 16 * 8
+    # the missing blocks form a L shape covered by two boxes
+    assert len(downloaded) == 2
+
+    # the cache should be bounded
+    cache.max_size = 16 * 16 * 8 * 3
+    cache.evict()
+    total_size = 0
+    for root, _, file_names in os.walk(cache_dir):
+        for file_name in file_names:
+            if file_name.endswith('.npy'):
+                total_size += os.path.getsize(os.path.join(root, file_name))
+    assert 0 < total_size <= cache.max_size
+
+    shutil.rmtree(cache_dir)
+
+
+def test_block_cache_eviction():
+    cache_dir = tempfile.mkdtemp()
+    bounds = Bbox((0, 0, 0), (64, 64, 8))
+    volume = np.random.randint(1, 255, size=(*bounds.size3(), 1), dtype=np.uint8)
+    # the missing blocks in the last half of x were filled with zeros
+    volume[32:, ...] = 0
+    block_size = Vec(16, 16, 8)
+
+    def download(bbox):
+        return volume[bbox.to_slices()]
+
+    # the cache directory is scanned after writing about 4 blocks
+    cache = BlockCache(cache_dir, max_size=16 * 16 * 8 * 40)
+    scans = []
+    evict = cache._evict
+    def count_scans():
+        scans.append(None)
+        evict()
+    cache._evict = count_scans
+    
+    for x in range(0, 64, 16):
+        for y in range(0, 64, 16):
+            bbox = Bbox((x, y, 0), (x + 16, y + 16, 8))
+            arr = cache.cutout('gs://bucket/image', 0, bbox, block_size,
+                               bounds.minpt, bounds, download, np.uint8,
+                               fill_missing=True)
+            np.testing.assert_array_equal(arr, download(bbox))
+
+    # the cache directory is not scanned in every miss
+    assert len(scans) == 2
+    # the filled zero blocks were not cached
+    file_names = [file_name for _, _, file_names in os.walk(cache_dir)
+                  for file_name in file_names if file_name.endswith('.npy')]
+    assert len(file_names) == 8
+    assert all(Bbox.from_filename(file_name[:-len('.npy')]).minpt[0] < 32
+               for file_name in file_names)
+
+    shutil.rmtree(cache_dir)
+
+
+def test_box_cover():
+    mask = np.zeros((3, 4, 5), dtype=bool)
+    mask[0, :2, :] = True
+    mask[1:, 3, 1:4] = True
+    boxes = _box_cover(mask)
+    assert boxes == [((0, 0, 0), (1, 2, 5)), ((1, 3, 1), (3, 4, 4))]
@@ -0,0 +1,61 @@
+import shutil
+import tempfile
+from itertools import product
+
+import numpy as np
+
+from cloudvolume.lib import Bbox, Vec
+
+from chunkflow.lib.merge_buffer import MergeBuffer, split_aligned
+
+
+def test_split_aligned():
+    block_size = Vec(16, 16, 4)
+    voxel_offset = Vec(0, 0, 0)
+    bounds = Bbox((0, 0, 0), (64, 64, 10))
+
+    aligned_bbox, partial_bboxes = split_aligned(
+        Bbox((5, 0, 0), (40, 64, 9)), block_size, voxel_offset, bounds)
+    # the region reaching the volume bounds is aligned
+    assert aligned_bbox == Bbox((16, 0, 0), (32, 64, 8))
+    # the last block in z is clipped by the volume bounds
+    assert Bbox((0, 0, 8), (16, 16, 10)) in partial_bboxes
+    covered = sum(b.volume() for b in partial_bboxes) + aligned_bbox.volume()
+    assert covered == 48 * 64 * 10
+
+    aligned_bbox, partial_bboxes = split_aligned(
+        Bbox((16, 16, 4), (48, 64, 10)), block_size, voxel_offset, bounds)
+    assert aligned_bbox == Bbox((16, 16, 4), (48, 64, 10))
+    assert len(partial_bboxes) == 0
+
+    aligned_bbox, partial_bboxes = split_aligned(
+        Bbox((18, 18, 5), (30, 30, 7)), block_size, voxel_offset, bounds)
+    assert aligned_bbox is None
+    assert partial_bboxes == [Bbox((16, 16, 4), (32, 32, 8))]
+
+
+def test_merge_buffer():
+    merge_dir = tempfile.mkdtemp()
+    merge_buffer = MergeBuffer(merge_dir)
+    block_bbox = Bbox((16, 16, 4), (32, 32, 8))
+    block = np.random.randint(0, 255, size=(16, 16, 4, 1), dtype=np.uint8)
+
+    # 4 parts splitting the block in x and y
+    parts = [Bbox((x, y, 4), (x + 8, y + 8, 8))
+             for x, y in product((16, 24), repeat=2)]
+
+    for idx, part_bbox in enumerate(parts):
+        part = block[tuple(slice(b - o, e - o) for b, e, o in zip(
+            part_bbox.minpt, part_bbox.maxpt, block_bbox.minpt))]
+        if idx < len(parts) - 1:
+            assert merge_buffer.stage('gs://bucket/image', 0, block_bbox,
+                                      part_bbox, part) is None
+            # staging the same part again, such as a retried task, replaces it
+            assert merge_buffer.stage('gs://bucket/image', 0, block_bbox,
+                                      part_bbox, part) is None
+        else:
+            result = merge_buffer.stage('gs://bucket/image', 0, block_bbox,
+                                        part_bbox, part)
+            np.testing.assert_array_equal(result, block)
+
+    shutil.rmtree(merge_dir)
@@ -0,0 +1,68 @@
+import os
+import json
+import shutil
+import tempfile
+from threading import Thread
+
+from cloudvolume import CloudVolume
+
+from chunkflow.lib.metadata_cache import MetadataCache, ThreadLocalVolume
+
+
+def test_metadata_cache():
+    print('test metadata cache...')
+    layer_dir = tempfile.mkdtemp()
+    cache_dir = tempfile.mkdtemp()
+    layer_path = 'file://' + layer_dir
+    with open(os.path.join(layer_dir, 'info'), 'w') as f:
+        json.dump({'num_channels': 1}, f)
+
+    cache = MetadataCache(cache_dir=cache_dir)
+    assert cache.get(layer_path, 'info') == {'num_channels': 1}
+    # the missing file is also cached
+    assert cache.get(layer_path, 'provenance') is None
+
+    # the cached metadata is used even if the info file was changed
+    with open(os.path.join(layer_dir, 'info'), 'w') as f:
+        json.dump({'num_channels': 3}, f)
+    assert cache.get(layer_path, 'info') == {'num_channels': 1}
+    # another process could use the metadata persisted in local disk
+    assert MetadataCache(cache_dir=cache_dir).get(
+        layer_path, 'info') == {'num_channels': 1}
+
+    cache.invalidate(layer_path)
+    assert cache.get(layer_path, 'info') == {'num_channels': 3}
+
+    # the metadata expires immediately
+    cache.configure(ttl=0)
+    with open(os.path.join(layer_dir, 'info'), 'w') as f:
+        json.dump({'num_channels': 2}, f)
+    assert cache.get(layer_path, 'info') == {'num_channels': 2}
+
+    shutil.rmtree(layer_dir)
+    shutil.rmtree(cache_dir)
+
+
+def test_thread_local_volume():
+    print('test thread local volume...')
+    layer_dir = tempfile.mkdtemp()
+    layer_path = 'file://' + layer_dir
+    info = CloudVolume.create_new_info(
+        num_channels=1, layer_type='image', data_type='uint8',
+        encoding='raw', resolution=(1, 1, 1), voxel_offset=(0, 0, 0),
+        volume_size=(64, 64, 8), chunk_size=(32, 32, 4))
+    CloudVolume(layer_path, info=info).commit_info()
+
+    volume = ThreadLocalVolume(layer_path, fill_missing=True)
+    # the handle is reused in the same thread
+    assert volume.get() is volume.get()
+
+    handles = []
+    thread = Thread(target=lambda: handles.append(volume.get()))
+    thread.start()
+    thread.join()
+    # another thread opens its own handle
+    assert handles[0] is not volume.get()
+    assert tuple(handles[0].chunk_size) == (32, 32, 4)
+
+    shutil.rmtree(layer_dir)
@@ -0,0 +1,40 @@
+import os
+import json
+import tempfile
+
+from chunkflow.lib.tracer import Tracer
+
+
+def test_tracer():
+    print('test span tracing...')
+    tracer = Tracer()
+
+    # disabled tracer do not record anything
+    with tracer.span('disabled'):
+        pass
+    assert len(tracer.events) == 0
+
+    tracer.enable()
+    with tracer.span('operator', category='test', bbox='0-1_0-1_0-1'):
+        with tracer.span('step'):
+            pass
+    
+    start = tracer.now()
+    tracer.add_span('manual', start, start + 1.)
+    assert [event['name'] for event in tracer.events] == ['step', 'operator', 'manual']
+    assert tracer.events[1]['args']['bbox'] == '0-1_0-1_0-1'
+    assert tracer.events[2]['dur'] == 1e6
+
+    # the nested span should be inside the parent span
+    step, operator, _ = tracer.events
+    assert step['ts'] >= operator['ts']
+    assert step['ts'] + step['dur'] <= operator['ts'] + operator['dur']
+    
+    file_name = os.path.join(tempfile.mkdtemp(), 'trace.json')
+    tracer.export(file_name)
+    with open(file_name) as f:
+        trace = json.load(f)
+    phases = [event['ph'] for event in trace['traceEvents']]
+    assert phases == ['M', 'X', 'X', 'X']
+    assert trace['traceEvents'][0]['args']['name'] == 'MainThread'
+    os.remove(file_name)
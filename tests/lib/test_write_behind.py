@@ -0,0 +1,34 @@
+import time
+import threading
+
+import pytest
+
+from chunkflow.lib.write_behind import WriteBehindUploader, wait_uploads
+
+
+def test_write_behind_uploader():
+    print('test write-behind uploading...')
+    uploader = WriteBehindUploader(worker_num=2, queue_depth=1)
+    
+    uploaded = []
+    def upload(idx):
+        time.sleep(0.01)
+        uploaded.append((idx, threading.current_thread().name))
+        return idx
+
+    task = {'pending_uploads': [uploader.submit(upload, idx) for idx in range(5)]}
+    wait_uploads(task)
+    assert 'pending_uploads' not in task
+    assert sorted(idx for idx, _ in uploaded) == list(range(5))
+    assert all(name.startswith('uploader-') for _, name in uploaded)
+    
+    def broken_upload():
+        raise IOError('broken uploading')
+    
+    future = uploader.submit(broken_upload)
+    with pytest.raises(IOError):
+        wait_uploads({'pending_uploads': [future]})
+    
+    # the failed job should also be raised while draining
+    with pytest.raises(IOError):
+        uploader.drain()